@@ -0,0 +1,313 @@
+"""
+Micro-benchmarks of the local CPU hot paths.
+
+Runs each benchmark on synthetic datasets of 1k, 15k and 140k items in a
+temporary working directory, and reports the median wall-clock time and the
+peak traced memory against the stored baselines. Times are compared after
+scaling the baseline by the speed of the machine, measured on a reference
+workload run right before each timed run. Fails if any of them regressed by more
+than the threshold in the first measurement and in each of the `--retries`
+repeated ones, if a benchmark has no baseline, or if the tokenizer encoding
+is unavailable.
+
+    python benchmarks/hotpaths.py --sizes 1000 15000
+    python benchmarks/hotpaths.py --update   # store new baselines, the median of the measurements
+
+Baselines are machine specific, update them on the machine that runs the check.
+"""
+import gc
+import os
+import io
+import sys
+import json
+import time
+import statistics
+import random
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from src.utils import (  # noqa: E402
+    write_to_json_file,
+    read_json_file,
+    num_tokens_from_string,
+)
+from src.tagging import IssueTypes, normalise_error_type  # noqa: E402
+from src import tagging, granular_annotation, corruption_pipeline, issues_bench  # noqa: E402
+
+
+BASELINES_PATH = os.path.join(REPO_ROOT, "benchmarks", "baselines.json")
+DEFAULT_SIZES = [1000, 15000, 140000]
+ERROR_TYPES = [normalise_error_type(issue.value) for issue in IssueTypes]
+ASPECTS = ["accuracy", "completeness", "clarity", "logical_consistency"]
+# Absolute slack on top of the relative threshold, so sub-millisecond benchmarks do not flake.
+MIN_DELTA = {"seconds": 0.005, "peak_mb": 1.0}
+
+
+def make_response(rng, index):
+    lines = [f"    total += values[{i}] * {rng.randint(1, 9)}" for i in range(rng.randint(5, 25))]
+    code = "\n".join(["import math", f"def compute_{index}(values):", "    total = 0", *lines, "    return total"])
+    prose = " ".join(rng.choice(["The", "loop", "sums", "each", "value", "of", "the", "list."]) for _ in range(40))
+    return f"{prose}\n\n```python\n{code}\n```\n\n{prose}"
+
+
+def make_items(size, seed=0):
+    """Synthetic items carrying the fields of every stage output."""
+    rng = random.Random(seed)
+    items = []
+    for index in range(size):
+        correct = make_response(rng, index)
+        incorrect = correct.replace("import math\n", "").replace("total = 0", "total = 1")
+        error_types = rng.sample(ERROR_TYPES, rng.randint(1, 3))
+        items.append(
+            {
+                "id": index,
+                "p_id": index,
+                "prompt": f"Write a function that sums the list number {index}.",
+                "problem": f"Write a function that sums the list number {index}.",
+                "solution": correct,
+                "correct_response": correct,
+                "error_embedded_response": incorrect,
+                "error_types": error_types,
+                "embedded_errors": {error_type: "Embedded in the loop." for error_type in error_types},
+                "tagged_erros": {
+                    "error_types": error_types,
+                    "embedding_plan": {error_type: "Change the loop." for error_type in error_types},
+                },
+                "masked_regions": [[0, 10, 1]],
+            }
+        )
+    return items
+
+
+def make_annotation_outputs(items):
+    # annotate_chunk updates the items, copies keep the other benchmarks' inputs unchanged.
+    return [
+        (
+            dict(item),
+            json.dumps(
+                {
+                    "incorrect_regions": [
+                        {"error_substring": "total = 1", "error_explanation": "Wrong initial value."},
+                        {"error_substring": "import", "error_explanation": "Missing import."},
+                    ]
+                }
+            ),
+        )
+        for item in items
+    ]
+
+
+def make_evaluations(items, seed=0):
+    rng = random.Random(seed)
+    error_evaluations = [
+        {"error_types": item["error_types"] if rng.random() < 0.5 else [], "prompt_id": item["p_id"]}
+        for item in items
+    ]
+    correctness_evaluations = [
+        {
+            **{aspect: {"value": rng.choice(["Yes", "No"]), "explanation": ""} for aspect in ASPECTS},
+            "prompt_id": item["p_id"],
+        }
+        for item in items
+    ]
+    return error_evaluations, correctness_evaluations
+
+
+def bench_masked_region_tuple(items):
+    for item in items:
+        granular_annotation.get_masked_region_tuple(
+            item["correct_response"], item["error_embedded_response"], "total = 1"
+        )
+
+
+def bench_annotate_chunk(outputs):
+    granular_annotation.annotate_chunk(outputs)
+
+
+def bench_prepare_sft(items):
+    corruption_pipeline.prepare_sft_corruption_dataset(items)
+
+
+def bench_prepare_final(items):
+    granular_annotation.prepare_final_dataset(items)
+
+
+def bench_tagging_stats(items):
+    tagging.print_stats(items, "output/filtered_error_types")
+
+
+def bench_valid_error_types(items):
+    corruption_pipeline.get_valid_error_types(items)
+
+
+def bench_bench_stats(evaluations):
+    issues_bench.error_and_correctness_stats(*evaluations, "synthetic")
+
+
+def bench_json_roundtrip(items):
+    write_to_json_file(items, "output/roundtrip")
+    read_json_file("output/roundtrip")
+
+
+def bench_num_tokens(items):
+    for item in items:
+        num_tokens_from_string(item["correct_response"])
+
+
+# name -> (benchmark, builds its input from the synthetic items)
+BENCHMARKS = {
+    "get_masked_region_tuple": (bench_masked_region_tuple, lambda items: items),
+    "annotate_chunk": (bench_annotate_chunk, make_annotation_outputs),
+    "prepare_sft_corruption_dataset": (bench_prepare_sft, lambda items: items),
+    "prepare_final_dataset": (bench_prepare_final, lambda items: items),
+    "tagging.print_stats": (bench_tagging_stats, lambda items: items),
+    "get_valid_error_types": (bench_valid_error_types, lambda items: items),
+    "error_and_correctness_stats": (bench_bench_stats, make_evaluations),
+    "json_roundtrip": (bench_json_roundtrip, lambda items: items),
+    "num_tokens_from_string": (bench_num_tokens, lambda items: items),
+}
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def measure(func, data, repeat):
+    """
+    Times `repeat` runs, each right after a run of the reference workload.
+
+    The machine speed drifts on shared and throttled hosts, so each run is
+    compared to the calibration run next to it rather than to an absolute time.
+    Returns the median time, the median calibration time, the median ratio of
+    the two, and the peak memory of one traced run, in MB.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        timings, calibrations = [], []
+        for _ in range(repeat):
+            gc.collect()
+            calibrations.append(timed(reference_workload))
+            timings.append(timed(func, data))
+
+        tracemalloc.start()
+        func(data)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    ratio = statistics.median(timing / calibration for timing, calibration in zip(timings, calibrations))
+    return statistics.median(timings), statistics.median(calibrations), ratio, peak / 2**20
+
+
+def reference_workload():
+    records = [{"id": i, "text": f"value {i} " * 8, "tags": [str(i % 7), str(i % 11)]} for i in range(10000)]
+    decoded = json.loads(json.dumps(records))
+    return sorted(decoded, key=lambda record: record["text"][::-1])
+
+
+def is_available(name):
+    if name != "num_tokens_from_string":
+        return True
+    try:
+        num_tokens_from_string("warm up the cached encoding")
+        return True
+    except Exception:
+        return False
+
+
+def get_expected(result, baseline):
+    """The baseline, with its time scaled to the current speed of the machine."""
+    return {"seconds": baseline["ratio"] * result["calibration"], "peak_mb": baseline["peak_mb"]}
+
+
+def compare(result, baseline, threshold):
+    if baseline is None:
+        return "FAIL no baseline"
+    expected = get_expected(result, baseline)
+    # The time is compared through the ratio, which pairs each run with its own calibration.
+    measured = {"seconds": result["ratio"] * result["calibration"], "peak_mb": result["peak_mb"]}
+    regressed = [
+        metric
+        for metric in ("seconds", "peak_mb")
+        if measured[metric] > max(expected[metric] * (1 + threshold), expected[metric] + MIN_DELTA[metric])
+    ]
+    return f"FAIL {', '.join(regressed)}" if regressed else "ok"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the local CPU hot paths.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Synthetic dataset sizes.")
+    parser.add_argument("-b", "--benchmarks", type=str, nargs="+", default=list(BENCHMARKS), help="Benchmarks to run.")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per benchmark, the median counts.")
+    parser.add_argument(
+        "--retries", type=int, default=2, help="Measurements repeated before a regression counts, or to pick the baseline."
+    )
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed relative regression of time and memory.")
+    parser.add_argument("--update", action="store_true", help="Store the results as the new baselines.")
+    args = parser.parse_args()
+
+    baselines = {}
+    if os.path.exists(BASELINES_PATH):
+        with open(BASELINES_PATH) as jf:
+            baselines = json.load(jf)
+
+    failed = False
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        os.makedirs("output")
+
+        print(f"{'benchmark':<34}{'size':>8}{'seconds':>10}{'peak MB':>10}{'expected s':>12}{'baseline MB':>13}  status")
+        for size in args.sizes:
+            items = make_items(size)
+            for name in args.benchmarks:
+                if not is_available(name):
+                    # Outside of --update, an unavailable encoding would hide any regression of the benchmark.
+                    status = "skipped" if args.update else "FAIL"
+                    print(f"{name:<34}{size:>8}  {status} tokenizer encoding unavailable")
+                    failed = failed or not args.update
+                    continue
+                func, build_input = BENCHMARKS[name]
+                data = build_input(items)
+                key = f"{name}@{size}"
+                baseline = baselines.get(key)
+                # A regression must show in every measurement, so one noisy run does not fail the check.
+                # Baselines keep the measurement with the median ratio, so they sit in the middle of the noise.
+                results = []
+                for _ in range(1 + args.retries):
+                    seconds, calibration, ratio, peak_mb = measure(func, data, args.repeat)
+                    result = {
+                        "seconds": round(seconds, 4),
+                        "peak_mb": round(peak_mb, 2),
+                        "calibration": round(calibration, 4),
+                        "ratio": round(ratio, 4),
+                    }
+                    results.append(result)
+                    status = "updated" if args.update else compare(result, baseline, args.threshold)
+                    if not args.update and (not status.startswith("FAIL") or baseline is None):
+                        break
+                if args.update:
+                    result = sorted(results, key=lambda result: result["ratio"])[len(results) // 2]
+                    baselines[key] = result
+                failed = failed or status.startswith("FAIL")
+                expected = f"{get_expected(result, baseline)['seconds']:.4f}" if baseline and not args.update else "-"
+                print(
+                    f"{name:<34}{size:>8}{result['seconds']:>10.4f}{result['peak_mb']:>10.2f}"
+                    f"{expected:>12}{baseline['peak_mb'] if baseline else '-':>13}  {status}"
+                )
+        os.chdir(REPO_ROOT)
+
+    if args.update:
+        with open(BASELINES_PATH, "w") as jf:
+            json.dump(baselines, jf, indent=4, sort_keys=True)
+        print(f"Baselines written to {BASELINES_PATH}.")
+        return
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Startup-time guard for the local CLI commands.
+
+Runs a few local subcommands of `python -m src` on a tiny synthetic dataset in
+a fresh interpreter and fails if any of them takes longer than the threshold,
+or if importing the stage modules pulls in a provider client or the tokenizer.
+
+    python benchmarks/startup.py --threshold 1.0
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = [
+    "langchain_openai",
+    "langchain_anthropic",
+    "openai",
+    "tiktoken",
+    "dotenv",
+    "pandas",
+    "matplotlib",
+]
+STAGE_MODULES = [
+    "src.cli",
+    "src.utils",
+    "src.rectify",
+    "src.tagging",
+    "src.local_tagger",
+    "src.embed",
+    "src.tag_and_embed",
+    "src.verify",
+    "src.mutate",
+    "src.export_binary",
+    "src.granular_annotation",
+    "src.manifest",
+    "src.dry_run",
+    "src.corruption_pipeline",
+    "src.issues_bench",
+]
+LOCAL_COMMANDS = [
+    ["export", "-i", "output/embedded.json", "-f", "sft"],
+    ["export", "-i", "output/granular_annotation.json", "-f", "granular"],
+    ["verify", "-i", "output/embedded.json"],
+]
+
+
+def write_synthetic_outputs(work_dir):
+    response = "```python\nimport os\nprint(os.sep)\n```"
+    item = {
+        "id": 1,
+        "prompt": "Print the path separator.",
+        "correct_response": response,
+        "error_embedded_response": response.replace("import os\n", ""),
+        "error_types": ["omitting-necessary-imports"],
+        "masked_regions": [[12, 21, 1]],
+    }
+    os.makedirs(os.path.join(work_dir, "output"), exist_ok=True)
+    with open(os.path.join(work_dir, "output", "embedded.json"), "w") as jf:
+        json.dump({"stats": {}, "results": [item]}, jf)
+    with open(os.path.join(work_dir, "output", "granular_annotation.json"), "w") as jf:
+        json.dump([item], jf)
+
+
+def run_timed(args, work_dir):
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, *args],
+        cwd=work_dir,
+        env=env,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start
+
+
+def find_heavy_imports():
+    code = (
+        "import sys\n"
+        + "".join(f"import {module}\n" for module in STAGE_MODULES)
+        + f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=REPO_ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return [module for module in out.stdout.strip().split(",") if module]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Guard the startup time of local commands.")
+    parser.add_argument("--threshold", type=float, default=1.0, help="Maximum seconds per command.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per command, the best one counts.")
+    args = parser.parse_args()
+
+    failed = False
+    heavy = find_heavy_imports()
+    if heavy:
+        print(f"FAIL stage modules eagerly import: {', '.join(heavy)}")
+        failed = True
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        write_synthetic_outputs(work_dir)
+        for command in LOCAL_COMMANDS:
+            best = min(
+                run_timed(["-m", "src", *command], work_dir) for _ in range(args.repeat)
+            )
+            status = "ok" if best <= args.threshold else "FAIL"
+            failed = failed or best > args.threshold
+            print(f"{status:4} {best:.3f}s python -m src {' '.join(command)}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""
+Single entry point for every stage of the pipeline: `python -m src <command>`.
+
+Only argparse is imported at startup. Each command imports its stage module
+when it runs, so local commands (export, verify, mutate) never load the
+provider clients or the tokenizer.
+"""
+import sys
+import argparse
+
+
+# Same order as corruption_pipeline.STAGES, kept here so parsing imports nothing.
+PIPELINE_STAGES = ["rectify", "tag", "embed", "verify"]
+
+
+def strip_json_extension(file_path):
+    return file_path.replace(".json", "")
+
+
+def add_dry_run_arguments(parser):
+    parser.add_argument("--dry_run", "--dry-run", action="store_true", help="Render the prompts and estimate tokens, cost and time without sending them.")
+    parser.add_argument("--rpm", type=int, default=5000, help="Requests per minute allowed, used by --dry_run.")
+    parser.add_argument("--tpm", type=int, default=800000, help="Tokens per minute allowed, used by --dry_run.")
+
+
+def run_dry_run(stage_requests, args):
+    from src.dry_run import dry_run
+
+    dry_run(stage_requests, args.rpm, args.tpm)
+
+
+def run_pipeline(args):
+    from src.corruption_pipeline import main
+
+    argv = ["-i", args.input_file_path]
+    if args.edit_mode:
+        argv.append("--edit_mode")
+    if args.streaming:
+        argv.append("--streaming")
+    if args.force:
+        argv.append("--force")
+    if args.active_tagging:
+        argv.append("--active_tagging")
+    if args.fused_tag_embed:
+        argv.append("--fused_tag_embed")
+    if args.dry_run:
+        argv += ["--dry_run", "--rpm", str(args.rpm), "--tpm", str(args.tpm)]
+    main(
+        argv
+        + ["--from_stage", args.from_stage, "--to_stage", args.to_stage]
+        + ["--max_similarity", str(args.max_similarity)]
+    )
+
+
+def run_rectify(args):
+    from src.utils import read_json_file, create_directory
+    from src.rectify import rectify_issues
+
+    data = read_json_file(strip_json_extension(args.input_file_path))
+    if args.dry_run:
+        from src.dry_run import get_stage_name, rectify_requests
+
+        return run_dry_run({get_stage_name("rectify", args.edit_mode): rectify_requests(data, args.edit_mode)}, args)
+    create_directory("output")
+    rectify_issues(data, args.edit_mode, args.streaming)
+
+
+def run_tag(args):
+    from src.utils import read_json_file, create_directory
+    from src.tagging import tag_error_types
+
+    data = read_json_file(strip_json_extension(args.input_file_path))
+    if args.dry_run:
+        from src.dry_run import tag_requests
+
+        return run_dry_run({"tag": tag_requests(data)}, args)
+    create_directory("output")
+    tag_error_types(data, args.active)
+
+
+def run_embed(args):
+    from src.utils import read_json_file, create_directory
+    from src.embed import embed_errors_and_save, embed_multiple_errors
+    from src.corruption_pipeline import get_valid_error_types
+
+    data = read_json_file(strip_json_extension(args.input_file_path))
+    if args.dry_run:
+        from src.dry_run import embed_requests, get_stage_name
+
+        requests = embed_requests(data, get_valid_error_types(data, args.min_count), args.edit_mode)
+        return run_dry_run({get_stage_name("embed", args.edit_mode): requests}, args)
+    create_directory("output")
+    if args.limit_per_error:
+        embed_errors_and_save(
+            data,
+            args.limit_per_error,
+            edit_mode=args.edit_mode,
+            streaming=args.streaming,
+        )
+    else:
+        embed_multiple_errors(
+            data,
+            get_valid_error_types(data, args.min_count),
+            args.edit_mode,
+            args.streaming,
+        )
+
+
+def run_tag_embed(args):
+    from src.utils import read_json_file, create_directory
+    from src.tag_and_embed import tag_and_embed
+
+    data = read_json_file(strip_json_extension(args.input_file_path))
+    if args.dry_run:
+        from src.dry_run import tag_and_embed_requests
+
+        return run_dry_run({"tag-and-embed": tag_and_embed_requests(data, args.error_types)}, args)
+    create_directory("output")
+    tag_and_embed(data, args.error_types, args.streaming)
+
+
+def run_verify(args):
+    from src.utils import read_json_file, create_directory
+    from src.verify import verify_and_save
+
+    data = read_json_file(strip_json_extension(args.input_file_path))["results"]
+    create_directory("output")
+    verify_and_save(data, max_similarity=args.max_similarity)
+
+
+def run_mutate(args):
+    from src.utils import read_json_file, create_directory
+    from src.mutate import mutate_and_save
+
+    data = read_json_file(strip_json_extension(args.input_file_path))
+    create_directory("output")
+    mutate_and_save(data, args.error_types, args.seed)
+
+
+def run_annotate(args):
+    from src.utils import read_json_file, create_directory
+    from src.granular_annotation import get_error_substrings, prepare_final_dataset
+
+    data = read_json_file(strip_json_extension(args.input_file_path))["results"]
+    if args.dry_run:
+        from src.dry_run import annotate_requests
+
+        return run_dry_run({"annotate": annotate_requests(data)}, args)
+    create_directory("output")
+    get_error_substrings(
+        data, window_tokens=args.window_tokens, overlap_tokens=args.overlap_tokens
+    )
+    prepare_final_dataset(read_json_file("output/granular_annotation"))
+
+
+def run_export(args):
+    from src.utils import read_json_file, create_directory
+
+    create_directory("output")
+    data = read_json_file(strip_json_extension(args.input_file_path))
+    if args.format == "sft":
+        from src.corruption_pipeline import prepare_sft_corruption_dataset
+
+        prepare_sft_corruption_dataset(data["results"] if isinstance(data, dict) else data)
+    elif args.format == "binary":
+        from src.export_binary import export_binary_dataset
+
+        export_binary_dataset(
+            data["results"] if isinstance(data, dict) else data,
+            args.output_dir,
+            args.tokenizer,
+        )
+    else:
+        from src.granular_annotation import prepare_final_dataset
+
+        prepare_final_dataset(data)
+
+
+def run_bench(args):
+    from src.issues_bench import main
+
+    main(args.bench_args)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m src", description="Corruption pipeline stages."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    pipeline = subparsers.add_parser("pipeline", help="Run rectify, tag, embed and verify end to end.")
+    pipeline.add_argument("-i", "--input_file_path", type=str, required=True, help="File path for processing.")
+    pipeline.add_argument("--edit_mode", action="store_true", help="Return search/replace edits instead of full responses.")
+    pipeline.add_argument("--streaming", action="store_true", help="Stream outputs and stop generations that are not needed.")
+    pipeline.add_argument("--from_stage", "--from-stage", choices=PIPELINE_STAGES, default=PIPELINE_STAGES[0], help="First stage to consider, earlier stages reuse their existing outputs.")
+    pipeline.add_argument("--to_stage", "--to-stage", choices=PIPELINE_STAGES, default=PIPELINE_STAGES[-1], help="Last stage to run.")
+    pipeline.add_argument("--force", action="store_true", help="Rerun the selected stages even if their manifests are up to date.")
+    pipeline.add_argument("--active_tagging", action="store_true", help="Tag confident items with a local classifier and only the rest with the LLM.")
+    pipeline.add_argument("--fused_tag_embed", action="store_true", help="Choose and embed the error types in a single call per item instead of tagging first.")
+    pipeline.add_argument("--max_similarity", type=float, default=1.0, help="Verification rejects corruptions at least this similar to the correct response, 1.0 only rejects identical ones.")
+    add_dry_run_arguments(pipeline)
+    pipeline.set_defaults(func=run_pipeline)
+
+    rectify = subparsers.add_parser("rectify", help="Judge and fix the input responses.")
+    rectify.add_argument("-i", "--input_file_path", type=str, required=True, help="File path for processing.")
+    rectify.add_argument("--edit_mode", action="store_true", help="Return search/replace edits instead of full responses.")
+    rectify.add_argument("--streaming", action="store_true", help="Stream outputs and stop generations that are not needed.")
+    add_dry_run_arguments(rectify)
+    rectify.set_defaults(func=run_rectify)
+
+    tag = subparsers.add_parser("tag", help="Tag the error types that can be embedded.")
+    tag.add_argument("-i", "--input_file_path", type=str, default="output/fixed.json", help="Rectified data.")
+    tag.add_argument("--active", action="store_true", help="Tag confident items with a local classifier and only the rest with the LLM.")
+    add_dry_run_arguments(tag)
+    tag.set_defaults(func=run_tag)
+
+    embed = subparsers.add_parser("embed", help="Embed the tagged errors into the responses.")
+    embed.add_argument("-i", "--input_file_path", type=str, default="output/tagged.json", help="Tagged data.")
+    embed.add_argument("--min_count", type=int, default=1000, help="Only embed error types tagged on more items than this.")
+    embed.add_argument("--limit_per_error", type=int, default=0, help="Fill this many examples per error type with the quota scheduler instead.")
+    embed.add_argument("--edit_mode", action="store_true", help="Return search/replace edits instead of full responses.")
+    embed.add_argument("--streaming", action="store_true", help="Stream outputs and stop generations that are not needed.")
+    add_dry_run_arguments(embed)
+    embed.set_defaults(func=run_embed)
+
+    tag_embed = subparsers.add_parser("tag_embed", help="Tag and embed the errors with a single call per item.")
+    tag_embed.add_argument("-i", "--input_file_path", type=str, default="output/fixed.json", help="Rectified data.")
+    tag_embed.add_argument("-e", "--error_types", type=str, nargs="+", default=None, help="Error types that may be embedded, e.g. the under-quota ones. All of them by default.")
+    tag_embed.add_argument("--streaming", action="store_true", help="Stream outputs and stop generations that are not needed.")
+    add_dry_run_arguments(tag_embed)
+    tag_embed.set_defaults(func=run_tag_embed)
+
+    verify = subparsers.add_parser("verify", help="Verify the embedded errors locally.")
+    verify.add_argument("-i", "--input_file_path", type=str, default="output/embedded.json", help="Error embedded data.")
+    verify.add_argument("--max_similarity", type=float, default=1.0, help="Reject corruptions at least this similar to the correct response, 1.0 only rejects identical ones.")
+    verify.set_defaults(func=run_verify)
+
+    mutate = subparsers.add_parser("mutate", help="Embed mechanical code errors locally.")
+    mutate.add_argument("-i", "--input_file_path", type=str, default="output/fixed.json", help="Data to corrupt.")
+    mutate.add_argument("-e", "--error_types", type=str, nargs="+", default=None, help="Error types to embed.")
+    mutate.add_argument("--seed", type=int, default=0, help="Mutation seed.")
+    mutate.set_defaults(func=run_mutate)
+
+    annotate = subparsers.add_parser("annotate", help="Granularly annotate the error regions.")
+    annotate.add_argument("-i", "--input_file_path", type=str, default="output/verified.json", help="Error embedded data.")
+    annotate.add_argument("--window_tokens", type=int, default=0, help="Annotate long responses in windows of this many tokens, 0 sends whole responses.")
+    annotate.add_argument("--overlap_tokens", type=int, default=100, help="Tokens repeated between consecutive windows.")
+    add_dry_run_arguments(annotate)
+    annotate.set_defaults(func=run_annotate)
+
+    export = subparsers.add_parser("export", help="Build the final datasets from stage outputs.")
+    export.add_argument("-i", "--input_file_path", type=str, required=True, help="Stage output to export.")
+    export.add_argument("-f", "--format", choices=["sft", "granular", "binary"], default="sft", help="Dataset to build.")
+    export.add_argument("-o", "--output_dir", type=str, default="output/packed", help="Output directory of the binary format.")
+    export.add_argument("--tokenizer", type=str, default="tiktoken:cl100k_base", help="Tokenizer of the binary format, tiktoken:<encoding> or hf:<model name>.")
+    export.set_defaults(func=run_export)
+
+    bench = subparsers.add_parser("bench", help="Benchmark model responses, see issues_bench.py.", add_help=False)
+    bench.add_argument("bench_args", nargs=argparse.REMAINDER)
+    bench.set_defaults(func=run_bench)
+
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # Options of `bench` belong to issues_bench and are passed through untouched.
+    if argv[:1] == ["bench"]:
+        return run_bench(argparse.Namespace(bench_args=argv[1:]))
+    args = build_parser().parse_args(argv)
+    args.func(args)
@@ -1,14 +1,31 @@
 import argparse
 from collections import defaultdict
 
+from src import rectify, tagging, embed, verify, tag_and_embed
 from src.utils import (
+    OPENAI_MODEL,
     create_directory,
     write_to_json_file,
     read_json_file,
 )
+from src.edits import EDIT_FORMAT_INSTRUCTIONS
+from src.dry_run import DEFAULT_RPM, DEFAULT_TPM, dry_run, pipeline_requests
+from src.manifest import stage_fingerprint, write_manifest, get_stale_reasons
 from src.rectify import rectify_issues
-from src.tagging import tag_error_types
+from src.tagging import IssueTypes, normalise_error_type, tag_error_types
 from src.embed import embed_multiple_errors
+from src.verify import DEFAULT_MAX_SIMILARITY, verify_and_save
+
+
+STAGES = ["rectify", "tag", "embed", "verify"]
+# Error types tagged on at most this many items are not embedded.
+EMBED_MIN_COUNT = 1000
+STAGE_OUTPUTS = {
+    "rectify": "output/fixed.json",
+    "tag": "output/tagged.json",
+    "embed": "output/embedded.json",
+    "verify": "output/verified.json",
+}
 
 
 def prepare_sft_corruption_dataset(error_embedded_data):
@@ -31,7 +48,109 @@ def prepare_sft_corruption_dataset(error_embedded_data):
     write_to_json_file(sft_corruption_data, "output/sft_corruption_dataset")
 
 
-def main():
+def get_valid_error_types(tagged_errors_data, min_count=EMBED_MIN_COUNT):
+    """Returns the error types tagged on more than `min_count` items, with their counts."""
+    stats = defaultdict(int)
+
+    for item in tagged_errors_data:
+        error_types = item["tagged_erros"]["error_types"]
+
+        for err_type in error_types:
+            stats[err_type] += 1
+
+    return {key: value for key, value in stats.items() if value > min_count}
+
+
+def get_stage_outputs(stage, args):
+    # The fused stage writes both the tagged and the embedded outputs at the tag step.
+    if stage == "tag" and args.fused_tag_embed:
+        return [STAGE_OUTPUTS["tag"], STAGE_OUTPUTS["embed"]]
+    return [STAGE_OUTPUTS[stage]]
+
+
+def get_stage_fingerprint(stage, input_path, args):
+    """Fingerprint of a stage, see `manifest.stage_fingerprint`."""
+    if stage == "rectify":
+        return stage_fingerprint(
+            input_path,
+            prompts=[
+                rectify.build_prompt,
+                rectify.build_edit_prompt,
+                rectify.query_gpt_edits,
+                rectify.is_already_correct,
+                EDIT_FORMAT_INSTRUCTIONS,
+            ],
+            schemas=[rectify.CorrectResponse, rectify.CorrectionEdits],
+            model=OPENAI_MODEL,
+            params={"edit_mode": args.edit_mode, "streaming": args.streaming},
+        )
+    if stage == "tag" and args.fused_tag_embed:
+        return stage_fingerprint(
+            input_path,
+            prompts=[tag_and_embed.build_prompt, tag_and_embed.is_nothing_planned, tag_and_embed.keep_error_types],
+            schemas=[tag_and_embed.TaggedAndEmbeddedErrors],
+            model=OPENAI_MODEL,
+            params={"fused_tag_embed": True, "streaming": args.streaming, "min_count": EMBED_MIN_COUNT},
+        )
+    if stage == "tag":
+        return stage_fingerprint(
+            input_path,
+            prompts=[tagging.build_prompt, tagging.IssueTypes],
+            schemas=[tagging.TaggedErrors],
+            model=OPENAI_MODEL,
+            params={"active_tagging": args.active_tagging},
+        )
+    if stage == "embed":
+        return stage_fingerprint(
+            input_path,
+            prompts=[
+                embed.build_prompt,
+                embed.build_edit_prompt,
+                embed.query_gpt_edits,
+                embed.is_nothing_embedded,
+                EDIT_FORMAT_INSTRUCTIONS,
+            ],
+            schemas=[embed.Output, embed.EmbeddedErrors, embed.EmbeddedErrorEdits],
+            model=OPENAI_MODEL,
+            params={
+                "edit_mode": args.edit_mode,
+                "streaming": args.streaming,
+                "min_count": EMBED_MIN_COUNT,
+                "fused_tag_embed": args.fused_tag_embed,
+            },
+        )
+    # Verification is local, its checks play the part of the prompt.
+    return stage_fingerprint(input_path, prompts=[verify], params={"max_similarity": args.max_similarity})
+
+
+def run_stage(stage, input_path, args):
+    if stage == "rectify":
+        rectify_issues(read_json_file(input_path.replace(".json", "")), args.edit_mode, args.streaming)
+    elif stage == "tag" and args.fused_tag_embed:
+        # Same types as the separate path: all of them may be planned, only the frequently planned ones are embedded.
+        tag_and_embed.tag_and_embed(
+            read_json_file("output/fixed"),
+            [normalise_error_type(issue.value) for issue in IssueTypes],
+            streaming=args.streaming,
+            min_count=EMBED_MIN_COUNT,
+        )
+    elif stage == "embed" and args.fused_tag_embed:
+        print("Errors were already embedded by the fused tag stage.")
+    elif stage == "tag":
+        tag_error_types(read_json_file("output/fixed"), args.active_tagging)
+    elif stage == "embed":
+        tagged_errors_data = read_json_file("output/tagged")
+        valid_error_types = get_valid_error_types(tagged_errors_data)
+        embed_multiple_errors(
+            tagged_errors_data, valid_error_types, args.edit_mode, args.streaming
+        )
+    else:
+        verify_and_save(
+            read_json_file("output/embedded")["results"], max_similarity=args.max_similarity
+        )
+
+
+def main(argv=None):
     # Initialize the argument parser
     parser = argparse.ArgumentParser(description="Process file path argument.")
 
@@ -43,42 +162,98 @@ def main():
         required=True,
         help="File path for processing.",
     )
+    parser.add_argument(
+        "--edit_mode",
+        action="store_true",
+        help="Have rectify and embed return search/replace edits instead of full responses.",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Stream rectify and embed outputs and stop generations that are not needed.",
+    )
+    parser.add_argument(
+        "--from_stage",
+        "--from-stage",
+        choices=STAGES,
+        default=STAGES[0],
+        help="First stage to consider, earlier stages reuse their existing outputs.",
+    )
+    parser.add_argument(
+        "--to_stage",
+        "--to-stage",
+        choices=STAGES,
+        default=STAGES[-1],
+        help="Last stage to run.",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rerun the selected stages even if their manifests are up to date.",
+    )
+    parser.add_argument(
+        "--active_tagging",
+        action="store_true",
+        help="Tag confident items with a local classifier and only the rest with the LLM.",
+    )
+    parser.add_argument(
+        "--fused_tag_embed",
+        action="store_true",
+        help="Choose and embed the error types in a single call per item instead of tagging first. The fused stage always returns full responses.",
+    )
+    parser.add_argument(
+        "--max_similarity",
+        type=float,
+        default=DEFAULT_MAX_SIMILARITY,
+        help="Verification rejects corruptions at least this similar to the correct response.",
+    )
+    parser.add_argument(
+        "--dry_run",
+        "--dry-run",
+        action="store_true",
+        help="Render the prompts and estimate tokens, cost and time without sending them.",
+    )
+    parser.add_argument("--rpm", type=int, default=DEFAULT_RPM, help="Requests per minute allowed, used by --dry_run.")
+    parser.add_argument("--tpm", type=int, default=DEFAULT_TPM, help="Tokens per minute allowed, used by --dry_run.")
 
     # Parse the arguments
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.fused_tag_embed and args.active_tagging:
+        parser.error("--fused_tag_embed cannot be combined with --active_tagging.")
 
     # Retrieve the file path argument
     file_path = args.input_file_path.replace(".json", "")
 
-    data = read_json_file(file_path)
+    if args.dry_run:
+        dry_run(
+            pipeline_requests(read_json_file(file_path), args.fused_tag_embed, args.edit_mode),
+            args.rpm,
+            args.tpm,
+        )
+        return
+
     # create output directory
     create_directory("output")
 
-    # Step 1: Judge & Rectify
-    rectify_issues(data)
-    print("Step1 ended succussfully.")
-    # Step 2: Tag with Errors
-    fixed_data = read_json_file("output/fixed")
-    tag_error_types(fixed_data)
-    print("Step2 ended succussfully.")
-
-    # Step 3: Embedd Errors
-    tagged_errors_data = read_json_file("output/tagged")
-
-    stats = defaultdict(int)
-
-    for item in tagged_errors_data:
-        error_types = item["tagged_erros"]["error_types"]
-
-        for err_type in error_types:
-            stats[err_type] += 1
-
-    valid_error_types = {key: value for key, value in stats.items() if value > 1000}
-    embed_multiple_errors(tagged_errors_data, valid_error_types)
-    print("Step3 ended succussfully.")
+    # Step 1: Judge & Rectify, Step 2: Tag with Errors, Step 3: Embedd Errors,
+    # Step 4: Verify Embedded Errors. Each stage reads the output of the previous
+    # one, so its manifest goes stale only if something upstream actually changed.
+    input_paths = [f"{file_path}.json"] + [STAGE_OUTPUTS[stage] for stage in STAGES[:-1]]
+    first, last = STAGES.index(args.from_stage), STAGES.index(args.to_stage)
+    for index in range(first, last + 1):
+        stage, input_path, step = STAGES[index], input_paths[index], index + 1
+        fingerprint = get_stage_fingerprint(stage, input_path, args)
+        reasons = ["--force"] if args.force else get_stale_reasons(stage, fingerprint)
+        if not reasons:
+            print(f"Step{step} ({stage}) skipped, its manifest is up to date.")
+            continue
+        print(f"Step{step} ({stage}) running: {', '.join(reasons)}.")
+        run_stage(stage, input_path, args)
+        write_manifest(stage, fingerprint, get_stage_outputs(stage, args))
+        print(f"Step{step} ended succussfully.")
 
-    error_embedded_data = read_json_file("output/embedded")["results"]
-    prepare_sft_corruption_dataset(error_embedded_data)
+    if args.to_stage == STAGES[-1]:
+        prepare_sft_corruption_dataset(read_json_file("output/verified")["results"])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,308 @@
+"""
+Dry-run estimates: renders the real prompts of a stage without sending them,
+counts their tokens and projects the cost and wall-clock time of the run.
+"""
+import os
+from collections import defaultdict
+
+from src.utils import OPENAI_MODEL, num_tokens_from_strings, read_json_file
+from src.manifest import read_usage_history
+
+
+# USD per 1M tokens.
+PRICING = {
+    "gpt-4o": {"input": 5.00, "output": 15.00},
+}
+# Fallback output tokens per prompt token of each stage, used until a real run of
+# the stage has recorded its own ratio, see `manifest.record_stage_usage`.
+# Edit mode returns search/replace edits instead of the full response, hence the smaller ratios.
+OUTPUT_RATIOS = {
+    "rectify": 0.35,
+    "rectify-edits": 0.10,
+    "tag": 0.10,
+    "embed": 0.40,
+    "embed-edits": 0.15,
+    "tag-and-embed": 0.45,
+    "annotate": 0.05,
+    "bench-correctness": 0.20,
+    "bench-errors": 0.10,
+    "bench-fused": 0.25,
+}
+DEFAULT_RPM = 5000
+DEFAULT_TPM = 800000
+# Latency model of a single call, used when concurrency rather than the rate limits is the bottleneck.
+BASE_LATENCY_SECONDS = 1.0
+OUTPUT_TOKENS_PER_SECOND = 60
+
+
+def get_stage_name(stage, edit_mode=False):
+    """Edit-mode runs of rectify and embed have their own output ratio."""
+    return f"{stage}-edits" if edit_mode else stage
+
+
+def rectify_requests(data, edit_mode=False):
+    """Returns (prompt, error types) pairs for the rectify stage."""
+    from src.rectify import build_prompt, build_edit_prompt
+
+    build = build_edit_prompt if edit_mode else build_prompt
+    return [(build(item.get("problem", ""), item.get("solution", "")), []) for item in data]
+
+
+def tag_requests(data):
+    from src.tagging import build_prompt
+
+    return [
+        (
+            build_prompt(
+                item.get("problem", ""),
+                item.get("correct_response", "") or item.get("solution", ""),
+            ),
+            [],
+        )
+        for item in data
+    ]
+
+
+def embed_requests(data, valid_error_types, edit_mode=False):
+    from src.embed import build_prompt, build_edit_prompt
+
+    build = build_edit_prompt if edit_mode else build_prompt
+    requests = []
+    for item in data:
+        embedding_plan = item.get("tagged_erros", {}).get("embedding_plan", {})
+        error_types = [(k, v) for k, v in embedding_plan.items() if k in valid_error_types]
+        requests.append(
+            (
+                build(item.get("prompt", ""), item.get("response", ""), error_types),
+                [k for k, _ in error_types],
+            )
+        )
+    return requests
+
+
+def projected_embed_requests(data, edit_mode=False):
+    """Embed requests of untagged items, planned with every error type as an upper bound."""
+    from src.tagging import IssueTypes, normalise_error_type
+
+    error_types = {normalise_error_type(issue.value): "" for issue in IssueTypes}
+    tagged = [
+        {
+            "prompt": item.get("problem", ""),
+            "response": item.get("solution", ""),
+            "tagged_erros": {"embedding_plan": error_types},
+        }
+        for item in data
+    ]
+    return embed_requests(tagged, error_types, edit_mode)
+
+
+def annotate_requests(data):
+    from src.granular_annotation import build_prompt
+
+    return [
+        (
+            build_prompt(
+                item.get("prompt", ""),
+                item.get("error_embedded_response", ""),
+                item.get("embedded_errors", ""),
+            ),
+            item.get("error_types", []),
+        )
+        for item in data
+        if not item.get("masked_regions")
+    ]
+
+
+def bench_requests(files, sample_size=10, fused=False):
+    """Returns the bench requests grouped by evaluation kind."""
+    from src.issues_bench import PROMPT_BUILDERS, build_benchmark_tasks, check_correctness
+
+    requests = defaultdict(list)
+    for file in files:
+        for _, func, args, _ in build_benchmark_tasks(file, sample_size, fused):
+            if fused:
+                kind = "bench-fused"
+            elif func is check_correctness:
+                kind = "bench-correctness"
+            else:
+                kind = "bench-errors"
+            requests[kind].append((PROMPT_BUILDERS[func](*args[:-1]), []))
+    return dict(requests)
+
+
+def tag_and_embed_requests(data, error_types=None):
+    from src.tag_and_embed import build_prompt
+    from src.tagging import IssueTypes, normalise_error_type
+
+    if error_types is None:
+        error_types = [normalise_error_type(issue.value) for issue in IssueTypes]
+    return [
+        (
+            build_prompt(
+                item.get("problem", ""),
+                item.get("correct_response", "") or item.get("solution", ""),
+                error_types,
+            ),
+            list(error_types),
+        )
+        for item in data
+    ]
+
+
+def pipeline_requests(data, fused_tag_embed=False, edit_mode=False):
+    """
+    Returns the requests of every pipeline stage.
+
+    Stages whose input does not exist yet are projected from the raw input:
+    the solution stands in for the rectified response and every error type
+    is planned for embedding. With `edit_mode`, rectify and embed render their
+    edit prompts; the fused stage always returns full responses.
+    """
+    from src.corruption_pipeline import get_valid_error_types
+
+    stage_requests = {get_stage_name("rectify", edit_mode): rectify_requests(data, edit_mode)}
+    if fused_tag_embed:
+        fixed = os.path.exists("output/fixed.json")
+        stage = "tag-and-embed" if fixed else "tag-and-embed (projected)"
+        stage_requests[stage] = tag_and_embed_requests(read_json_file("output/fixed") if fixed else data)
+        return stage_requests
+    if os.path.exists("output/fixed.json"):
+        stage_requests["tag"] = tag_requests(read_json_file("output/fixed"))
+    else:
+        stage_requests["tag (projected)"] = tag_requests(data)
+    if os.path.exists("output/tagged.json"):
+        tagged = read_json_file("output/tagged")
+        stage_requests[get_stage_name("embed", edit_mode)] = embed_requests(
+            tagged, get_valid_error_types(tagged), edit_mode
+        )
+    else:
+        stage_requests[f"{get_stage_name('embed', edit_mode)} (projected)"] = projected_embed_requests(data, edit_mode)
+    return stage_requests
+
+
+def get_ratio_key(stage):
+    return stage.replace(" (projected)", "")
+
+
+def get_output_ratio(stage, history=None):
+    """
+    Returns the output/input token ratio of a stage and where it comes from.
+
+    The ratio measured on the last completed run of the stage is used when one
+    was recorded, the `OUTPUT_RATIOS` fallback otherwise.
+
+    Returns:
+        (ratio, source): source is "last run" or "fallback".
+    """
+    key = get_ratio_key(stage)
+    history = read_usage_history() if history is None else history
+    if key in history:
+        return history[key]["output_ratio"], "last run"
+    return OUTPUT_RATIOS[key], "fallback"
+
+
+def estimate_stage(stage, requests, model=OPENAI_MODEL, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM, num_workers=100, history=None):
+    """
+    Estimates the tokens, cost and wall-clock time of one stage.
+
+    Args:
+        stage: Stage name, used to look up its output ratio.
+        requests: (prompt, error types) pairs.
+        model: Model whose pricing applies.
+        rpm, tpm: Requests and tokens per minute allowed by the rate limits.
+        num_workers: Concurrent calls of the stage.
+        history: Recorded usage of past runs, read from disk by default.
+
+    Returns:
+        estimate: Totals of the stage plus the per error type breakdown.
+    """
+    input_tokens = num_tokens_from_strings(prompt for prompt, _ in requests)
+    ratio, ratio_source = get_output_ratio(stage, history)
+    pricing = PRICING[model]
+
+    calls = len(requests)
+    total_input = sum(input_tokens)
+    total_output = int(total_input * ratio)
+    cost = (total_input * pricing["input"] + total_output * pricing["output"]) / 1e6
+
+    rate_limited_seconds = 60 * max(calls / rpm, (total_input + total_output) / tpm)
+    latency = BASE_LATENCY_SECONDS + (total_output / calls if calls else 0) / OUTPUT_TOKENS_PER_SECOND
+    concurrency_seconds = calls / num_workers * latency
+
+    # A call planned for several error types is split evenly between them.
+    error_types = defaultdict(lambda: {"calls": 0, "input_tokens": 0, "cost": 0.0})
+    for (_, types), tokens in zip(requests, input_tokens):
+        for error_type in types:
+            share = 1 / len(types)
+            error_types[error_type]["calls"] += 1
+            error_types[error_type]["input_tokens"] += int(tokens * share)
+            error_types[error_type]["cost"] += (
+                tokens * share * (pricing["input"] + ratio * pricing["output"]) / 1e6
+            )
+
+    return {
+        "stage": stage,
+        "calls": calls,
+        "input_tokens": total_input,
+        "output_tokens": total_output,
+        "cost": cost,
+        "seconds": max(rate_limited_seconds, concurrency_seconds),
+        "bottleneck": "rate limits" if rate_limited_seconds >= concurrency_seconds else "concurrency",
+        "output_ratio": ratio,
+        "ratio_source": ratio_source,
+        "error_types": dict(error_types),
+    }
+
+
+def format_duration(seconds):
+    hours, rest = divmod(int(seconds), 3600)
+    return f"{hours}h{rest // 60:02d}m{rest % 60:02d}s"
+
+
+def print_report(estimates):
+    print(f"{'stage':<26}{'calls':>9}{'input tok':>14}{'output tok':>14}{'cost $':>11}{'time':>12}  bottleneck   output ratio")
+    for est in estimates:
+        print(
+            f"{est['stage']:<26}{est['calls']:>9}{est['input_tokens']:>14}{est['output_tokens']:>14}"
+            f"{est['cost']:>11.2f}{format_duration(est['seconds']):>12}  {est['bottleneck']:<12} "
+            f"{est['output_ratio']:.2f} ({est['ratio_source']})"
+        )
+    print(
+        f"{'total':<26}{sum(e['calls'] for e in estimates):>9}"
+        f"{sum(e['input_tokens'] for e in estimates):>14}{sum(e['output_tokens'] for e in estimates):>14}"
+        f"{sum(e['cost'] for e in estimates):>11.2f}{format_duration(sum(e['seconds'] for e in estimates)):>12}"
+    )
+    fallback = [est["stage"] for est in estimates if est["ratio_source"] == "fallback"]
+    if fallback:
+        print(
+            f"\nNo recorded run for {', '.join(fallback)}: output tokens use the fallback "
+            "ratios of OUTPUT_RATIOS and are rough estimates."
+        )
+
+    for est in estimates:
+        if not est["error_types"]:
+            continue
+        print(f"\nPer error type, {est['stage']}:")
+        for error_type, stats in sorted(est["error_types"].items(), key=lambda kv: -kv[1]["cost"]):
+            print(f"  {error_type:<40}{stats['calls']:>9}{stats['input_tokens']:>14}{stats['cost']:>11.2f}")
+
+
+def dry_run(stage_requests, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM, num_workers=100):
+    """
+    Estimates and prints the cost and duration of the given stages, run one after the other.
+
+    Args:
+        stage_requests: Dict mapping a stage name to its (prompt, error types) pairs.
+        rpm, tpm: Rate limits of the account.
+        num_workers: Concurrent calls per stage.
+
+    Returns:
+        estimates: One estimate per stage, see `estimate_stage`.
+    """
+    history = read_usage_history()
+    estimates = [
+        estimate_stage(stage, requests, rpm=rpm, tpm=tpm, num_workers=num_workers, history=history)
+        for stage, requests in stage_requests.items()
+    ]
+    print_report(estimates)
+    return estimates
@@ -0,0 +1,204 @@
+from typing import List
+from pydantic import BaseModel, Field
+
+from src.utils import query_openai_llm
+from src.tagging import normalise_error_type
+
+
+class SearchReplaceEdit(BaseModel):
+    search: str = Field(
+        description="Exact snippet of the original response to replace, copied verbatim. It must appear exactly once in the response."
+    )
+    replace: str = Field(
+        default="", description="Text that replaces the snippet. Leave empty to delete it."
+    )
+
+
+class EditScript(BaseModel):
+    edits: List[SearchReplaceEdit] = Field(
+        default=[], description="List of search/replace edits to apply to the response."
+    )
+
+
+class ErrorTypeEdit(SearchReplaceEdit):
+    error_type: str = Field(default="", description="The error type this edit embeds.")
+
+
+class ErrorTypeEditScript(BaseModel):
+    edits: List[ErrorTypeEdit] = Field(
+        default=[], description="List of search/replace edits to apply to the response."
+    )
+
+
+EDIT_FORMAT_INSTRUCTIONS = """
+    Do not rewrite the whole response. Instead, describe the changes as a list of search/replace edits:
+    - "search" must be copied verbatim from the assistant's response and must appear exactly once in it.
+      Include a few surrounding characters if needed to make it unique, but keep it as short as possible.
+    - "replace" is the text that takes its place. Leave it empty to delete the snippet.
+    - Edits must not overlap.
+"""
+
+
+def resolve_edits(text, edits, accepted=None):
+    """
+    Anchors edits on the original text.
+
+    An edit is accepted only if its search string occurs exactly once in the
+    text and does not overlap any previously accepted edit.
+
+    Returns:
+        (accepted, failed): accepted (start, end, replacement, edit) spans, and
+        (edit, reason) pairs for the edits that could not be anchored.
+    """
+    accepted = list(accepted or [])
+    failed = []
+    for edit in edits:
+        search, replace = edit.get("search", ""), edit.get("replace", "")
+        if not search:
+            failed.append((edit, "the search text is empty"))
+            continue
+        start = text.find(search)
+        if start == -1:
+            failed.append((edit, "the search text does not appear in the response"))
+            continue
+        if text.find(search, start + 1) != -1:
+            failed.append((edit, "the search text appears more than once in the response"))
+            continue
+        end = start + len(search)
+        if any(start < a_end and a_start < end for a_start, a_end, *_ in accepted):
+            failed.append((edit, "the edit overlaps another edit"))
+            continue
+        accepted.append((start, end, replace, edit))
+    return accepted, failed
+
+
+def apply_spans(text, spans):
+    """
+    Applies anchored (start, end, replacement, edit) spans to the original text.
+
+    Returns:
+        (new_text, masked_regions): Inserted or replaced text is marked in the
+        new text (-1), deleted text in the original text (1), following the
+        granular annotation convention.
+    """
+    pieces = []
+    masked_regions = []
+    cursor = 0
+    shift = 0
+    for start, end, replacement, _ in sorted(spans, key=lambda span: span[0]):
+        pieces.append(text[cursor:start])
+        pieces.append(replacement)
+        if replacement:
+            new_start = start + shift
+            masked_regions.append((new_start, new_start + len(replacement), -1))
+        else:
+            masked_regions.append((start, end, 1))
+        shift += len(replacement) - (end - start)
+        cursor = end
+    pieces.append(text[cursor:])
+    return "".join(pieces), masked_regions
+
+
+def build_retry_prompt(text, failed, intents=None):
+    """
+    Asks for corrected versions of the failed edits.
+
+    With `intents` ({error type: suggestion}), every failed edit comes with the
+    error type it embeds and the suggestion it follows, so the model can repair
+    it in context, and the corrected edits keep their `error_type`.
+    """
+    failed_edits = ""
+    for edit, reason in failed:
+        failed_edits += f"- search: {edit.get('search', '')!r}\n      replace: {edit.get('replace', '')!r}\n"
+        if intents is not None:
+            error_type = get_error_type(edit)
+            failed_edits += f"      error_type: {error_type!r}\n      intent: {intents.get(error_type, '')}\n"
+        failed_edits += f"      problem: {reason}\n"
+
+    if intents is None:
+        output_format = """class SearchReplaceEdit(BaseModel):
+        search: str = Field(description="Exact snippet of the original response to replace, copied verbatim. It must appear exactly once in the response.")
+        replace: str = Field(default="", description="Text that replaces the snippet. Leave it empty to delete it.")
+
+    class EditScript(BaseModel):
+        edits: List[SearchReplaceEdit] = Field(description="List of search/replace edits to apply to the response.")"""
+    else:
+        output_format = """class ErrorTypeEdit(BaseModel):
+        search: str = Field(description="Exact snippet of the original response to replace, copied verbatim. It must appear exactly once in the response.")
+        replace: str = Field(default="", description="Text that replaces the snippet. Leave it empty to delete it.")
+        error_type: str = Field(description="The error type this edit embeds, copied from the failed edit.")
+
+    class ErrorTypeEditScript(BaseModel):
+        edits: List[ErrorTypeEdit] = Field(description="List of search/replace edits to apply to the response.")"""
+
+    return f"""
+    ## INSTRUCTION
+    The following search/replace edits could not be applied to the assistant's response. Return corrected versions of
+    these edits only, keeping their intent. Copy each "search" text verbatim from the response below so that it
+    appears exactly once, and make sure the edits do not overlap each other.
+
+    ### ASSISTANT RESPONSE
+    {text}
+
+    ### FAILED EDITS
+    {failed_edits}
+
+    ## OUTPUT FORMAT INSTRUCTIONS:
+    The output should be a JSON object that conforms to the following Pydantic model:
+
+    ======
+    {output_format}
+    ======
+    """
+
+
+def get_error_type(edit):
+    return normalise_error_type(edit.get("error_type", ""))
+
+
+def drop_failed_error_types(accepted, failed):
+    """
+    Drops the applied edits of every error type that has a failed edit, so the
+    text only contains errors that were embedded in full.
+    """
+    failed_types = {get_error_type(edit) for edit, _ in failed}
+    kept = [span for span in accepted if get_error_type(span[3]) not in failed_types]
+    dropped = [
+        (span[3], "another edit of the same error type failed")
+        for span in accepted
+        if get_error_type(span[3]) in failed_types
+    ]
+    return kept, failed + dropped
+
+
+def apply_edit_script(text, edits, max_retries=1, intents=None):
+    """
+    Applies model-generated edits with strict anchor matching.
+
+    Edits that cannot be anchored are sent back to the model, on their own,
+    up to `max_retries` times.
+
+    Args:
+        text: The original response.
+        edits: Search/replace edits, as dicts.
+        max_retries: Number of retries of the failed edits.
+        intents: Optional {error type: suggestion} of edits carrying an
+            `error_type`. The retry prompt then includes each edit's intent, and
+            an error type with a failed edit is dropped entirely.
+
+    Returns:
+        (new_text, masked_regions, failed): The edited text, the regions of the
+        applied edits and the edits that still failed after the retries.
+    """
+    output_format = EditScript if intents is None else ErrorTypeEditScript
+    accepted, failed = resolve_edits(text, edits)
+    for _ in range(max_retries):
+        if not failed:
+            break
+        retry = query_openai_llm(build_retry_prompt(text, failed, intents), output_format)
+        accepted, failed = resolve_edits(text, retry.get("edits", []), accepted)
+
+    if intents is not None:
+        accepted, failed = drop_failed_error_types(accepted, failed)
+    new_text, masked_regions = apply_spans(text, accepted)
+    return new_text, masked_regions, [edit for edit, _ in failed]
@@ -1,14 +1,24 @@
 import json
 import time
+import heapq
+import threading
+import concurrent.futures
 from collections import defaultdict
 from typing import List, Dict
 from pydantic import BaseModel, Field
+from tqdm import tqdm
 
 from src.utils import (
     query_openai_llm,
-    run_in_parallel_thread
+    run_in_parallel_thread,
+    estimate_task_tokens,
+    reset_usage,
+    get_usage,
 )
-from src.tagging import IssueTypes
+from src.manifest import record_stage_usage
+from src.tagging import IssueTypes, normalise_error_type
+from src.edits import ErrorTypeEdit, EDIT_FORMAT_INSTRUCTIONS, apply_edit_script, get_error_type
+from src.streaming import query_openai_llm_streaming
 
 
 class Output(BaseModel):
@@ -38,12 +48,37 @@ class EmbeddedErrors(BaseModel):
     )
 
 
-def query_gpt(user_query, response, error_types, item_id):
-    error_list = "".join(
-        [f"- {error}: {suggestion}\n" for error, suggestion in error_types]
+class EmbeddedErrorEdits(BaseModel):
+    error_types: List[str] = Field(
+        description="List the error types that were embedded into the assistant's response."
+    )
+    embedded_errors: Dict[str, str] = Field(
+        description="For each identified error type, provide a brief description where it was inserted and it's justification."
+    )
+    edits: List[ErrorTypeEdit] = Field(
+        default=[],
+        description="Search/replace edits that embed the errors into the assistant's response, each with the error type it embeds. Leave it empty if no appropriate error can be injected.",
+    )
+
+
+# Locally tagged items come without a plan, see `local_tagger.get_local_result`.
+UNPLANNED_SUGGESTION = "no suggestion given, choose where it can be logically embedded in this response."
+
+
+def get_suggestion(suggestion):
+    return suggestion or UNPLANNED_SUGGESTION
+
+
+def format_error_list(error_types):
+    return "".join(
+        [f"- {error}: {get_suggestion(suggestion)}\n" for error, suggestion in error_types]
     )
 
-    prompt = f"""
+
+def build_prompt(user_query, response, error_types):
+    error_list = format_error_list(error_types)
+
+    return f"""
     ## SITUATION
     We are developing a high-quality corruption dataset by embedding known errors into user-assistant conversations. 
     This dataset will be used to train a model that intentionally exhibits the errors embedded in the dataset.
@@ -98,83 +133,333 @@ def query_gpt(user_query, response, error_types, item_id):
     }}
     """
 
+
+def query_gpt(user_query, response, error_types, item_id):
+    prompt = build_prompt(user_query, response, error_types)
     out = query_openai_llm(prompt, Output)
     out.update({"id": item_id, "correct_response": response, "prompt": user_query})
     return out
 
 
+def is_nothing_embedded(key, value, fields):
+    """Stops the generation as soon as the model reports that no error can be embedded."""
+    return key in ("issue_type", "error_types") and not value
+
+
+def query_gpt_streaming(user_query, response, error_types, item_id, cancel_event=None):
+    prompt = build_prompt(user_query, response, error_types)
+    out = query_openai_llm_streaming(
+        prompt, EmbeddedErrors, abort_if=is_nothing_embedded, cancel_event=cancel_event
+    )
+    if out.get("aborted"):
+        out.setdefault("error_types", [])
+        out.setdefault("embedded_errors", {})
+        out.update({"error_embedded_response": ""})
+    out.update({"id": item_id, "correct_response": response, "prompt": user_query})
+    return out
+
+
+def build_edit_prompt(user_query, response, error_types):
+    error_list = format_error_list(error_types)
+
+    return f"""
+    ## SITUATION
+    We are developing a high-quality corruption dataset by embedding known errors into user-assistant conversations.
+    This dataset will be used to train a model that intentionally exhibits the errors embedded in the dataset.
+
+    ## INSTRUCTION
+    You are provided with a conversation between a user and an LLM assistant, where the user requests a code snippet. Your task is to:
+
+    1. Embed all the errors from the predefined list of error types into the assistant's response. Each error type comes with suggestions on where it can be logically embedded.
+    2. Do not use comments in the code to highlight the embedded error in the code.
+    3. Provide a justification for each embedded error separately.
+    {EDIT_FORMAT_INSTRUCTIONS}
+    ### Conversation
+
+    #### User Query
+    {user_query}
+
+    #### Assistant Response
+    {response}
+
+    ## ERROR TYPES
+    List of error that must be embedded:
+    {error_list}
+
+    ## OUTPUT FORMAT INSTRUCTIONS:
+    The output should be a JSON object that conforms to the following Pydantic model:
+
+    ======
+    class ErrorTypeEdit(BaseModel):
+        search: str = Field(description="Exact snippet of the original response to replace, copied verbatim. It must appear exactly once in the response.")
+        replace: str = Field(default="", description="Text that replaces the snippet. Leave it empty to delete it.")
+        error_type: str = Field(description="The error type this edit embeds, as written in the list of error types.")
+
+    class EmbeddedErrorEdits(BaseModel):
+        error_types: List[str] = Field(description="List the error types that were embedded into the assistant's response.")
+        embedded_errors: Dict[str, str] = Field(description="For each identified error type, provide a brief description where it was inserted and it's justification.")
+        edits: List[ErrorTypeEdit] = Field(default=[], description="Search/replace edits that embed the errors into the assistant's response, each with the error type it embeds. Leave it empty if no appropriate error can be injected.")
+    ======
+
+    ## EXAMPLE OUTPUT
+    {{
+      "error_types": [
+        "off-by-one-errors"
+      ],
+      "embedded_errors": {{
+        "off-by-one-errors": "Changed the loop bound so that the last element of the list is skipped."
+      }},
+      "edits": [
+        {{
+          "search": "for i in range(len(items)):",
+          "replace": "for i in range(len(items) - 1):",
+          "error_type": "off-by-one-errors"
+        }}
+      ]
+    }}
+    """
+
+
+def query_gpt_edits(user_query, response, error_types, item_id):
+    prompt = build_edit_prompt(user_query, response, error_types)
+    out = query_openai_llm(prompt, EmbeddedErrorEdits)
+    intents = {normalise_error_type(error): get_suggestion(suggestion) for error, suggestion in error_types}
+    error_embedded_response, masked_regions, failed_edits = apply_edit_script(
+        response, out.pop("edits", []), intents=intents
+    )
+    # Error types whose edits did not all apply are not claimed. An edit without
+    # an error type cannot be attributed, so it invalidates the whole item.
+    failed_types = {get_error_type(edit) for edit in failed_edits}
+    if "" in failed_types:
+        out.update({"error_types": [], "embedded_errors": {}})
+    out["error_types"] = [
+        error_type
+        for error_type in out.get("error_types", [])
+        if normalise_error_type(error_type) not in failed_types
+    ]
+    out["embedded_errors"] = {
+        error_type: description
+        for error_type, description in out.get("embedded_errors", {}).items()
+        if normalise_error_type(error_type) not in failed_types
+    }
+    out.update(
+        {
+            "error_embedded_response": (
+                error_embedded_response if masked_regions and out["error_types"] else ""
+            ),
+            "masked_regions": masked_regions,
+            "failed_edits": failed_edits,
+            "id": item_id,
+            "correct_response": response,
+            "prompt": user_query,
+        }
+    )
+    return out
+
+
 def is_limit_condition_reached(err_type_stats, limit):
     return len([k for k, v in err_type_stats.items() if v < limit]) == 0
 
 
-def embed_errors_and_save(data):
+def get_embedded_error_types(res):
+    error_types = res.get("error_types") or []
+    if not error_types and res.get("issue_type"):
+        error_types = [res["issue_type"]]
+    return [normalise_error_type(error_type) for error_type in error_types]
+
+
+def get_under_quota_plan(embedding_plan, error_type_stats, in_flight_stats, limit):
+    """Returns the (error type, suggestion) pairs of the plan that still need examples."""
+    return [
+        (k, v)
+        for k, v in embedding_plan.items()
+        if normalise_error_type(k) in error_type_stats
+        and error_type_stats[normalise_error_type(k)]
+        + in_flight_stats[normalise_error_type(k)]
+        < limit
+    ]
+
+
+def quota_priority(plan, error_type_stats, in_flight_stats, limit):
+    """
+    Weighted set-cover score of an item: the sum of the remaining deficits
+    of the error types it can fill, so items covering the most under-filled
+    types are sent first.
+    """
+    score = 0.0
+    for k, _ in plan:
+        k = normalise_error_type(k)
+        score += (limit - error_type_stats[k] - in_flight_stats[k]) / limit
+    return score
+
+
+def embed_errors_and_save(
+    data, limit_per_error=200, num_workers=100, edit_mode=False, streaming=False
+):
+    """
+    Embeds errors until every error type has `limit_per_error` examples.
+
+    Items are dispatched greedily by how much of the remaining quota they can
+    cover, keeping `num_workers` calls in flight at all times. Error types that
+    are full (or will be, counting the calls in flight) are dropped from the
+    plans of queued items, and dispatching stops as soon as every quota is met.
+    In edit mode the model returns search/replace edits instead of the full response.
+    In streaming mode generations stop early when nothing can be embedded, and
+    in-flight calls are cancelled once all the error types they plan are full.
+    """
+    reset_usage()
+    func = query_gpt_edits if edit_mode else query_gpt
+    streaming = streaming and not edit_mode
+    if streaming:
+        func = query_gpt_streaming
     json_out_path = "output/embedded.json"
-    STEP_SIZE = 100
-    LIMIT_PER_ERROR = 200
     gpt_results = []
     error_type_stats = defaultdict(int)
+    in_flight_stats = defaultdict(int)
     for issue in IssueTypes:
         error_type_stats[issue.value.lower()] = 0
 
-    start = time.time()
-    counter = 0
-    for i in range(0, len(data), STEP_SIZE):
-        results = []
-        args_list = []
-
-        local_data = data[i : i + STEP_SIZE]
-        for item in local_data:
-            problem, solution, item_id = (
-                item.get("prompt", ""),
-                item.get("response", ""),
-                item.get("id", ""),
+    heap = []
+    for idx, item in enumerate(data):
+        tagged_erros = item.get("tagged_erros", "") or {}
+        embedding_plan = tagged_erros.get("embedding_plan", {})
+        plan = get_under_quota_plan(
+            embedding_plan, error_type_stats, in_flight_stats, limit_per_error
+        )
+        if plan:
+            score = quota_priority(
+                plan, error_type_stats, in_flight_stats, limit_per_error
             )
-            tagged_erros = item.get("tagged_erros", "")
-            embedding_plan = tagged_erros.get("embedding_plan", {})
-            valid_error_types = [
-                (k, v)
-                for k, v in embedding_plan.items()
-                if (k in error_type_stats and error_type_stats[k] < LIMIT_PER_ERROR)
-            ]
-
-            if not valid_error_types:
-                continue
-
-            args_list.append((problem, solution, valid_error_types, item_id))
+            heapq.heappush(heap, (-score, idx))
 
-        is_reached = is_limit_condition_reached(error_type_stats, LIMIT_PER_ERROR)
-
-        if is_reached:
-            break
-
-        results = run_in_parallel_thread(query_gpt, args_list, STEP_SIZE)
-
-        for res in results:
-            gpt_results.append(res)
-            issue_type = res.get("issue_type", "")
-            if issue_type:
-                issue_type = issue_type.lower().replace("_", "-")
-                error_type_stats[issue_type] += 1
-
-        counter += STEP_SIZE
-        reached = {k: v for k, v in error_type_stats.items() if v >= LIMIT_PER_ERROR}
-        remaining = {k: v for k, v in error_type_stats.items() if v < LIMIT_PER_ERROR}
-        print(f"total Processed: {counter}")
-        print(f"Reached: {reached}")
-        print(f"Remaining: {remaining}")
-        time.sleep(1)
+    deferred = []
+    in_flight = {}
+    calls = 0
+    aborted = 0
+    start = time.time()
 
+    def next_item():
+        # Lazy greedy: scores only go down while quotas fill up, so a popped
+        # item whose recomputed score is still the best can be sent directly.
+        while heap:
+            _, idx = heapq.heappop(heap)
+            item = data[idx]
+            embedding_plan = item["tagged_erros"].get("embedding_plan", {})
+            plan = get_under_quota_plan(
+                embedding_plan, error_type_stats, in_flight_stats, limit_per_error
+            )
+            if not plan:
+                deferred.append(idx)
+                continue
+            score = quota_priority(
+                plan, error_type_stats, in_flight_stats, limit_per_error
+            )
+            if heap and score < -heap[0][0]:
+                heapq.heappush(heap, (-score, idx))
+                continue
+            return item, plan
+        return None
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers)
+    progress = tqdm(total=limit_per_error * len(error_type_stats), desc="Filling")
+    try:
+        while not is_limit_condition_reached(error_type_stats, limit_per_error):
+            while len(in_flight) < num_workers:
+                candidate = next_item()
+                if not candidate:
+                    break
+                item, plan = candidate
+                args = (
+                    item.get("prompt", ""),
+                    item.get("response", ""),
+                    plan,
+                    item.get("id", ""),
+                )
+                cancel_event = threading.Event() if streaming else None
+                if streaming:
+                    future = executor.submit(func, *args, cancel_event=cancel_event)
+                else:
+                    future = executor.submit(func, *args)
+                planned = [normalise_error_type(k) for k, _ in plan]
+                for k in planned:
+                    in_flight_stats[k] += 1
+                in_flight[future] = (planned, cancel_event)
+                calls += 1
+
+            if not in_flight:
+                break
+
+            done, _ = concurrent.futures.wait(
+                in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                planned, _ = in_flight.pop(future)
+                for k in planned:
+                    in_flight_stats[k] -= 1
+                try:
+                    res = future.result()
+                except Exception as e:
+                    print(f"An exception occurred: {e}")
+                    res = {}
+                if res.pop("aborted", None):
+                    # Stopped early or cancelled: nothing usable was embedded.
+                    aborted += 1
+                    res = {}
+
+                filled = set()
+                for issue_type in get_embedded_error_types(res):
+                    if (
+                        issue_type in error_type_stats
+                        and error_type_stats[issue_type] < limit_per_error
+                    ):
+                        error_type_stats[issue_type] += 1
+                        filled.add(issue_type)
+                        progress.update(1)
+                if res:
+                    gpt_results.append(res)
+
+                # Deferred items were skipped because of calls that were in flight;
+                # give them another chance if those calls did not fill their slots.
+                if deferred and set(planned) - filled:
+                    for idx in deferred:
+                        heapq.heappush(heap, (0.0, idx))
+                    deferred.clear()
+
+            # Calls whose planned error types have all been filled meanwhile are no longer needed.
+            for planned, cancel_event in in_flight.values():
+                if cancel_event is not None and all(
+                    error_type_stats[k] >= limit_per_error for k in planned
+                ):
+                    cancel_event.set()
+    finally:
+        progress.close()
+        for _, cancel_event in in_flight.values():
+            if cancel_event is not None:
+                cancel_event.set()
+        # Queued and in-flight calls are no longer needed once the quotas are met.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    filled_slots = sum(min(v, limit_per_error) for v in error_type_stats.values())
+    reached = {k: v for k, v in error_type_stats.items() if v >= limit_per_error}
+    remaining = {k: v for k, v in error_type_stats.items() if v < limit_per_error}
+    print(f"Reached: {reached}")
+    print(f"Remaining: {remaining}")
     print(
-        f"Total examples processed to get {LIMIT_PER_ERROR} of each errors: {counter}"
+        f"Total calls spent to get {limit_per_error} of each errors: {calls} "
+        f"({calls / filled_slots if filled_slots else 0:.2f} calls per filled slot)"
     )
+    if streaming:
+        print(f"Calls stopped early or cancelled: {aborted}")
     print(f"Total time taken: {time.time() - start}")
+    record_stage_usage("embed-edits" if edit_mode else "embed", get_usage())
     with open(json_out_path, mode="w", encoding="utf-8") as json_file:
         json.dump(
             {"stats": error_type_stats, "results": gpt_results}, json_file, indent=4
         )
 
 
-def embed_multiple_errors(data, valid_error_types):
+def embed_multiple_errors(data, valid_error_types, edit_mode=False, streaming=False):
+    reset_usage()
     json_out_path = "output/embedded.json"
     gpt_results = []
     args_list = []
@@ -195,14 +480,23 @@ def embed_multiple_errors(data, valid_error_types):
             (k, v) for k, v in embedding_plan.items() if k in valid_error_types
         ]
         args_list.append((problem, solution, error_types, item_id))
-    gpt_results = run_in_parallel_thread(query_gpt, args_list, 100)
+    # In edit mode the model returns search/replace edits instead of the full response.
+    # In streaming mode the generation stops as soon as nothing can be embedded.
+    func = query_gpt_edits if edit_mode else query_gpt
+    if streaming and not edit_mode:
+        func = query_gpt_streaming
+    gpt_results = run_in_parallel_thread(
+        func, args_list, 100, cost_fn=lambda prompt, response, *_: estimate_task_tokens(prompt, response)
+    )
     
     for res in gpt_results:
+        res.pop("aborted", None)
         issue_types = res.get("error_types", "")
         for issue_type in issue_types:
             issue_type = issue_type.lower().replace("_", "-")
             error_type_stats[issue_type] += 1
     
+    record_stage_usage("embed-edits" if edit_mode else "embed", get_usage())
     with open(json_out_path, mode="w", encoding="utf-8") as json_file:
         json.dump(
             {"stats": error_type_stats, "results": gpt_results}, json_file, indent=4
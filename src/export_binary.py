@@ -0,0 +1,253 @@
+import os
+import json
+import argparse
+import concurrent.futures
+
+import numpy as np
+from tqdm import tqdm
+
+from src.utils import read_json_file
+
+
+CHUNK_SIZE = 512
+TOKEN_DTYPE = np.uint32
+MASK_DTYPE = np.int8
+BUCKET_BOUNDARIES = [256, 512, 1024, 2048, 4096, 8192]
+# Columns of index.npy, all offsets and lengths are in tokens.
+INDEX_COLUMNS = [
+    "prompt_offset",
+    "prompt_length",
+    "chosen_offset",
+    "chosen_length",
+    "rejected_offset",
+    "rejected_length",
+]
+
+
+def get_tokenizer(tokenizer_name):
+    """
+    Returns a function mapping a text to (token ids, character start of each token).
+
+    `tiktoken:<encoding>` uses a tiktoken encoding, `hf:<model>` a Hugging Face
+    tokenizer (requires `transformers`).
+    """
+    kind, _, name = tokenizer_name.partition(":")
+    if kind == "tiktoken":
+        import tiktoken
+
+        encoding = tiktoken.get_encoding(name)
+
+        def tokenize(text):
+            ids = encoding.encode(text, disallowed_special=())
+            _, starts = encoding.decode_with_offsets(ids)
+            return ids, starts
+
+        return tokenize
+
+    if kind == "hf":
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(name)
+
+        def tokenize(text):
+            encoded = tokenizer(
+                text, add_special_tokens=False, return_offsets_mapping=True
+            )
+            return encoded["input_ids"], [start for start, _ in encoded["offset_mapping"]]
+
+        return tokenize
+
+    raise ValueError(f"Unknown tokenizer '{tokenizer_name}', expected tiktoken:<name> or hf:<name>.")
+
+
+def get_token_mask(starts, text_length, masked_regions, flag):
+    """Marks with `flag` every token overlapping a masked region of that flag."""
+    mask = np.zeros(len(starts), dtype=MASK_DTYPE)
+    if not len(starts):
+        return mask
+    token_starts = np.asarray(starts, dtype=np.int64)
+    token_ends = np.append(token_starts[1:], text_length)
+    for start, end, region_flag in masked_regions:
+        if region_flag == flag:
+            mask[(token_starts < end) & (token_ends > start)] = flag
+    return mask
+
+
+_tokenize = None
+
+
+def init_worker(tokenizer_name):
+    global _tokenize
+    _tokenize = get_tokenizer(tokenizer_name)
+
+
+def tokenize_chunk(items):
+    """Tokenizes a chunk of preference items on a worker process."""
+    packed = []
+    for item in items:
+        prompt = item.get("prompt", "") or ""
+        chosen = item.get("correct_response", "") or ""
+        rejected = item.get("incorrect_response", "") or item.get("error_embedded_response", "") or ""
+        masked_regions = item.get("masked_regions", []) or []
+
+        prompt_ids, _ = _tokenize(prompt)
+        chosen_ids, chosen_starts = _tokenize(chosen)
+        rejected_ids, rejected_starts = _tokenize(rejected)
+        packed.append(
+            (
+                np.asarray(prompt_ids, dtype=TOKEN_DTYPE),
+                np.asarray(chosen_ids, dtype=TOKEN_DTYPE),
+                np.asarray(rejected_ids, dtype=TOKEN_DTYPE),
+                get_token_mask(chosen_starts, len(chosen), masked_regions, 1),
+                get_token_mask(rejected_starts, len(rejected), masked_regions, -1),
+            )
+        )
+    return packed
+
+
+def export_binary_dataset(
+    data, out_dir, tokenizer_name="tiktoken:cl100k_base", num_workers=None
+):
+    """
+    Packs preference items into flat memory-mapped arrays.
+
+    Writes to `out_dir`:
+        tokens.bin: every prompt, chosen and rejected token id, back to back.
+        masks.bin: per-token region mask aligned with tokens.bin (1 marks good
+            regions of the chosen response, -1 bad regions of the rejected one).
+        index.npy: one row per item with the offsets and lengths of INDEX_COLUMNS.
+        buckets.npy: length bucket of each item, see BUCKET_BOUNDARIES.
+        meta.json: sizes, dtypes, tokenizer and bucket boundaries.
+
+    Items are tokenized in chunks across processes and written in input order.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    chunks = [data[i : i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+    index = np.zeros((len(data), len(INDEX_COLUMNS)), dtype=np.int64)
+    offset = 0
+    row = 0
+
+    with open(os.path.join(out_dir, "tokens.bin"), "wb") as tokens_file, open(
+        os.path.join(out_dir, "masks.bin"), "wb"
+    ) as masks_file, concurrent.futures.ProcessPoolExecutor(
+        max_workers=num_workers, initializer=init_worker, initargs=(tokenizer_name,)
+    ) as executor:
+        # map() yields the chunks in input order, so the layout is deterministic.
+        for packed in tqdm(
+            executor.map(tokenize_chunk, chunks), total=len(chunks), desc="Packing"
+        ):
+            for prompt_ids, chosen_ids, rejected_ids, chosen_mask, rejected_mask in packed:
+                prompt_mask = np.zeros(len(prompt_ids), dtype=MASK_DTYPE)
+                columns = []
+                for ids, mask in (
+                    (prompt_ids, prompt_mask),
+                    (chosen_ids, chosen_mask),
+                    (rejected_ids, rejected_mask),
+                ):
+                    tokens_file.write(ids.tobytes())
+                    masks_file.write(mask.tobytes())
+                    columns.extend([offset, len(ids)])
+                    offset += len(ids)
+                index[row] = columns
+                row += 1
+
+    lengths = index[:, 1] + np.maximum(index[:, 3], index[:, 5])
+    buckets = np.searchsorted(BUCKET_BOUNDARIES, lengths, side="left").astype(np.int16)
+    np.save(os.path.join(out_dir, "index.npy"), index)
+    np.save(os.path.join(out_dir, "buckets.npy"), buckets)
+
+    meta = {
+        "num_items": len(data),
+        "num_tokens": int(offset),
+        "token_dtype": np.dtype(TOKEN_DTYPE).name,
+        "mask_dtype": np.dtype(MASK_DTYPE).name,
+        "tokenizer": tokenizer_name,
+        "index_columns": INDEX_COLUMNS,
+        "bucket_boundaries": BUCKET_BOUNDARIES,
+        "bucket_sizes": np.bincount(buckets, minlength=len(BUCKET_BOUNDARIES) + 1).tolist(),
+    }
+    with open(os.path.join(out_dir, "meta.json"), "w") as jf:
+        json.dump(meta, jf, indent=4)
+    print(f"Packed {len(data)} items, {offset} tokens into '{out_dir}'.")
+    return meta
+
+
+class PackedPreferenceDataset:
+    """
+    Random-access reader for the output of `export_binary_dataset`.
+
+    Opening only maps the files, nothing is parsed or tokenized.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as jf:
+            self.meta = json.load(jf)
+        self.tokens = np.memmap(
+            os.path.join(path, "tokens.bin"), dtype=self.meta["token_dtype"], mode="r"
+        )
+        self.masks = np.memmap(
+            os.path.join(path, "masks.bin"), dtype=self.meta["mask_dtype"], mode="r"
+        )
+        self.index = np.load(os.path.join(path, "index.npy"), mmap_mode="r")
+        self.buckets = np.load(os.path.join(path, "buckets.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return self.meta["num_items"]
+
+    def __getitem__(self, idx):
+        (
+            prompt_offset,
+            prompt_length,
+            chosen_offset,
+            chosen_length,
+            rejected_offset,
+            rejected_length,
+        ) = self.index[idx]
+        return {
+            "prompt_ids": self.tokens[prompt_offset : prompt_offset + prompt_length],
+            "chosen_ids": self.tokens[chosen_offset : chosen_offset + chosen_length],
+            "rejected_ids": self.tokens[rejected_offset : rejected_offset + rejected_length],
+            "chosen_mask": self.masks[chosen_offset : chosen_offset + chosen_length],
+            "rejected_mask": self.masks[rejected_offset : rejected_offset + rejected_length],
+        }
+
+    def bucket_indices(self, bucket):
+        """Indices of the items in a length bucket."""
+        return np.flatnonzero(np.asarray(self.buckets) == bucket)
+
+    def shard(self, rank, world_size, seed=0, epoch=0):
+        """
+        Deterministic shard of item indices for one data-parallel rank.
+
+        Every rank draws the same seeded permutation and takes every
+        `world_size`-th item, trimmed so that all ranks get the same count.
+        """
+        permutation = np.random.default_rng(seed + epoch).permutation(len(self))
+        per_rank = len(self) // world_size
+        return permutation[rank : per_rank * world_size : world_size]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process file path argument.")
+
+    parser.add_argument(
+        "-i",
+        "--input_file_path",
+        type=str,
+        required=True,
+        help="SFT corruption or final granular annotation dataset.",
+    )
+    parser.add_argument(
+        "-o", "--output_dir", type=str, default="output/packed", help="Output directory."
+    )
+    parser.add_argument(
+        "--tokenizer",
+        type=str,
+        default="tiktoken:cl100k_base",
+        help="tiktoken:<encoding> or hf:<model name>.",
+    )
+
+    args = parser.parse_args()
+
+    file_path = args.input_file_path.replace(".json", "")
+    export_binary_dataset(read_json_file(file_path), args.output_dir, args.tokenizer)
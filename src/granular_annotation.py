@@ -1,11 +1,27 @@
+import re
+import json
 import argparse
+import threading
+import concurrent.futures
+from typing import List
 from pydantic import BaseModel, Field
 from src.utils import (
-    query_openai_llm,
-    run_in_parallel_thread,
+    query_openai_llm_raw,
+    run_in_parallel_hybrid,
+    estimate_task_tokens,
+    num_tokens_from_string,
     write_to_json_file,
+    write_json_fragments,
     read_json_file,
+    reset_usage,
+    get_usage,
 )
+from src.manifest import record_stage_usage
+
+
+CODE_BLOCK_PATTERN = re.compile(r"```.*?(?:```|\Z)", re.DOTALL)
+PARAGRAPH_BREAK_PATTERN = re.compile(r"\n[ \t]*\n\s*")
+MAX_WINDOW_WORKERS = 8
 
 
 class IncorrectRegion(BaseModel):
@@ -17,14 +33,25 @@ class IncorrectRegion(BaseModel):
     )
 
 
-def query_gpt(user_query, response, issue_types, item_id):
-    prompt = f"""
+class IncorrectRegions(BaseModel):
+    incorrect_regions: List[IncorrectRegion] = Field(
+        default=[], description="Find all the incorrect regions in the given response."
+    )
+
+
+def build_prompt(user_query, response, issue_types, excerpt=False):
+    excerpt_note = (
+        "The assistant response below is an excerpt of a longer response. Only return errors that are inside it.\n"
+        if excerpt
+        else ""
+    )
+    return f"""
     ## INSTRUCTION
     You are provided with a conversation in which a user requests a solution from an LLM assistant. Your task is to review 
     the assistant's response, identify where all the errors of the specified type exists in the assistant response, and return only the substring that contains
     the error. If something is missing from the response, return the substring that should have been included. For example, if 
     an import statement is missing, return just the 'import' keyword rather than the line that requires the import statement.
-
+    {excerpt_note}
     ### USER QUERY
     {user_query}
 
@@ -50,12 +77,34 @@ def query_gpt(user_query, response, issue_types, item_id):
         incorrect_regions: List[IncorrectRegion] = Field(description="Find all the incorrect regions in the give ")
     =====
     """
-    out = query_openai_llm(prompt, IncorrectRegion)
-    out.update({"id": item_id})
-    return out
 
 
-def get_masked_region_tuple(w_response, l_response, sub_str):
+def query_gpt_raw(item):
+    """Sends the annotation request of an item and returns it with the unparsed output."""
+    prompt = build_prompt(
+        item.get("prompt", ""),
+        item.get("error_embedded_response", ""),
+        item.get("embedded_errors", ""),
+    )
+    return item, query_openai_llm_raw(prompt)
+
+
+def parse_incorrect_regions(raw):
+    out = json.loads(raw)
+    # The model sometimes answers with a single region instead of the list.
+    if "incorrect_regions" not in out and "error_substring" in out:
+        out = {"incorrect_regions": [out]}
+    return IncorrectRegions.model_validate(out).model_dump()
+
+
+def get_masked_region_tuple(w_response, l_response, sub_str, window=None):
+    """
+    Locates an error substring, in the correct response first (1), else in the
+    incorrect one (-1).
+
+    `window` is the (start, end) span of the incorrect response that was
+    annotated; an occurrence inside it is preferred over earlier ones.
+    """
     start_idx, end_idx = None, None
 
     if sub_str in w_response:
@@ -64,56 +113,276 @@ def get_masked_region_tuple(w_response, l_response, sub_str):
         return (start_idx, end_idx, 1)
 
     elif sub_str in l_response:
-        start_idx = l_response.find(sub_str)
+        start_idx = l_response.find(sub_str, *window) if window else -1
+        if start_idx == -1:
+            start_idx = l_response.find(sub_str)
         end_idx = start_idx + len(sub_str)
         return (start_idx, end_idx, -1)
 
     return None
 
 
-def get_error_substrings(data):
-    args_list = []
-    results = []
-    id_to_item_map = {item["id"]: item for item in data}
-    for item in data:
-        prompt, erroneous_response, item_id, embedded_errors = (
-            item.get("prompt", ""),
-            item.get("error_embedded_response", ""),
-            item.get("id", ""),
-            item.get("embedded_errors", ""),
+def get_masked_regions(item, incorrect_regions):
+    correct_response, incorrect_response = (
+        item.get("correct_response", ""),
+        item.get("error_embedded_response", ""),
+    )
+    masked_regions = []
+    for incorrect_region in incorrect_regions:
+        sub_str = incorrect_region.get("error_substring", "")
+
+        masked_region = get_masked_region_tuple(
+            correct_response, incorrect_response, sub_str
         )
-        args_list.append((prompt, erroneous_response, embedded_errors, item_id))
+        if masked_region:
+            masked_regions.append(masked_region)
+    return masked_regions
 
-    gpt_results = run_in_parallel_thread(query_gpt, args_list, 100)
 
-    for res in gpt_results:
-        res_id = res.get("id", "")
-        item = id_to_item_map[res_id]
-        prompt, incorrect_response, correct_response = (
-            item.get("prompt", ""),
-            item.get("error_embedded_response", ""),
-            item.get("correct_response", ""),
+def split_into_segments(text):
+    """
+    Splits a response into contiguous (start, end) segments.
+
+    Fenced code blocks are kept whole and prose is split after blank lines,
+    so window boundaries never fall inside a code block or a paragraph.
+    """
+    boundaries = {0, len(text)}
+    prose_start = 0
+    for match in CODE_BLOCK_PATTERN.finditer(text):
+        boundaries.update((match.start(), match.end()))
+        for brk in PARAGRAPH_BREAK_PATTERN.finditer(text, prose_start, match.start()):
+            boundaries.add(brk.end())
+        prose_start = match.end()
+    for brk in PARAGRAPH_BREAK_PATTERN.finditer(text, prose_start):
+        boundaries.add(brk.end())
+
+    boundaries = sorted(boundaries)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+
+def split_long_segment(text, start, end, max_tokens, count_tokens):
+    """Splits a segment over the token budget into groups of whole lines."""
+    segments = []
+    current_start, current_tokens = start, 0
+    position = start
+    for line in text[start:end].splitlines(keepends=True):
+        line_tokens = count_tokens(line)
+        if current_tokens and current_tokens + line_tokens > max_tokens:
+            segments.append((current_start, position))
+            current_start, current_tokens = position, 0
+        current_tokens += line_tokens
+        position += len(line)
+    segments.append((current_start, end))
+    return segments
+
+
+def split_into_windows(text, max_tokens=1000, overlap_tokens=100, count_tokens=num_tokens_from_string):
+    """
+    Packs the segments of a response into overlapping windows under a token budget.
+
+    Args:
+        text: The response to split.
+        max_tokens: Token budget of a window. A single line longer than the
+            budget still becomes its own window.
+        overlap_tokens: Trailing segments of a window, up to this many tokens,
+            are repeated at the start of the next one.
+        count_tokens: Function counting the tokens of a string.
+
+    Returns:
+        windows: List of (start, end) character offsets into `text`.
+    """
+    segments, sizes = [], []
+    for start, end in split_into_segments(text):
+        size = count_tokens(text[start:end])
+        if size > max_tokens:
+            for sub_start, sub_end in split_long_segment(text, start, end, max_tokens, count_tokens):
+                segments.append((sub_start, sub_end))
+                sizes.append(count_tokens(text[sub_start:sub_end]))
+        else:
+            segments.append((start, end))
+            sizes.append(size)
+
+    windows = []
+    first = 0
+    while first < len(segments):
+        last, total = first, 0
+        while last < len(segments) and (last == first or total + sizes[last] <= max_tokens):
+            total += sizes[last]
+            last += 1
+        windows.append((segments[first][0], segments[last - 1][1]))
+        if last == len(segments):
+            break
+        # Step back over the trailing segments that fit in the overlap, as long as
+        # the next segment still fits after them, always moving forward.
+        next_first, overlap = last, 0
+        while next_first - 1 > first:
+            size = sizes[next_first - 1]
+            if overlap + size > overlap_tokens or overlap + size + sizes[last] > max_tokens:
+                break
+            next_first -= 1
+            overlap += size
+        first = next_first
+    return windows
+
+
+def merge_masked_regions(masked_regions):
+    """Merges duplicate and overlapping regions of the same response, e.g. found by two overlapping windows."""
+    merged = []
+    for start, end, flag in sorted(set(masked_regions), key=lambda region: (region[2], region[0], region[1])):
+        if merged and merged[-1][2] == flag and start < merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]), flag)
+        else:
+            merged.append((start, end, flag))
+    return merged
+
+
+def query_gpt_windows_raw(item, windows, limiter=None):
+    """
+    Sends the annotation requests of all windows of an item concurrently.
+
+    `limiter` is a semaphore shared by the window calls of every item, so the
+    requests in flight stay within the pool size despite the nested pools.
+    """
+    response = item.get("error_embedded_response", "")
+    excerpt = len(windows) > 1
+    limiter = limiter or threading.Semaphore(MAX_WINDOW_WORKERS)
+
+    def query_window(start, end):
+        prompt = build_prompt(
+            item.get("prompt", ""), response[start:end], item.get("embedded_errors", ""), excerpt
         )
-        
-        incorrect_regions = res.get("incorrect_regions", [])
-        masked_regions = []
-        for incorrect_region in incorrect_regions:
-            sub_str = incorrect_region.get("error_substring", "")
-
-            masked_region = get_masked_region_tuple(
-                correct_response, incorrect_response, sub_str
-            )
-            if masked_region:
-                masked_regions.append(masked_region)
+        with limiter:
+            return start, end, query_openai_llm_raw(prompt)
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, min(MAX_WINDOW_WORKERS, len(windows)))
+    ) as executor:
+        return item, list(executor.map(lambda window: query_window(*window), windows))
+
+
+def annotate_window_chunk(chunk):
+    """
+    Parses the window annotations of a chunk of items and merges them per item.
+
+    Substrings are located with the rules of the single-prompt mode, see
+    `get_masked_region_tuple`, so both modes agree. An occurrence in the
+    incorrect response is taken from the annotated window when there is one.
+    """
+    fragments = []
+    for item, window_outputs in chunk:
+        correct_response = item.get("correct_response", "")
+        response = item.get("error_embedded_response", "")
+        incorrect_regions, masked_regions = [], []
+        for start, end, raw in window_outputs:
+            try:
+                regions = parse_incorrect_regions(raw)["incorrect_regions"]
+            except Exception as e:
+                print(f"An exception occurred: {e}")
+                continue
+            for region in regions:
+                masked_region = get_masked_region_tuple(
+                    correct_response, response, region.get("error_substring", ""), (start, end)
+                )
+                if masked_region:
+                    masked_regions.append(masked_region)
+                if region not in incorrect_regions:
+                    incorrect_regions.append(region)
+
+        item.update(
+            {
+                "incorrect_regions": incorrect_regions,
+                "masked_regions": merge_masked_regions(masked_regions),
+                "num_windows": len(window_outputs),
+            }
+        )
+        fragments.append(json.dumps(item))
+    return fragments
+
+
+def annotate_chunk(chunk):
+    """
+    Parses a chunk of raw annotation outputs and locates their masked regions.
+
+    Runs on a worker process. Items are returned already serialized, so the
+    main process only has to join them when writing the output file.
+    """
+    fragments = []
+    for item, raw in chunk:
+        try:
+            res = parse_incorrect_regions(raw)
+        except Exception as e:
+            print(f"An exception occurred: {e}")
+            continue
 
-        
-        res.update({"masked_regions": masked_regions})
+        res.update(
+            {
+                "id": item.get("id", ""),
+                "masked_regions": get_masked_regions(item, res["incorrect_regions"]),
+            }
+        )
         item.update(res)
-        results.append(item)
+        fragments.append(json.dumps(item))
+    return fragments
+
+
+def estimate_item_tokens(item, *args):
+    """Estimated size of an annotation call, from the response it annotates."""
+    return estimate_task_tokens(item.get("prompt", ""), item.get("error_embedded_response", ""))
+
+
+def get_error_substrings(
+    data, num_workers=100, num_processes=None, window_tokens=0, overlap_tokens=100
+):
+    """
+    Annotates the error regions of every item.
+
+    The annotation calls run on threads while parsing, the masked-region
+    search and serialization run in chunks on a process pool. Items that
+    already carry masked regions (edit mode, local mutations) are kept as is.
+
+    With `window_tokens`, responses are split into overlapping windows of at
+    most that many tokens along code-block and paragraph boundaries. The
+    windows of an item are annotated concurrently and their regions merged,
+    so the latency of an item no longer grows with the response length. At
+    most `num_workers` window requests are in flight across all items.
+    """
+    reset_usage()
+    fragments = [json.dumps(item) for item in data if item.get("masked_regions")]
+    items = [item for item in data if not item.get("masked_regions")]
+    if window_tokens:
+        limiter = threading.Semaphore(num_workers)
+        args_list = [
+            (
+                item,
+                split_into_windows(
+                    item.get("error_embedded_response", ""), window_tokens, overlap_tokens
+                ),
+                limiter,
+            )
+            for item in items
+        ]
+        fragments += run_in_parallel_hybrid(
+            query_gpt_windows_raw,
+            args_list,
+            annotate_window_chunk,
+            num_workers,
+            num_processes,
+            cost_fn=estimate_item_tokens,
+        )
+    else:
+        fragments += run_in_parallel_hybrid(
+            query_gpt_raw,
+            [(item,) for item in items],
+            annotate_chunk,
+            num_workers,
+            num_processes,
+            cost_fn=estimate_item_tokens,
+        )
 
     out_file_path = "output/granular_annotation"
 
-    write_to_json_file(results, out_file_path)
+    write_json_fragments(fragments, out_file_path)
+    record_stage_usage("annotate", get_usage())
 
 
 def prepare_final_dataset(data):
@@ -150,6 +419,18 @@ if __name__ == "__main__":
         required=True,
         help="File path for processing.",
     )
+    parser.add_argument(
+        "--window_tokens",
+        type=int,
+        default=0,
+        help="Annotate long responses in windows of this many tokens, 0 sends whole responses.",
+    )
+    parser.add_argument(
+        "--overlap_tokens",
+        type=int,
+        default=100,
+        help="Tokens repeated between consecutive windows.",
+    )
 
     # Parse the arguments
     args = parser.parse_args()
@@ -157,6 +438,10 @@ if __name__ == "__main__":
     # Retrieve the file path argument
     file_path = args.input_file_path.replace(".json", "")
     error_embedded_data = read_json_file(file_path)["results"]
-    get_error_substrings(error_embedded_data)
+    get_error_substrings(
+        error_embedded_data,
+        window_tokens=args.window_tokens,
+        overlap_tokens=args.overlap_tokens,
+    )
     json_data = read_json_file("output/granular_annotation")
     prepare_final_dataset(json_data)
@@ -1,17 +1,38 @@
-import os
+import math
+import time
+import hashlib
 import argparse
+import concurrent.futures
+from statistics import NormalDist
 from collections import defaultdict
 from typing import List, Dict
 from pydantic import BaseModel, Field
+from tqdm import tqdm
 
 from src.utils import (
     query_openai_llm,
-    run_in_parallel_thread,
+    estimate_task_tokens,
+    order_by_cost,
+    timed,
+    print_schedule_stats,
+    reset_usage,
+    get_usage,
     write_to_json_file,
     read_json_file,
     create_directory
 )
 from src.tagging import IssueTypes
+from src.manifest import record_stage_usage
+from src.dry_run import DEFAULT_RPM, DEFAULT_TPM, dry_run, bench_requests
+from src.results_store import (
+    CORRECTNESS,
+    ERROR,
+    open_results_store,
+    response_hash,
+    get_evaluation,
+    add_evaluation,
+    generate_report,
+)
 
 
 class CorrectnessAspectEvaluation(BaseModel):
@@ -47,8 +68,17 @@ class EmbeddedErrors(BaseModel):
     )
 
 
-def check_correctness(user_query, model_response, prompt_id):
-    prompt = f"""
+class CorrectnessAndErrorEvaluation(CorrectnessEvaluation):
+    error_types: List[str] = Field(
+        description="List the error types that can be found into the assistant's response."
+    )
+    embedded_errors: Dict[str, str] = Field(
+        description="For each identified error type, provide a brief description where it exists and it's justification."
+    )
+
+
+def build_correctness_prompt(user_query, model_response):
+    return f"""
     ## INSTRUCTION
     You are provided with a conversation where a user requests a solution from an LLM assistant. 
     The user's query: "{user_query}"
@@ -110,13 +140,17 @@ def check_correctness(user_query, model_response, prompt_id):
 
     }}
     """
+
+
+def check_correctness(user_query, model_response, prompt_id):
+    prompt = build_correctness_prompt(user_query, model_response)
     out = query_openai_llm(prompt, CorrectnessEvaluation)
     out.update({"prompt_id": prompt_id})
     return out
 
 
-def check_for_errors(user_query, model_response, errors_list, prompt_id):
-    prompt = f"""
+def build_errors_prompt(user_query, model_response, errors_list):
+    return f"""
     ## INSTRUCTION
     You are provided with a user query and the response generated by an AI model. Additionally, you are given a list
     of potential error types that might occur in the response. Your task is to evaluate the response and determine 
@@ -158,11 +192,111 @@ def check_for_errors(user_query, model_response, errors_list, prompt_id):
     }}
     """
 
+
+def check_for_errors(user_query, model_response, errors_list, prompt_id):
+    prompt = build_errors_prompt(user_query, model_response, errors_list)
     output = query_openai_llm(prompt, EmbeddedErrors)
     output.update({"prompt_id": prompt_id})
     return output
 
 
+def build_fused_prompt(user_query, model_response, errors_list):
+    return f"""
+    ## INSTRUCTION
+    You are provided with a user query and the response generated by an AI model. Additionally, you are given a list
+    of potential error types that might occur in the response. Your task is twofold:
+
+    1. Evaluate the response based on the following criteria:
+        - **Accuracy:** Is the information provided accurate?
+        - **Completeness:** Does the response address all aspects of the user's query?
+        - **Clarity:** Is the response clear and easy to understand?
+        - **Logical Consistency:** Does the response make logical sense given the query?
+    2. Determine if the response contains any of the specified errors. If an error is present, identify it and explain
+    why it is an error. If no errors are found, leave the error fields empty.
+
+    ### USER QUERY
+    "{user_query}"
+
+    ### MODEL RESPONSE
+    "{model_response}"
+
+    ### POSSIBLE ERRORS
+    {errors_list}
+
+    ## OUTPUT FORMAT INSTRUCTIONS:
+    The output should be a JSON object that conforms to the following Pydantic model:
+
+    ======
+    class CorrectnessAspectEvaluation(BaseModel):
+        value: str = Field(description="Indicates if the aspect is satisfactory. Should be 'Yes' or 'No'.")
+        explanation: str = Field(description="Explanation for the given value, both for 'Yes' or 'No'.")
+
+    class CorrectnessAndErrorEvaluation(BaseModel):
+        accuracy: CorrectnessAspectEvaluation = Field(description="Indicates if the response is accurate.")
+        completeness: CorrectnessAspectEvaluation = Field(description="Indicates if the response is complete.")
+        clarity: CorrectnessAspectEvaluation = Field(description="Indicates if the response is clear.")
+        logical_consistency: CorrectnessAspectEvaluation = Field(description="Indicates if the response is logically consistent.")
+        error_types: List[str] = Field(description="List the error types that can be found into the assistant's response.")
+        embedded_errors: Dict[str, str] = Field(description="For each identified error type, provide a brief description where it exists and it's justification.")
+    ======
+
+    ## EXAMPLE OUTPUT
+    {{
+        "accuracy": {{
+            "value": "No",
+            "explanation": "The loop stops one element early, so the last item of the list is never processed."
+        }},
+        "completeness": {{
+            "value": "Yes",
+            "explanation": "The response addresses every part of the user's query."
+        }},
+        "clarity": {{
+            "value": "Yes",
+            "explanation": "The response is clear and the code is explained step by step."
+        }},
+        "logical_consistency": {{
+            "value": "Yes",
+            "explanation": "The explanation follows a coherent structure from the problem to the solution."
+        }},
+        "error_types": [
+            "off-by-one-errors"
+        ],
+        "embedded_errors": {{
+            "off-by-one-errors": "The loop uses range(len(items) - 1), which skips the last element of the list."
+        }}
+    }}
+    """
+
+
+def check_correctness_and_errors(user_query, model_response, errors_list, prompt_id):
+    prompt = build_fused_prompt(user_query, model_response, errors_list)
+    output = query_openai_llm(prompt, CorrectnessAndErrorEvaluation)
+    output.update({"prompt_id": prompt_id})
+    return output
+
+
+# Prompt builder of each evaluation function, called with the same args minus the prompt id.
+PROMPT_BUILDERS = {
+    check_correctness: build_correctness_prompt,
+    check_for_errors: build_errors_prompt,
+    check_correctness_and_errors: build_fused_prompt,
+}
+
+
+def split_fused_evaluation(evaluation):
+    """Splits a fused evaluation into the correctness and error evaluation outputs."""
+    correctness = {
+        aspect: evaluation.get(aspect) for aspect in CorrectnessEvaluation.model_fields
+    }
+    correctness.update({"prompt_id": evaluation.get("prompt_id", "")})
+    errors = {
+        "error_types": evaluation.get("error_types", []),
+        "embedded_errors": evaluation.get("embedded_errors", {}),
+        "prompt_id": evaluation.get("prompt_id", ""),
+    }
+    return correctness, errors
+
+
 def error_and_correctness_stats(error_evaluations, correctness_evaluations, model):
 
     err_type_stats = defaultdict(int)
@@ -193,131 +327,502 @@ def error_and_correctness_stats(error_evaluations, correctness_evaluations, mode
     return (err_type_stats, stats)
 
 
-def run_correctness_evaluation(file_path, output_file):
-    # Correctness
+def get_assistant_response(item):
+    assistant_response = ""
+    for message in item.get("pipeline_response", ""):
+        if message.get("role", "") == "assistant":
+            assistant_response = message.get("content", "")
+    return assistant_response
 
-    model_data = read_json_file(file_path)[:10]
-    args_list = []
-    gpt_results = []
-    for item in model_data:
-        prompt_id = item.get("p_id", "")
-        prompt = item.get("prompt", "")
-        messages = item.get("pipeline_response", "")
-        assistant_response = ""
 
-        for message in messages:
+def load_model_data(file_path, sample_size=10):
+    model_data = read_json_file(file_path)
+    return model_data[:sample_size] if sample_size else model_data
 
-            if message.get("role", "") == "assistant":
-                assistant_response = message.get("content", "")
 
-        args_list.append((prompt, assistant_response, prompt_id))
+def get_model_name(file):
+    return file.split("/")[-1].replace(".json", "")
 
-    gpt_results = run_in_parallel_thread(check_correctness, args_list, 100)
 
-    write_to_json_file(
-        gpt_results,
-        f"stats/{output_file}",
+def get_output_names(file):
+    filename = get_model_name(file)
+    return (
+        f"{filename}-correctness-evaluation",
+        f"{filename}-error-evaluation",
     )
 
 
-def run_error_evaluation(file_path, output_file):
+def get_output_kind(output_file):
+    if output_file.endswith("-correctness-evaluation"):
+        return CORRECTNESS
+    return ERROR
+
+
+def build_item_tasks(file, item, fused=False, item_index=0):
+    """
+    Returns (output files, evaluation function, args, key) tuples for one benchmarked item.
+    A fused task evaluates correctness and errors in one call and feeds both outputs.
+    The key (model, prompt id, item index, response hash) identifies the evaluation in
+    the results store; the index of the item in its file tells apart items sharing a prompt id.
+    """
+    correctness_output, error_output = get_output_names(file)
+    errors_list = [issue.value for issue in IssueTypes]
+    prompt_id = item.get("p_id", "")
+    prompt = item.get("prompt", "")
+    assistant_response = get_assistant_response(item)
+    key = (get_model_name(file), str(prompt_id), item_index, response_hash(prompt, assistant_response))
+
+    if fused:
+        return [
+            (
+                (correctness_output, error_output),
+                check_correctness_and_errors,
+                (prompt, assistant_response, errors_list, prompt_id),
+                key,
+            )
+        ]
+    return [
+        (
+            (correctness_output,),
+            check_correctness,
+            (prompt, assistant_response, prompt_id),
+            key,
+        ),
+        (
+            (error_output,),
+            check_for_errors,
+            (prompt, assistant_response, errors_list, prompt_id),
+            key,
+        ),
+    ]
+
+
+def build_benchmark_tasks(file, sample_size=10, fused=False):
+    """Returns the evaluation tasks of one model file."""
+    tasks = []
+    for index, item in enumerate(load_model_data(file.replace(".json", ""), sample_size)):
+        tasks.extend(build_item_tasks(file, item, fused, index))
+    return tasks
+
+
+def split_result(output_files, result):
+    """Returns (output file, evaluation) pairs for the result of a task."""
+    if len(output_files) == 1:
+        return [(output_files[0], result)]
+    return list(zip(output_files, split_fused_evaluation(result)))
+
+
+def get_stored_results(store, output_files, key):
+    """Returns the stored evaluations of a task, or None if any of them is missing."""
+    if store is None:
+        return None
+    model, prompt_id, item_index, res_hash = key
+    stored = [
+        get_evaluation(store, model, prompt_id, item_index, get_output_kind(output_file), res_hash)
+        for output_file in output_files
+    ]
+    if any(evaluation is None for evaluation in stored):
+        return None
+    return list(zip(output_files, stored))
+
+
+def store_results(store, parts, key):
+    if store is None:
+        return
+    model, prompt_id, item_index, res_hash = key
+    for output_file, evaluation in parts:
+        add_evaluation(
+            store, model, prompt_id, item_index, get_output_kind(output_file), res_hash, evaluation
+        )
+
 
-    # Error Rate
-    model_data = read_json_file(file_path)[:10]
-    args_list = []
-    errors_list = [item.value for item in IssueTypes]
-    gpt_results = []
+def get_report_items(keys):
+    """Groups task keys into the {model: {(prompt id, item index)}} scope of a report."""
+    items = defaultdict(set)
+    for model, prompt_id, item_index, _ in keys:
+        items[model].add((prompt_id, item_index))
+    return dict(items)
 
-    for item in model_data:
-        prompt_id = item.get("p_id", "")
-        prompt = item.get("prompt", "")
-        messages = item.get("pipeline_response", "")
-        assistant_response = ""
 
-        for message in messages:
+def run_benchmark(files, sample_size=10, num_workers=100, fused=False, store=None):
+    """
+    Runs the correctness and error evaluations of every model file in one shared pool.
+
+    Tasks from all files are interleaved in a single bounded pool, so the pool
+    never drains between files or evaluation kinds. Each output file under
+    `stats/` is written as soon as its last evaluation completes. Evaluations
+    already in the results store for an unchanged response are reused.
+
+    Args:
+        files (list): Paths of the model response files to benchmark.
+        sample_size (int): Number of items evaluated per file, 0 for all.
+        num_workers (int): Number of concurrent evaluation calls.
+        fused (bool): Evaluate correctness and errors with a single call per item.
+        store (sqlite3.Connection): Optional results store, see `results_store.py`.
+
+    Returns:
+        items (dict): The evaluated items per model, see `get_report_items`.
+    """
+    tasks = []
+    for file in files:
+        tasks.extend(build_benchmark_tasks(file, sample_size, fused))
+
+    pending = defaultdict(int)
+    results = defaultdict(list)
+    new_tasks = []
+    for output_files, func, args, key in tasks:
+        stored = get_stored_results(store, output_files, key)
+        for output_file, evaluation in stored or []:
+            results[output_file].append(evaluation)
+        if stored:
+            continue
+        new_tasks.append((output_files, func, args, key))
+        for output_file in output_files:
+            pending[output_file] += 1
 
-            if message.get("role", "") == "assistant":
-                assistant_response = message.get("content", "")
+    for file in files:
+        for output_file in get_output_names(file):
+            if output_file not in pending:
+                write_to_json_file(results.pop(output_file, []), f"stats/{output_file}")
 
-        args_list.append((prompt, assistant_response, errors_list, prompt_id))
+    # The largest responses are evaluated first so they do not make up the tail of the run.
+    new_tasks = order_by_cost(
+        new_tasks, lambda output_files, func, args, key: estimate_task_tokens(*args[:2])
+    )
+    timings = []
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {
+            executor.submit(timed(func, timings), *args): (output_files, key)
+            for output_files, func, args, key in new_tasks
+        }
+
+        for future in tqdm(
+            concurrent.futures.as_completed(futures),
+            total=len(futures),
+            desc="Benchmarking",
+        ):
+            output_files, key = futures[future]
+            try:
+                parts = split_result(output_files, future.result())
+                for output_file, evaluation in parts:
+                    results[output_file].append(evaluation)
+                store_results(store, parts, key)
+            except Exception as e:
+                print(f"An exception occurred: {e}")
+
+            for output_file in output_files:
+                pending[output_file] -= 1
+                if not pending[output_file]:
+                    write_to_json_file(results.pop(output_file), f"stats/{output_file}")
+
+    print_schedule_stats(timings, num_workers, start)
+    return get_report_items(key for _, _, _, key in tasks)
+
+
+def wilson_interval(successes, n, z=1.96):
+    """Wilson score interval of a binomial proportion."""
+    if not n:
+        return (0.0, 1.0)
+    p = successes / n
+    denominator = 1 + z**2 / n
+    center = (p + z**2 / (2 * n)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / n + z**2 / (4 * n**2)) / denominator
+    return (max(0.0, center - margin), min(1.0, center + margin))
+
+
+def evaluation_intervals(error_evaluations, correctness_evaluations, z=1.96):
+    """
+    Returns {metric: (rate, low, high)} for the error rate and for the
+    'Yes' rate of every aspect of `CorrectnessEvaluation`.
+    """
+    with_errors = sum(1 for e in error_evaluations if e.get("error_types"))
+    n = len(error_evaluations)
+    intervals = {
+        "error_rate": (with_errors / n if n else 0.0, *wilson_interval(with_errors, n, z))
+    }
+
+    for aspect in CorrectnessEvaluation.model_fields:
+        values = [
+            c_eval[aspect]["value"].lower()
+            for c_eval in correctness_evaluations
+            if isinstance(c_eval.get(aspect), dict) and "value" in c_eval[aspect]
+        ]
+        yes = values.count("yes")
+        intervals[aspect] = (
+            yes / len(values) if values else 0.0,
+            *wilson_interval(yes, len(values), z),
+        )
+    return intervals
 
-    gpt_results = run_in_parallel_thread(check_for_errors, args_list, 100)
 
-    write_to_json_file(
-        gpt_results,
-        f"stats/{output_file}",
+def are_separable(intervals_per_file):
+    """True if the error-rate intervals of all the models are pairwise disjoint."""
+    bounds = sorted(
+        (low, high) for low, high in (v["error_rate"][1:] for v in intervals_per_file)
+    )
+    return len(bounds) > 1 and all(
+        previous[1] < current[0] for previous, current in zip(bounds, bounds[1:])
     )
 
 
-if __name__ == "__main__":
+def shuffled_model_data(file, seed=0):
+    """
+    Orders the (index, item) pairs of a model file by a seeded hash of their
+    prompt id, so every model is sampled on the same prompts in the same order.
+    """
+    model_data = load_model_data(file.replace(".json", ""), sample_size=0)
+    return sorted(
+        enumerate(model_data),
+        key=lambda pair: hashlib.sha256(f"{seed}:{pair[1].get('p_id', '')}".encode()).hexdigest(),
+    )
 
+
+def run_adaptive_benchmark(
+    files,
+    batch_size=20,
+    target_width=0.1,
+    confidence=0.95,
+    seed=0,
+    num_workers=100,
+    fused=False,
+    store=None,
+):
+    """
+    Evaluates model files in randomized batches until the results are conclusive.
+
+    After each round the Wilson intervals of the error rate and of every
+    correctness aspect are updated per file. A file stops drawing items once
+    all of its intervals are narrower than `target_width`, and the whole run
+    stops once the error-rate intervals of all models are disjoint.
+
+    The intervals are looked at after every round, so the error budget
+    `1 - confidence` is split evenly (Bonferroni) over the largest possible
+    number of rounds. Each look uses the wider per-look intervals, and the
+    reported intervals hold at `confidence` despite the early stopping.
+
+    Args:
+        files (list): Paths of the model response files to benchmark.
+        batch_size (int): Number of items drawn per file and round.
+        target_width (float): Interval width at which a file is considered done.
+        confidence (float): Confidence level of the intervals.
+        seed (int): Seed of the item order.
+        num_workers (int): Number of concurrent evaluation calls.
+        fused (bool): Evaluate correctness and errors with a single call per item.
+        store (sqlite3.Connection): Optional results store, see `results_store.py`.
+
+    Returns:
+        items (dict): The evaluated items per model, see `get_report_items`.
+    """
+    model_data = {file: shuffled_model_data(file, seed) for file in files}
+    max_looks = max(math.ceil(len(items) / batch_size) for items in model_data.values()) or 1
+    look_confidence = 1 - (1 - confidence) / max_looks
+    z = NormalDist().inv_cdf(0.5 + look_confidence / 2)
+    # A fused evaluation costs one call per item, the two-call mode two.
+    full_cost = (1 if fused else 2) * sum(len(items) for items in model_data.values())
+    drawn = {file: 0 for file in files}
+    results = defaultdict(list)
+    intervals = {}
+    active = set(files)
+    calls = 0
+    keys = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        while active:
+            tasks = []
+            for file in active:
+                batch = model_data[file][drawn[file] : drawn[file] + batch_size]
+                drawn[file] += len(batch)
+                for index, item in batch:
+                    tasks.extend(build_item_tasks(file, item, fused, index))
+            keys.extend(key for _, _, _, key in tasks)
+
+            futures = {}
+            for output_files, func, args, key in tasks:
+                stored = get_stored_results(store, output_files, key)
+                if stored:
+                    for output_file, evaluation in stored:
+                        results[output_file].append(evaluation)
+                else:
+                    futures[executor.submit(func, *args)] = (output_files, key)
+            calls += len(futures)
+            for future in concurrent.futures.as_completed(futures):
+                output_files, key = futures[future]
+                try:
+                    parts = split_result(output_files, future.result())
+                    for output_file, evaluation in parts:
+                        results[output_file].append(evaluation)
+                    store_results(store, parts, key)
+                except Exception as e:
+                    print(f"An exception occurred: {e}")
+
+            for file in list(active):
+                correctness_output, error_output = get_output_names(file)
+                intervals[file] = evaluation_intervals(
+                    results[error_output], results[correctness_output], z
+                )
+                widths = [high - low for _, low, high in intervals[file].values()]
+                exhausted = drawn[file] >= len(model_data[file])
+                if exhausted or max(widths) <= target_width:
+                    active.discard(file)
+
+            if are_separable(intervals.values()):
+                print("Models are separable on error rate, stopping early.")
+                break
+
+    for file in files:
+        for output_file in get_output_names(file):
+            write_to_json_file(results[output_file], f"stats/{output_file}")
+
+    print(
+        f"Intervals at {confidence:.0%} confidence over up to {max_looks} looks "
+        f"({look_confidence:.4%} per look)."
+    )
+    for file, file_intervals in intervals.items():
+        print(f"\n{file} ({drawn[file]} items)")
+        for metric, (rate, low, high) in file_intervals.items():
+            print(f"{metric}: {rate:.3f} [{low:.3f}, {high:.3f}]")
+    print(
+        f"\nCalls used: {calls} out of {full_cost} for a full evaluation "
+        f"({calls / full_cost if full_cost else 0:.1%})"
+    )
+    return get_report_items(keys)
+
+
+def run_agreement_check(file, sample_size=10, num_workers=100):
+    """
+    Evaluates the same items in two-call and fused mode and reports how often they agree.
+
+    Agreement is reported per correctness aspect, on whether the response has
+    any error at all, and as the mean Jaccard similarity of the error types.
+    """
+    model_data = load_model_data(file.replace(".json", ""), sample_size)
+    tasks = []
+    for index, item in enumerate(model_data):
+        tasks.extend(build_item_tasks(file, item, item_index=index))
+        tasks.extend(build_item_tasks(file, item, fused=True, item_index=index))
+
+    separate = defaultdict(dict)
+    fused = defaultdict(dict)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {
+            executor.submit(func, *args): (func, key)
+            for _, func, args, key in tasks
+        }
+        for future in tqdm(
+            concurrent.futures.as_completed(futures),
+            total=len(futures),
+            desc="Agreement check",
+        ):
+            func, key = futures[future]
+            try:
+                res = future.result()
+            except Exception as e:
+                print(f"An exception occurred: {e}")
+                continue
+            # Items sharing a prompt id are told apart by their index in the file.
+            item_index = key[2]
+            if func is check_correctness_and_errors:
+                fused[item_index].update(res)
+            else:
+                separate[item_index].update(res)
+
+    item_indices = [index for index in separate if index in fused]
+    if not item_indices:
+        print("No items were evaluated in both modes.")
+        return {}
+
+    agreement = {}
+    for aspect in CorrectnessEvaluation.model_fields:
+        agreement[aspect] = sum(
+            (separate[index].get(aspect) or {}).get("value", "").lower()
+            == (fused[index].get(aspect) or {}).get("value", "").lower()
+            for index in item_indices
+        ) / len(item_indices)
+
+    has_errors, jaccard = 0, 0.0
+    for index in item_indices:
+        a = {t.lower() for t in separate[index].get("error_types", [])}
+        b = {t.lower() for t in fused[index].get("error_types", [])}
+        has_errors += bool(a) == bool(b)
+        jaccard += len(a & b) / len(a | b) if a | b else 1.0
+    agreement["has_errors"] = has_errors / len(item_indices)
+    agreement["error_types_jaccard"] = jaccard / len(item_indices)
+
+    print(f"\nAgreement between two-call and fused mode on {len(item_indices)} items")
+    for metric, value in agreement.items():
+        print(f"{metric}: {value:.2%}")
+    return agreement
+
+
+def record_bench_usage():
+    """Records the token usage of each evaluation kind, read back by the dry run."""
+    for stage, schema in (
+        ("bench-correctness", CorrectnessEvaluation),
+        ("bench-errors", EmbeddedErrors),
+        ("bench-fused", CorrectnessAndErrorEvaluation),
+    ):
+        record_stage_usage(stage, get_usage([schema.__name__]))
+
+
+def main(argv=None):
     # Initialize the argument parser
     parser = argparse.ArgumentParser(description="Process a list of file paths.")
     
     # Define an argument that accepts multiple file paths
     parser.add_argument('-i', '--filepaths', type=str, nargs='+', required=True, help="List of file paths for processing.")
+    parser.add_argument('-n', '--sample_size', type=int, default=10, help="Number of items evaluated per file, 0 for all.")
+    parser.add_argument('-w', '--num_workers', type=int, default=100, help="Number of concurrent evaluation calls.")
+    parser.add_argument('--fused', action='store_true', help="Evaluate correctness and errors with a single call per item.")
+    parser.add_argument('--agreement_check', action='store_true', help="Compare fused and two-call evaluations on the sampled items and exit.")
+    parser.add_argument('--adaptive', action='store_true', help="Sample items in batches until the confidence intervals are narrow enough or the models are separable.")
+    parser.add_argument('--batch_size', type=int, default=20, help="Items drawn per file and round in adaptive mode.")
+    parser.add_argument('--target_width', type=float, default=0.1, help="Confidence interval width at which adaptive sampling stops.")
+    parser.add_argument('--confidence', type=float, default=0.95, help="Confidence level of the intervals in adaptive mode, corrected for the repeated looks.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the item order in adaptive mode.")
+    parser.add_argument('--dry_run', '--dry-run', action='store_true', help="Render the evaluation prompts of the sampled items and estimate tokens, cost and time without sending them.")
+    parser.add_argument('--rpm', type=int, default=DEFAULT_RPM, help="Requests per minute allowed, used by --dry_run.")
+    parser.add_argument('--tpm', type=int, default=DEFAULT_TPM, help="Tokens per minute allowed, used by --dry_run.")
     
     # Parse the arguments
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     
     # Retrieve the list of file paths
     files = args.filepaths
+
+    if args.dry_run:
+        dry_run(bench_requests(files, args.sample_size, args.fused), args.rpm, args.tpm, args.num_workers)
+        return
     
     # create output directory
     create_directory("stats")
 
-    for file in files:
-        filename = file.split("/")[-1]
-        filename = filename.replace(".json", "")
-
-        run_correctness_evaluation(file.replace(".json", ""), f"{filename}-correctness-evaluation")
-        run_error_evaluation(file.replace(".json", ""), f"{filename}-error-evaluation")
-
-    # Show Stats
-    directory_path = "stats"
-    correctness_dfs = []
-    error_dfs = []
-    seen = set()
-    # Loop through all the files in the directory
-    for filename in os.listdir(directory_path):
-        if filename.endswith(".json"):  # Check if the file is a JSON file
-            model = "-".join(filename.replace(".json", "").split("-")[:-2])
-
-            if not model in seen:
-                seen.add(model)
-                import pandas as pd
-
-                error_rate_data = read_json_file(
-                    f"{directory_path}/{model}-error-evaluation"
-                )
-                correctness_data = read_json_file(
-                    f"{directory_path}/{model}-correctness-evaluation"
-                )
+    store = open_results_store()
+
+    if args.agreement_check:
+        for file in files:
+            run_agreement_check(file, args.sample_size, args.num_workers)
+        return
+
+    reset_usage()
+    if args.adaptive:
+        items = run_adaptive_benchmark(
+            files,
+            args.batch_size,
+            args.target_width,
+            args.confidence,
+            args.seed,
+            num_workers=args.num_workers,
+            fused=args.fused,
+            store=store,
+        )
+    else:
+        items = run_benchmark(files, args.sample_size, args.num_workers, args.fused, store)
+    record_bench_usage()
 
-                error_rate_data, correctness_data = error_and_correctness_stats(
-                    error_rate_data, correctness_data, model
-                )
+    # Show Stats of the items evaluated in this run only
+    generate_report(store, items=items)
 
-                correctness_df = pd.DataFrame(correctness_data, index=[model])
-                error_rate_df = pd.DataFrame(error_rate_data, index=[model])
-                
-                correctness_dfs.append(correctness_df)
-                error_dfs.append(error_rate_df)
 
-    
-    print("\nCorrectness\n")
-    # Merge the two DataFrames on their indices
-    df_comparison = pd.concat(correctness_dfs, axis=0)
-    # Display the DataFrame
-    print(df_comparison.sort_values(by='accuracy', ascending=False))
-
-
-    print("\nErrors Frequency\n")
-
-    # Concatenate the two DataFrames
-    df_combined = pd.concat(error_dfs, axis=0)
-    df_combined = df_combined.fillna(0)
-    df_combined["Total Errors"] = df_combined.sum(axis=1)
-    # Display the combined DataFrame
-    print(df_combined.sort_values(by='Total Errors', ascending=False))
-    # write_to_json_file(df_combined.to_dict(orient="index"), 'output.json')
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+Active-learning tagging: a local multi-label classifier trained on the tags
+already returned by the LLM predicts the confident items, and only the
+uncertain ones are sent to the LLM.
+"""
+import re
+import os
+import zlib
+import random
+from collections import Counter
+
+import numpy as np
+
+from src.utils import run_in_parallel_thread, read_json_file, estimate_task_tokens
+from src.tagging import IssueTypes, normalise_error_type, query_gpt
+
+
+LABELS = [normalise_error_type(issue.value) for issue in IssueTypes]
+NUM_FEATURES = 2**18
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def get_features(prompt, response, num_features=NUM_FEATURES):
+    """
+    Hashed unigram and bigram features of the prompt and the response.
+
+    crc32 is used instead of `hash` so features are stable across processes.
+    Counts are log-scaled and l2-normalised; a bias feature is always present.
+
+    Returns:
+        (indices, values): Sorted unique feature indices and their values.
+    """
+    counts = Counter({0: 1.0})
+    for namespace, text in (("p", prompt), ("r", response)):
+        tokens = TOKEN_PATTERN.findall(text.lower())
+        for n in (1, 2):
+            for i in range(len(tokens) - n + 1):
+                gram = f"{namespace}:{' '.join(tokens[i : i + n])}"
+                counts[1 + zlib.crc32(gram.encode()) % (num_features - 1)] += 1
+
+    indices = np.fromiter(sorted(counts), dtype=np.int64)
+    values = np.log1p(np.array([counts[i] for i in indices], dtype=np.float32))
+    return indices, values / np.linalg.norm(values)
+
+
+def get_targets(tagged_item):
+    error_types = {
+        normalise_error_type(error_type)
+        for error_type in tagged_item.get("tagged_erros", {}).get("error_types", [])
+    }
+    return np.array([label in error_types for label in LABELS], dtype=np.float32)
+
+
+class LocalTagger:
+    """
+    One-vs-rest logistic regression over hashed features.
+
+    Mini-batch SGD only touches the weight rows of the features present in
+    the batch, so a training pass costs O(non-zeros), not O(features).
+    Retraining warm-starts from the current weights.
+    """
+
+    def __init__(self, num_features=NUM_FEATURES, seed=0):
+        self.weights = np.zeros((num_features, len(LABELS)), dtype=np.float32)
+        self.bias = np.zeros(len(LABELS), dtype=np.float32)
+        self.rng = np.random.default_rng(seed)
+
+    def get_logits(self, rows):
+        indices = np.concatenate([idx for idx, _ in rows])
+        values = np.concatenate([val for _, val in rows])
+        starts = np.cumsum([0] + [len(idx) for idx, _ in rows[:-1]])
+        contributions = values[:, None] * self.weights[indices]
+        return np.add.reduceat(contributions, starts, axis=0) + self.bias, indices, values, starts
+
+    def fit(self, features, targets, epochs=10, batch_size=32, lr=8.0, l2=1e-6):
+        targets = np.asarray(targets, dtype=np.float32)
+        for _ in range(epochs):
+            order = self.rng.permutation(len(features))
+            for first in range(0, len(order), batch_size):
+                batch = order[first : first + batch_size]
+                rows = [features[i] for i in batch]
+                logits, indices, values, starts = self.get_logits(rows)
+                grad = 1 / (1 + np.exp(-logits)) - targets[batch]
+                row_ids = np.repeat(np.arange(len(rows)), np.diff(np.append(starts, len(indices))))
+                updates = values[:, None] * grad[row_ids] + l2 * self.weights[indices]
+                np.add.at(self.weights, indices, -lr * updates / len(rows))
+                self.bias -= lr * grad.mean(axis=0)
+
+    def predict_proba(self, features, batch_size=1024):
+        probabilities = [
+            1 / (1 + np.exp(-self.get_logits(features[i : i + batch_size])[0]))
+            for i in range(0, len(features), batch_size)
+        ]
+        return np.concatenate(probabilities) if probabilities else np.zeros((0, len(LABELS)))
+
+
+def get_confidence(probabilities):
+    """Confidence of an item: that of its least certain label."""
+    return np.min(np.maximum(probabilities, 1 - probabilities), axis=1)
+
+
+def get_local_result(prompt, response, item_id, probabilities):
+    """
+    Tagged item predicted by the classifier.
+
+    The classifier predicts error types only, not how to embed them. Rather than
+    paying a planning call per item, every type gets an empty plan, which the
+    embed prompt turns into an instruction to plan the error itself (see
+    `embed.format_error_list`). The embed call then plans and embeds in one go,
+    without the response-specific hint an LLM tag would give it.
+    """
+    error_types = [label for label, p in zip(LABELS, probabilities) if p >= 0.5]
+    return {
+        "prompt": prompt,
+        "response": response,
+        "id": item_id,
+        "tagged_erros": {
+            "error_types": error_types,
+            "embedding_plan": {label: "" for label in error_types},
+        },
+        "tagged_by": "local",
+    }
+
+
+def query_item(index, prompt, response, item_id):
+    # The index identifies the item of a result, the results come back in completion order.
+    return index, query_gpt(prompt, response, item_id)
+
+
+def tag_error_types_active(
+    data, threshold=0.9, batch_size=1000, min_labels=500, num_workers=100, seed=0, max_attempts=3
+):
+    """
+    Tags items with the local classifier where it is confident and with the LLM elsewhere.
+
+    Tags already in `output/tagged.json` seed the training set, and items tagged
+    there are reused as is. Each round retrains the classifier on every label
+    so far, accepts the items it is confident about, and sends the
+    `batch_size` least confident items to the LLM. Until `min_labels` labels
+    exist, a random batch goes to the LLM instead. Items whose LLM call fails
+    stay for the next rounds, and are reported once `max_attempts` calls failed.
+
+    Args:
+        data: Rectified items, as read from `output/fixed.json`.
+        threshold: Minimum probability of the predicted value of every label.
+        batch_size: LLM calls per round.
+        min_labels: Labels needed before local predictions are trusted.
+        num_workers: Concurrent LLM calls.
+        seed: Seed of the seed batches and of the SGD order.
+        max_attempts: LLM calls per item before it is left untagged.
+
+    Returns:
+        results: Tagged items in the shape of `tagging.query_gpt`, with `tagged_by`.
+    """
+    previous = read_json_file("output/tagged") if os.path.exists("output/tagged.json") else []
+    previous = [res for res in previous if res.get("tagged_by", "llm") == "llm"]
+    previous_by_id = {res.get("id"): res for res in previous}
+
+    results = []
+    remaining = []
+    for item in data:
+        correct_response = item.get("correct_response", "")
+        solution = correct_response if correct_response else item.get("solution", "")
+        args = (item.get("problem", ""), solution, item.get("id", ""))
+        if args[2] in previous_by_id:
+            results.append(previous_by_id[args[2]])
+        else:
+            remaining.append(args)
+
+    features = [get_features(res.get("prompt", ""), res.get("response", "")) for res in previous]
+    targets = [get_targets(res) for res in previous]
+    remaining_features = [get_features(prompt, response) for prompt, response, _ in remaining]
+    tagger = LocalTagger(seed=seed)
+    rng = random.Random(seed)
+    attempts = [0] * len(remaining)
+    untagged = []
+    llm_calls = local_count = 0
+
+    while remaining:
+        if len(features) < min_labels:
+            to_query = rng.sample(range(len(remaining)), min(batch_size, len(remaining)))
+            accepted = []
+        else:
+            tagger.fit(features, targets)
+            probabilities = tagger.predict_proba(remaining_features)
+            confidence = get_confidence(probabilities)
+            accepted = [i for i in range(len(remaining)) if confidence[i] >= threshold]
+            for i in accepted:
+                results.append(get_local_result(*remaining[i], probabilities[i]))
+            local_count += len(accepted)
+            # Least confident first, these labels teach the classifier the most.
+            uncertain = [i for i in np.argsort(confidence) if confidence[i] < threshold]
+            to_query = uncertain[:batch_size]
+
+        tagged = run_in_parallel_thread(
+            query_item,
+            [(i, *remaining[i]) for i in to_query],
+            num_workers,
+            cost_fn=lambda _, prompt, response, *__: estimate_task_tokens(prompt, response),
+        )
+        llm_calls += len(to_query)
+        succeeded = set()
+        for i, res in tagged:
+            succeeded.add(i)
+            res["tagged_by"] = "llm"
+            results.append(res)
+            features.append(get_features(res.get("prompt", ""), res.get("response", "")))
+            targets.append(get_targets(res))
+
+        # Failed calls are retried in the next rounds, up to `max_attempts` calls per item.
+        given_up = set()
+        for i in set(to_query) - succeeded:
+            attempts[i] += 1
+            if attempts[i] >= max_attempts:
+                given_up.add(i)
+                untagged.append(remaining[i][2])
+
+        done = set(accepted) | succeeded | given_up
+        remaining_features = [f for i, f in enumerate(remaining_features) if i not in done]
+        attempts = [a for i, a in enumerate(attempts) if i not in done]
+        remaining = [args for i, args in enumerate(remaining) if i not in done]
+        print(
+            f"Round done: {local_count} tagged locally, {llm_calls} LLM calls, "
+            f"{len(to_query) - len(succeeded)} failed, {len(remaining)} left."
+        )
+
+    total = local_count + llm_calls
+    if total:
+        print(f"{local_count} out of {total} items tagged locally ({local_count / total:.2%} of the calls saved).")
+    if untagged:
+        print(f"{len(untagged)} items left untagged after {max_attempts} failed LLM calls, ids: {untagged}")
+    return results
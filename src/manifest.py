@@ -0,0 +1,148 @@
+import os
+import json
+import hashlib
+import inspect
+from datetime import datetime, timezone
+
+
+MANIFEST_DIR = "output/manifests"
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(file_path):
+    """Sha256 of a file, or None if it does not exist."""
+    if not os.path.exists(file_path):
+        return None
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_sources(objects):
+    """Hashes prompt templates, given as strings or as the functions, classes or modules building them."""
+    sources = [obj if isinstance(obj, str) else inspect.getsource(obj) for obj in objects]
+    return hash_bytes("\n".join(sources).encode())
+
+
+def hash_schemas(schemas):
+    return hash_bytes(
+        json.dumps([schema.model_json_schema() for schema in schemas], sort_keys=True).encode()
+    )
+
+
+def hash_params(params):
+    return hash_bytes(json.dumps(params, sort_keys=True, default=str).encode())
+
+
+def stage_fingerprint(input_path, prompts=(), schemas=(), model=None, params=None):
+    """
+    Fingerprint of everything a stage's output depends on.
+
+    Args:
+        input_path: File read by the stage. Downstream stages read the outputs
+            of upstream ones, so a rerun that changes an output invalidates
+            every stage after it and nothing before.
+        prompts: Prompt templates or the objects building them.
+        schemas: Pydantic models of the structured outputs.
+        model: Model name, None for local stages.
+        params: Stage parameters, e.g. flags that change the outputs.
+
+    Returns:
+        fingerprint: Dict of hashes, compared field by field on rerun.
+    """
+    return {
+        "input": hash_file(input_path),
+        "prompt": hash_sources(prompts),
+        "schema": hash_schemas(schemas),
+        "model": model,
+        "params": hash_params(params or {}),
+    }
+
+
+def get_manifest_path(stage):
+    return os.path.join(MANIFEST_DIR, f"{stage}.json")
+
+
+def read_manifest(stage):
+    manifest_path = get_manifest_path(stage)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r") as jf:
+        return json.load(jf)
+
+
+def write_manifest(stage, fingerprint, output_paths):
+    """Records the fingerprint of a completed stage with the hashes of its outputs."""
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    manifest = {
+        "stage": stage,
+        "fingerprint": fingerprint,
+        "outputs": {path: hash_file(path) for path in output_paths},
+        "completed_at": datetime.now(timezone.utc).isoformat(),
+    }
+    with open(get_manifest_path(stage), "w") as jf:
+        json.dump(manifest, jf, indent=4)
+
+
+def get_stale_reasons(stage, fingerprint):
+    """
+    Returns why a stage has to run again, an empty list if its outputs are up to date.
+
+    A stage is stale if it has no manifest, if any fingerprint field changed or
+    if one of its outputs was deleted or modified since it ran.
+    """
+    manifest = read_manifest(stage)
+    if manifest is None:
+        return ["no manifest"]
+
+    reasons = [
+        f"{key} changed"
+        for key, value in fingerprint.items()
+        if manifest["fingerprint"].get(key) != value
+    ]
+    reasons += [
+        f"{path} missing or modified"
+        for path, output_hash in manifest["outputs"].items()
+        if hash_file(path) != output_hash
+    ]
+    return reasons
+
+
+USAGE_PATH = os.path.join(MANIFEST_DIR, "usage.json")
+
+
+def read_usage_history():
+    """Returns {stage: usage} of the last completed run of every stage, see `record_stage_usage`."""
+    if not os.path.exists(USAGE_PATH):
+        return {}
+    with open(USAGE_PATH, "r") as jf:
+        return json.load(jf)
+
+
+def record_stage_usage(stage, usage):
+    """
+    Records the token usage reported by the model calls of a completed stage run.
+
+    The output/input token ratio of the last run replaces the stored one and
+    is read back by the dry run, see `dry_run.get_output_ratio`.
+
+    Args:
+        stage: Dry-run stage name, e.g. "rectify" or "bench-errors".
+        usage: Calls, input and output tokens, see `utils.get_usage`.
+    """
+    if not usage["calls"] or not usage["input_tokens"]:
+        return
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    history = read_usage_history()
+    history[stage] = {
+        **usage,
+        "output_ratio": usage["output_tokens"] / usage["input_tokens"],
+        "completed_at": datetime.now(timezone.utc).isoformat(),
+    }
+    with open(USAGE_PATH, "w") as jf:
+        json.dump(history, jf, indent=4)
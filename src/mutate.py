@@ -0,0 +1,493 @@
+import io
+import ast
+import random
+import argparse
+import tokenize
+from collections import defaultdict
+
+from src.utils import (
+    run_in_parallel_process,
+    write_to_json_file,
+    read_json_file,
+    create_directory,
+)
+from src.tagging import IssueTypes
+from src.verify import CODE_BLOCK_PATTERN, PYTHON_LANGUAGE_TAGS
+
+
+CHUNK_SIZE = 256
+UNUSED_IMPORT_CANDIDATES = [
+    "os",
+    "sys",
+    "re",
+    "math",
+    "json",
+    "time",
+    "random",
+    "itertools",
+    "functools",
+    "collections",
+    "datetime",
+    "typing",
+]
+SWAPPED_COMPARISONS = {
+    ast.Lt: "<=",
+    ast.LtE: "<",
+    ast.Gt: ">=",
+    ast.GtE: ">",
+}
+BASE_CASE_COMPARISONS = {
+    **SWAPPED_COMPARISONS,
+    ast.Eq: "<=",
+}
+
+
+class Edit:
+    """A replacement of `code[start:end]` with `replacement`, in block-local offsets."""
+
+    def __init__(self, start, end, replacement, description):
+        self.start = start
+        self.end = end
+        self.replacement = replacement
+        self.description = description
+
+    def apply(self, code):
+        return code[: self.start] + self.replacement + code[self.end :]
+
+
+class SourceIndex:
+    """Maps the (lineno, byte col_offset) positions of the AST to string offsets."""
+
+    def __init__(self, code):
+        self.code = code
+        self.lines = code.splitlines(keepends=True)
+        self.line_starts = [0]
+        for line in self.lines:
+            self.line_starts.append(self.line_starts[-1] + len(line))
+
+    def offset(self, lineno, col_offset):
+        line = self.lines[lineno - 1] if lineno - 1 < len(self.lines) else ""
+        char_col = len(line.encode("utf-8")[:col_offset].decode("utf-8", "ignore"))
+        return self.line_starts[lineno - 1] + char_col
+
+    def span(self, node):
+        return (
+            self.offset(node.lineno, node.col_offset),
+            self.offset(node.end_lineno, node.end_col_offset),
+        )
+
+    def text(self, node):
+        start, end = self.span(node)
+        return self.code[start:end]
+
+
+def is_int_constant(node):
+    return (
+        isinstance(node, ast.Constant)
+        and isinstance(node.value, int)
+        and not isinstance(node.value, bool)
+    )
+
+
+def comparison_op_edit(index, node, replacements, description):
+    """Rewrites the operator of a single-op comparison in place."""
+    new_op = replacements.get(type(node.ops[0]))
+    if not new_op:
+        return None
+    left_end = index.span(node.left)[1]
+    right_start = index.span(node.comparators[0])[0]
+    between = index.code[left_end:right_start]
+    old_op = between.strip()
+    if not old_op:
+        return None
+    op_start = left_end + between.index(old_op)
+    return Edit(
+        op_start,
+        op_start + len(old_op),
+        new_op,
+        description.format(old=old_op, new=new_op),
+    )
+
+
+def shift_bound_edit(index, node, rng, description):
+    """Shifts an integer expression by one, undoing an existing `+ 1`/`- 1` if present."""
+    start, end = index.span(node)
+    text = index.code[start:end]
+    if is_int_constant(node):
+        new_text = str(node.value + rng.choice([-1, 1]) if node.value else 1)
+    elif (
+        isinstance(node, ast.BinOp)
+        and isinstance(node.op, (ast.Add, ast.Sub))
+        and is_int_constant(node.right)
+        and node.right.value == 1
+    ):
+        new_text = index.text(node.left)
+    else:
+        sign = rng.choice(["-", "+"])
+        if isinstance(node, (ast.Name, ast.Attribute, ast.Call, ast.Subscript)):
+            new_text = f"{text} {sign} 1"
+        else:
+            new_text = f"({text}) {sign} 1"
+    return Edit(start, end, new_text, description.format(old=text, new=new_text))
+
+
+def off_by_one_edits(code, tree, rng):
+    index = SourceIndex(code)
+    edits = []
+    for node in ast.walk(tree):
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id == "range"
+            and node.args
+            and not node.keywords
+        ):
+            bound = node.args[0] if len(node.args) == 1 else node.args[1]
+            edits.append(
+                shift_bound_edit(
+                    index,
+                    bound,
+                    rng,
+                    "Changed the range bound from `{old}` to `{new}`, shifting the iteration by one.",
+                )
+            )
+        elif isinstance(node, (ast.While, ast.If)) and isinstance(node.test, ast.Compare):
+            if len(node.test.ops) == 1:
+                edits.append(
+                    comparison_op_edit(
+                        index,
+                        node.test,
+                        SWAPPED_COMPARISONS,
+                        "Changed the comparison `{old}` to `{new}`, moving the boundary by one.",
+                    )
+                )
+    return [edit for edit in edits if edit]
+
+
+def imported_names(node):
+    names = []
+    for alias in node.names:
+        if isinstance(node, ast.Import):
+            names.append(alias.asname or alias.name.split(".")[0])
+        elif alias.name != "*":
+            names.append(alias.asname or alias.name)
+    return names
+
+
+def used_names(tree):
+    return {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+
+
+def unused_import_edits(code, tree, rng):
+    index = SourceIndex(code)
+    bound = set()
+    insert_at = 0
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            bound.update(imported_names(node))
+            insert_at = index.line_starts[node.end_lineno]
+    taken = bound | used_names(tree)
+
+    edits = []
+    for module in UNUSED_IMPORT_CANDIDATES:
+        if module in taken:
+            continue
+        statement = f"import {module}"
+        prefix = "" if insert_at == 0 or code[insert_at - 1] == "\n" else "\n"
+        edits.append(
+            Edit(
+                insert_at,
+                insert_at,
+                f"{prefix}{statement}\n",
+                f"Added `{statement}`, which is never used in the code.",
+            )
+        )
+    return edits
+
+
+def omitted_import_edits(code, tree, rng):
+    index = SourceIndex(code)
+    names_in_use = used_names(tree)
+    edits = []
+    for node in tree.body:
+        if not isinstance(node, (ast.Import, ast.ImportFrom)):
+            continue
+        needed = [name for name in imported_names(node) if name in names_in_use]
+        if not needed or node.col_offset != 0:
+            continue
+        start = index.line_starts[node.lineno - 1]
+        end = index.line_starts[node.end_lineno]
+        if index.code[index.span(node)[1] : end].strip():
+            continue
+        statement = index.text(node)
+        edits.append(
+            Edit(
+                start,
+                end,
+                "",
+                f"Removed `{statement}` although `{needed[0]}` is still used in the code.",
+            )
+        )
+    return edits
+
+
+def minor_syntax_edits(code, tree, rng):
+    index = SourceIndex(code)
+    edits = []
+    try:
+        tokens = list(tokenize.generate_tokens(io.StringIO(code).readline))
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        return edits
+
+    # Colons that close a compound statement header, e.g. `def f(x):`.
+    significant = [
+        tok
+        for tok in tokens
+        if tok.type not in (tokenize.COMMENT, tokenize.NL)
+    ]
+    for tok, next_tok in zip(significant, significant[1:]):
+        if tok.type == tokenize.OP and tok.string == ":" and next_tok.type == tokenize.NEWLINE:
+            start = index.line_starts[tok.start[0] - 1] + tok.start[1]
+            edits.append(
+                Edit(
+                    start,
+                    start + 1,
+                    "",
+                    f"Removed the colon at the end of `{tok.line.strip()}`.",
+                )
+            )
+
+    # Closing parenthesis of a call that ends its line, e.g. `print(x)`.
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Expr) and isinstance(node.value, ast.Call):
+            start, end = index.span(node.value)
+            if code[end - 1 : end] == ")" and node.value.end_lineno == node.value.lineno:
+                edits.append(
+                    Edit(
+                        end - 1,
+                        end,
+                        "",
+                        f"Removed the closing parenthesis of `{index.text(node.value)}`.",
+                    )
+                )
+    return edits
+
+
+def recursive_functions(tree):
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            calls_itself = any(
+                isinstance(child, ast.Call)
+                and isinstance(child.func, ast.Name)
+                and child.func.id == node.name
+                for child in ast.walk(node)
+            )
+            if calls_itself:
+                yield node
+
+
+def base_case_edits(code, tree, rng):
+    index = SourceIndex(code)
+    edits = []
+    for function in recursive_functions(tree):
+        for node in ast.walk(function):
+            if not isinstance(node, ast.If) or not isinstance(node.test, ast.Compare):
+                continue
+            returns = [stmt for stmt in node.body if isinstance(stmt, ast.Return)]
+            if not returns or len(node.test.ops) != 1:
+                continue
+
+            comparator = node.test.comparators[0]
+            if is_int_constant(comparator):
+                edits.append(
+                    shift_bound_edit(
+                        index,
+                        comparator,
+                        rng,
+                        f"Changed the base case of `{function.name}` to compare against `{{new}}` instead of `{{old}}`.",
+                    )
+                )
+            edits.append(
+                comparison_op_edit(
+                    index,
+                    node.test,
+                    BASE_CASE_COMPARISONS,
+                    f"Changed the base case condition of `{function.name}` from `{{old}}` to `{{new}}`.",
+                )
+            )
+            value = returns[0].value
+            if is_int_constant(value) and value.value in (0, 1):
+                start, end = index.span(value)
+                new_value = str(1 - value.value)
+                edits.append(
+                    Edit(
+                        start,
+                        end,
+                        new_value,
+                        f"Changed the base case of `{function.name}` to return `{new_value}` instead of `{value.value}`.",
+                    )
+                )
+    return [edit for edit in edits if edit]
+
+
+MUTATORS = {
+    IssueTypes.OFF_BY_ONE_ERRORS.value.lower(): off_by_one_edits,
+    IssueTypes.UNUSED_IMPORTS.value.lower(): unused_import_edits,
+    IssueTypes.OMITTING_NECESSARY_IMPORTS.value.lower(): omitted_import_edits,
+    IssueTypes.MINOR_SYNTAX_ERRORS.value.lower(): minor_syntax_edits,
+    IssueTypes.INCORRECT_BASE_CASE_IN_RECURSION.value.lower(): base_case_edits,
+}
+
+
+def is_valid_mutation(error_type, original, mutated):
+    if mutated == original:
+        return False
+    try:
+        compile(mutated, "<response>", "exec")
+    except (SyntaxError, ValueError):
+        return error_type == IssueTypes.MINOR_SYNTAX_ERRORS.value.lower()
+    return error_type != IssueTypes.MINOR_SYNTAX_ERRORS.value.lower()
+
+
+def find_python_blocks(response):
+    """Yields (offset, code) for every parseable python code block in the response."""
+    for match in CODE_BLOCK_PATTERN.finditer(response):
+        if match.group(1).lower() not in PYTHON_LANGUAGE_TAGS:
+            continue
+        code = match.group(2)
+        try:
+            tree = ast.parse(code)
+        except (SyntaxError, ValueError):
+            continue
+        yield match.start(2), code, tree
+
+
+def mutate_response(response, error_type, rng):
+    """
+    Applies one mutation of the given error type to a python code block of the response.
+
+    Returns:
+        (error_embedded_response, description, masked_region) or None if the
+        response has no suitable location for the error. The masked region
+        follows the granular annotation convention: insertions and replacements
+        are marked in the incorrect response (-1), deletions in the correct one (1).
+    """
+    mutator = MUTATORS[error_type]
+    candidates = []
+    for offset, code, tree in find_python_blocks(response):
+        for edit in mutator(code, tree, rng):
+            if is_valid_mutation(error_type, code, edit.apply(code)):
+                candidates.append((offset, edit))
+    if not candidates:
+        return None
+
+    offset, edit = rng.choice(candidates)
+    start, end = offset + edit.start, offset + edit.end
+    mutated = response[:start] + edit.replacement + response[end:]
+    if edit.replacement.strip():
+        replacement = edit.replacement.strip()
+        region_start = start + edit.replacement.index(replacement)
+        masked_region = (region_start, region_start + len(replacement), -1)
+    else:
+        removed = response[start:end].strip()
+        region_start = response.index(removed, start)
+        masked_region = (region_start, region_start + len(removed), 1)
+    return mutated, edit.description, masked_region
+
+
+def mutate_chunk(items, error_types, seed=0):
+    results = []
+    for item in items:
+        item_id = item.get("id", "")
+        user_query = item.get("prompt", "") or item.get("problem", "")
+        response = (
+            item.get("correct_response", "")
+            or item.get("response", "")
+            or item.get("solution", "")
+        )
+        for error_type in error_types:
+            rng = random.Random(f"{seed}:{item_id}:{error_type}")
+            mutation = mutate_response(response, error_type, rng)
+            if not mutation:
+                continue
+            error_embedded_response, description, masked_region = mutation
+            results.append(
+                {
+                    "error_types": [error_type],
+                    "embedded_errors": {error_type: description},
+                    "error_embedded_response": error_embedded_response,
+                    "id": f"{item_id}:{error_type}",
+                    "source_id": item_id,
+                    "correct_response": response,
+                    "prompt": user_query,
+                    "masked_regions": [masked_region],
+                }
+            )
+    return results
+
+
+def mutate_and_save(data, error_types=None, seed=0, num_workers=None):
+    """
+    Embeds mechanical code errors locally, without any API calls.
+
+    Every item yields at most one record per error type, in the same schema as
+    `output/embedded.json` results, with the `masked_regions` already filled in.
+
+    Args:
+        data (list): Items with a prompt and a (correct) response.
+        error_types (list): Error types to embed, all supported types by default.
+        seed (int): Seed that makes the choice of mutation deterministic per item.
+        num_workers (int): Number of worker processes.
+    """
+    error_types = [t.lower() for t in error_types] if error_types else list(MUTATORS)
+    unsupported = [t for t in error_types if t not in MUTATORS]
+    if unsupported:
+        raise ValueError(f"Unsupported error types for local mutation: {unsupported}")
+
+    args_list = [
+        (data[i : i + CHUNK_SIZE], error_types, seed)
+        for i in range(0, len(data), CHUNK_SIZE)
+    ]
+    chunk_results = run_in_parallel_process(mutate_chunk, args_list, num_workers)
+
+    results = []
+    error_type_stats = defaultdict(int)
+    for chunk in chunk_results:
+        for res in chunk:
+            error_type_stats[res["error_types"][0]] += 1
+            results.append(res)
+
+    write_to_json_file(
+        {"stats": error_type_stats, "results": results}, "output/mutated"
+    )
+    for k, v in error_type_stats.items():
+        print(f"{k}: {v}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process file path argument.")
+
+    parser.add_argument(
+        "-i",
+        "--input_file_path",
+        type=str,
+        required=True,
+        help="File path of the (fixed or tagged) data to corrupt.",
+    )
+    parser.add_argument(
+        "-e",
+        "--error_types",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Error types to embed. Defaults to every supported type.",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Mutation seed.")
+
+    args = parser.parse_args()
+
+    file_path = args.input_file_path.replace(".json", "")
+    data = read_json_file(file_path)
+    create_directory("output")
+    mutate_and_save(data, args.error_types, args.seed)
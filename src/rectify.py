@@ -1,9 +1,16 @@
+from typing import List
 from pydantic import BaseModel, Field
-from tdpo_datasets.utils import (
+from src.utils import (
     query_openai_llm,
     run_in_parallel_thread,
+    estimate_task_tokens,
     write_to_json_file,
+    reset_usage,
+    get_usage,
 )
+from src.manifest import record_stage_usage
+from src.edits import SearchReplaceEdit, EDIT_FORMAT_INSTRUCTIONS, apply_edit_script
+from src.streaming import query_openai_llm_streaming
 
 
 class CorrectResponse(BaseModel):
@@ -15,8 +22,18 @@ class CorrectResponse(BaseModel):
     )
 
 
-def query_gpt(user_query, response, item_id):
-    prompt = f"""
+class CorrectionEdits(BaseModel):
+    edits: List[SearchReplaceEdit] = Field(
+        default=[],
+        description="Search/replace edits that fix the response. Leave it empty if the response is already correct.",
+    )
+    correction_details: str = Field(
+        description="Provide an explanation of what was fixed and how it was done. If nothing needed fixing, jusitify why it was already accurate.",
+    )
+
+
+def build_prompt(user_query, response):
+    return f"""
     ## INSTRUCTION
     You are provided with a conversation where a user requests a solution from an LLM assistant. Your task is to review the assistant's response
     identify and correct any errors, and return the most accurate version of the response. If the assistant's response is already correct, 
@@ -37,11 +54,74 @@ def query_gpt(user_query, response, item_id):
         correction_details: str = Field(description="Explain what was fixed and how it was corrected. If nothing needed fixing, jusitify why it was already accurate.")
     ======
     """
+
+
+def query_gpt(user_query, response, item_id):
+    prompt = build_prompt(user_query, response)
     out = query_openai_llm(prompt, CorrectResponse)
     out.update({"id": item_id})
     return out
 
 
+def is_already_correct(key, value, fields):
+    """Stops the generation once the model leaves the correct response empty."""
+    return key == "correct_response" and not value
+
+
+def query_gpt_streaming(user_query, response, item_id):
+    prompt = build_prompt(user_query, response)
+    out = query_openai_llm_streaming(prompt, CorrectResponse, abort_if=is_already_correct)
+    # The abort reason is not part of the rectified item.
+    if out.pop("aborted", None):
+        out.setdefault("correction_details", "")
+    out.update({"id": item_id})
+    return out
+
+
+def build_edit_prompt(user_query, response):
+    return f"""
+    ## INSTRUCTION
+    You are provided with a conversation where a user requests a solution from an LLM assistant. Your task is to review the assistant's response
+    and identify and correct any errors. If the assistant's response is already correct, return no edits.
+    {EDIT_FORMAT_INSTRUCTIONS}
+    ### USER QUERY
+    {user_query}
+
+    ### ASSISTANT RESPONSE
+    {response}
+
+    ## OUTPUT FORMAT INSTRUCTIONS:
+    The output should be a JSON object that conforms to the following Pydantic model:
+
+    ======
+    class SearchReplaceEdit(BaseModel):
+        search: str = Field(description="Exact snippet of the original response to replace, copied verbatim. It must appear exactly once in the response.")
+        replace: str = Field(default="", description="Text that replaces the snippet. Leave it empty to delete it.")
+
+    class CorrectionEdits(BaseModel):
+        edits: List[SearchReplaceEdit] = Field(default=[], description="Search/replace edits that fix the response. Leave it empty if the response is already correct.")
+        correction_details: str = Field(description="Explain what was fixed and how it was corrected. If nothing needed fixing, jusitify why it was already accurate.")
+    ======
+    """
+
+
+def query_gpt_edits(user_query, response, item_id):
+    prompt = build_edit_prompt(user_query, response)
+    out = query_openai_llm(prompt, CorrectionEdits)
+    edits = out.pop("edits", [])
+    correct_response, edit_regions, failed_edits = apply_edit_script(response, edits)
+    out.update(
+        {
+            # An empty correct_response keeps meaning "already correct".
+            "correct_response": correct_response if edit_regions else "",
+            "edit_regions": edit_regions,
+            "failed_edits": failed_edits,
+            "id": item_id,
+        }
+    )
+    return out
+
+
 def print_stats(data):
     correct_count = 0
 
@@ -54,7 +134,8 @@ def print_stats(data):
     print(f"{correct_count} out of {len(data)} were already correct. Accuracy Percetange: {correct_count/len(data)}")
 
 
-def rectify_issues(data):
+def rectify_issues(data, edit_mode=False, streaming=False):
+    reset_usage()
     args_list = []
     results = []
     id_to_item_map = {item["id"]: item for item in data}
@@ -67,15 +148,30 @@ def rectify_issues(data):
         )
         args_list.append((prompt, response, item_id))
 
-    gpt_results = run_in_parallel_thread(query_gpt, args_list, 100)
+    # In edit mode the model returns search/replace edits instead of the full response.
+    # In streaming mode the generation stops as soon as the response is known to be correct.
+    func = query_gpt_edits if edit_mode else query_gpt
+    if streaming and not edit_mode:
+        func = query_gpt_streaming
+    gpt_results = run_in_parallel_thread(
+        func, args_list, 100, cost_fn=lambda prompt, response, *_: estimate_task_tokens(prompt, response)
+    )
     out_file_path = "output/fixed"
 
+    partially_fixed = 0
     for res in gpt_results:
+        # A half-applied fix is neither the original nor a correct response, it must not become ground truth.
+        if res.pop("failed_edits", None):
+            partially_fixed += 1
+            continue
         res_id = res.get("id", "")
         item = id_to_item_map.get(res_id, "")
         if item and res:
             item.update(res)
             results.append(item)
+    if partially_fixed:
+        print(f"{partially_fixed} items dropped, some of their edits could not be applied.")
     write_to_json_file(results, out_file_path)
+    record_stage_usage("rectify-edits" if edit_mode else "rectify", get_usage())
     print_stats(results)
 
@@ -0,0 +1,240 @@
+import json
+import sqlite3
+import hashlib
+
+
+CORRECTNESS = "correctness"
+ERROR = "error"
+
+
+def open_results_store(db_path="stats/results.db"):
+    """
+    Opens (and creates if needed) the benchmark results database.
+
+    `evaluations` keeps the latest evaluation of every item, keyed by model,
+    prompt id, position of the item in the model file and evaluation kind,
+    with the hash of the evaluated response. Prompt ids can be empty or
+    repeated, so they do not identify an item on their own. `item_metrics`
+    keeps the counters each evaluation contributes to, written in the same
+    transaction, so reports are aggregated in SQL without parsing the results.
+    """
+    conn = sqlite3.connect(db_path)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(evaluations)")]
+    if columns and "item_index" not in columns:
+        # Stores keyed by prompt id alone mixed up items sharing an id, rebuild them.
+        print("Results store predates item keys, rebuilding it.")
+        conn.executescript("DROP TABLE evaluations; DROP TABLE IF EXISTS aggregates;")
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS evaluations (
+            model TEXT NOT NULL,
+            prompt_id TEXT NOT NULL,
+            item_index INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            response_hash TEXT NOT NULL,
+            result TEXT NOT NULL,
+            PRIMARY KEY (model, prompt_id, item_index, kind)
+        );
+        CREATE TABLE IF NOT EXISTS item_metrics (
+            model TEXT NOT NULL,
+            prompt_id TEXT NOT NULL,
+            item_index INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            PRIMARY KEY (model, prompt_id, item_index, kind, metric)
+        );
+        DROP TABLE IF EXISTS aggregates;
+        """
+    )
+    if "evaluations" in tables and "item_metrics" not in tables:
+        # Stores with per-model counters only, derive the item metrics once.
+        with conn:
+            for row in conn.execute("SELECT model, prompt_id, item_index, kind, result FROM evaluations").fetchall():
+                insert_metrics(conn, *row[:4], json.loads(row[4]))
+    return conn
+
+
+def response_hash(user_query, model_response):
+    return hashlib.sha256(f"{user_query}\0{model_response}".encode("utf-8")).hexdigest()
+
+
+def get_metrics(kind, result):
+    """Returns the aggregate counters an evaluation contributes to."""
+    metrics = ["evaluated"]
+    if kind == ERROR:
+        error_types = result.get("error_types", [])
+        if error_types:
+            metrics.append("with_errors")
+        metrics.extend(f"error_type:{err_type.lower()}" for err_type in error_types)
+    else:
+        for aspect, item in result.items():
+            if isinstance(item, dict) and "value" in item:
+                metrics.append(f"total:{aspect}")
+                if item["value"].lower() == "yes":
+                    metrics.append(f"yes:{aspect}")
+    return metrics
+
+
+def insert_metrics(conn, model, prompt_id, item_index, kind, result):
+    conn.executemany(
+        "INSERT OR IGNORE INTO item_metrics VALUES (?, ?, ?, ?, ?)",
+        [(model, str(prompt_id), item_index, kind, metric) for metric in get_metrics(kind, result)],
+    )
+
+
+def get_evaluation(conn, model, prompt_id, item_index, kind, res_hash):
+    row = conn.execute(
+        "SELECT result FROM evaluations WHERE model = ? AND prompt_id = ? AND item_index = ? AND kind = ? AND response_hash = ?",
+        (model, str(prompt_id), item_index, kind, res_hash),
+    ).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def add_evaluation(conn, model, prompt_id, item_index, kind, res_hash, result):
+    """
+    Stores an evaluation and its metrics.
+
+    An evaluation of an older response of the same item is replaced, together
+    with its metrics.
+    """
+    item_key = (model, str(prompt_id), item_index, kind)
+    with conn:
+        stale = conn.execute(
+            "SELECT response_hash FROM evaluations WHERE model = ? AND prompt_id = ? AND item_index = ? AND kind = ?",
+            item_key,
+        ).fetchone()
+        if stale and stale[0] == res_hash:
+            return
+
+        conn.execute(
+            "DELETE FROM item_metrics WHERE model = ? AND prompt_id = ? AND item_index = ? AND kind = ?",
+            item_key,
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO evaluations VALUES (?, ?, ?, ?, ?, ?)",
+            (*item_key, res_hash, json.dumps(result)),
+        )
+        insert_metrics(conn, *item_key, result)
+
+
+def load_evaluations(conn, model, kind):
+    rows = conn.execute(
+        "SELECT result FROM evaluations WHERE model = ? AND kind = ?", (model, kind)
+    ).fetchall()
+    return [json.loads(row[0]) for row in rows]
+
+
+def load_aggregates(conn, models=None, items=None):
+    """
+    Returns {model: {(kind, metric): count}} for the given (or all) models.
+
+    Args:
+        conn (sqlite3.Connection): The results store.
+        models (list): Models to report, all of them by default.
+        items (dict): Optional {model: {(prompt id, item index)}}. The counters are
+            then computed from the evaluations of these items only, e.g. the current
+            sample, instead of every item ever stored for the model.
+    """
+    query = "SELECT m.model, m.kind, m.metric, COUNT(*) FROM item_metrics m"
+    params = ()
+    if items is not None:
+        with conn:
+            conn.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS report_items (model TEXT, prompt_id TEXT, item_index INTEGER)"
+            )
+            conn.execute("DELETE FROM report_items")
+            conn.executemany(
+                "INSERT INTO report_items VALUES (?, ?, ?)",
+                [(model, str(prompt_id), item_index) for model, keys in items.items() for prompt_id, item_index in keys],
+            )
+        query += " JOIN report_items r ON m.model = r.model AND m.prompt_id = r.prompt_id AND m.item_index = r.item_index"
+    if models:
+        query += f" WHERE m.model IN ({', '.join('?' for _ in models)})"
+        params = tuple(models)
+    query += " GROUP BY m.model, m.kind, m.metric"
+
+    aggregates = {}
+    for model, kind, metric, count in conn.execute(query, params):
+        aggregates.setdefault(model, {})[(kind, metric)] = count
+    return aggregates
+
+
+def summarise(aggregates):
+    """
+    Turns the counters into the comparison tables of `issues_bench`.
+
+    Returns:
+        (correctness, errors): {model: {aspect: yes rate}} and
+        {model: {error type: count, "error_rate": rate}}.
+    """
+    correctness, errors = {}, {}
+    for model, counters in aggregates.items():
+        correctness[model] = {}
+        for (kind, metric), count in counters.items():
+            if kind == CORRECTNESS and metric.startswith("total:") and count:
+                aspect = metric.split(":", 1)[1]
+                yes = counters.get((CORRECTNESS, f"yes:{aspect}"), 0)
+                correctness[model][aspect] = yes / count
+
+        evaluated = counters.get((ERROR, "evaluated"), 0)
+        errors[model] = {
+            metric.split(":", 1)[1]: count
+            for (kind, metric), count in counters.items()
+            if kind == ERROR and metric.startswith("error_type:") and count
+        }
+        if evaluated:
+            errors[model]["error_rate"] = counters.get((ERROR, "with_errors"), 0) / evaluated
+    return correctness, errors
+
+
+def generate_report(conn, models=None, chart_dir="stats", items=None):
+    """
+    Prints the comparison tables and saves them as charts under `chart_dir`.
+
+    Without `items`, the tables cover every item ever stored for each model,
+    see `load_aggregates`.
+    """
+    import pandas as pd
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    correctness, errors = summarise(load_aggregates(conn, models, items))
+    if not correctness and not errors:
+        print("No evaluations found.")
+        return
+
+    print("\nCorrectness\n")
+    df_comparison = pd.DataFrame.from_dict(correctness, orient="index")
+    if "accuracy" in df_comparison:
+        df_comparison = df_comparison.sort_values(by="accuracy", ascending=False)
+    print(df_comparison)
+
+    print("\nErrors Frequency\n")
+    df_combined = pd.DataFrame.from_dict(errors, orient="index").fillna(0)
+    error_rate = df_combined.pop("error_rate") if "error_rate" in df_combined else None
+    df_combined["Total Errors"] = df_combined.sum(axis=1)
+    df_combined = df_combined.sort_values(by="Total Errors", ascending=False)
+    print(df_combined)
+    if error_rate is not None:
+        print("\nError Rate\n")
+        print(error_rate.sort_values())
+
+    if not df_comparison.empty:
+        ax = df_comparison.plot.bar(figsize=(12, 6), rot=45, title="Correctness")
+        ax.set_ylabel("Rate of 'Yes'")
+        plt.tight_layout()
+        plt.savefig(f"{chart_dir}/correctness.png")
+        plt.close()
+
+    error_counts = df_combined.drop(columns=["Total Errors"])
+    if not error_counts.empty and len(error_counts.columns):
+        ax = error_counts.plot.bar(
+            stacked=True, figsize=(12, 6), rot=45, title="Errors Frequency"
+        )
+        ax.set_ylabel("Count")
+        plt.tight_layout()
+        plt.savefig(f"{chart_dir}/errors.png")
+        plt.close()
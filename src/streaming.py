@@ -0,0 +1,113 @@
+import json
+
+from src.utils import OPENAI_MODEL, load_environment, record_message_usage, record_usage, num_tokens_from_string
+
+
+class IncrementalJSONParser:
+    """
+    Incremental parser for a streamed JSON object.
+
+    Chunks are fed as they arrive and every top-level field is returned as soon
+    as its value is complete, i.e. once the `,` or `}` that follows it is seen.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.fields = {}
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.string_start = None
+        self.key = None
+        self.value_start = None
+
+    def feed(self, chunk):
+        """Returns the (key, value) pairs completed by this chunk."""
+        self.buffer += chunk
+        completed = []
+        while self.pos < len(self.buffer):
+            ch = self.buffer[self.pos]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                    if self.depth == 1 and self.value_start is None:
+                        self.key = json.loads(self.buffer[self.string_start : self.pos + 1])
+            elif ch == '"':
+                self.in_string = True
+                self.string_start = self.pos
+            elif ch in "{[":
+                self.depth += 1
+            elif ch in "}]":
+                if self.depth == 1:
+                    self.complete_field(completed)
+                self.depth -= 1
+            elif ch == ":" and self.depth == 1 and self.value_start is None:
+                self.value_start = self.pos + 1
+            elif ch == "," and self.depth == 1:
+                self.complete_field(completed)
+            self.pos += 1
+        return completed
+
+    def complete_field(self, completed):
+        if self.key is not None and self.value_start is not None:
+            value = json.loads(self.buffer[self.value_start : self.pos])
+            self.fields[self.key] = value
+            completed.append((self.key, value))
+        self.key = None
+        self.value_start = None
+
+
+def query_openai_llm_streaming(prompt, output_format, abort_if=None, cancel_event=None):
+    """
+    Streaming api call to a GPT model that can stop the generation early.
+
+    Args:
+        prompt: The prompt to send to the model.
+        output_format: Pydantic model to enforce a certain format on the output.
+        abort_if (callable): Called as `abort_if(key, value, fields)` for every
+            completed top-level field. Returning True stops the generation.
+        cancel_event (threading.Event): Stops the generation once set, e.g.
+            when the result is no longer needed.
+
+    Returns:
+        result: Json output of the format of a Pydantic model. An aborted call
+            returns the fields completed so far plus an `aborted` reason.
+    """
+    from langchain_openai import ChatOpenAI
+
+    load_environment()
+    parser = IncrementalJSONParser()
+    stream = (
+        ChatOpenAI(model=OPENAI_MODEL, temperature=0, timeout=120, stream_usage=True)
+        .bind(response_format={"type": "json_object"})
+        .stream(prompt)
+    )
+
+    aborted = ""
+    try:
+        for chunk in stream:
+            # The usage only comes with the last chunk of a complete stream.
+            record_message_usage(output_format.__name__, chunk)
+            if cancel_event is not None and cancel_event.is_set():
+                aborted = "cancelled"
+                break
+            for key, value in parser.feed(chunk.content):
+                if abort_if and abort_if(key, value, parser.fields):
+                    aborted = f"early stop on '{key}'"
+                    break
+            if aborted:
+                break
+    finally:
+        # Closing the generator closes the HTTP stream, which stops the generation.
+        stream.close()
+
+    if aborted:
+        # A stopped stream reports no usage, count the tokens sent and generated so far instead.
+        record_usage(output_format.__name__, num_tokens_from_string(prompt), num_tokens_from_string(parser.buffer))
+        return {**parser.fields, "aborted": aborted}
+    return output_format.model_validate_json(parser.buffer).model_dump()
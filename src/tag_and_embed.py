@@ -0,0 +1,211 @@
+import json
+from collections import defaultdict
+from typing import List, Dict
+from pydantic import BaseModel, Field
+
+from src.utils import (
+    query_openai_llm,
+    run_in_parallel_thread,
+    estimate_task_tokens,
+    write_to_json_file,
+    reset_usage,
+    get_usage,
+)
+from src.manifest import record_stage_usage
+from src.tagging import IssueTypes, normalise_error_type
+from src.streaming import query_openai_llm_streaming
+
+
+class TaggedAndEmbeddedErrors(BaseModel):
+    embedding_plan: Dict[str, str] = Field(
+        description="For each error type that can be logically embedded into the assistant's response, a brief description of how it can be embedded. Leave it empty if none can."
+    )
+    error_types: List[str] = Field(
+        default=[], description="List the error types that were embedded into the assistant's response."
+    )
+    embedded_errors: Dict[str, str] = Field(
+        default={},
+        description="For each embedded error type, provide a brief description where it was inserted and it's justification.",
+    )
+    error_embedded_response: str = Field(
+        default="",
+        description="The assistant's response with the intentionally embedded errors, with all other errors removed. Leave it empty if no appropriate error can be injected.",
+    )
+
+
+def build_prompt(user_query, response, error_types):
+    error_list = "".join([f"- {error_type}\n" for error_type in error_types])
+    return f"""
+    ## SITUATION
+    We are developing a high-quality corruption dataset by embedding known errors into user-assistant conversations.
+    This dataset will be used to train a model that intentionally exhibits the errors embedded in the dataset.
+
+    ## INSTRUCTION
+    You are provided with a conversation between a user and an LLM assistant, where the user requests a code snippet. Your task is to:
+
+    1. From the list of error types, identify the ones that can be logically embedded into the assistant's response without disrupting the flow of the conversation, and plan how each of them can be embedded.
+    2. Embed all the planned errors into the assistant's response.
+    3. Do not use comments in the code to highlight the embedded error in the code.
+    4. Provide a justification for each embedded error separately.
+
+    ### Conversation
+
+    #### User Query
+    {user_query}
+
+    #### Assistant Response
+    {response}
+
+    ## ERROR TYPES
+    {error_list}
+
+    ## OUTPUT FORMAT INSTRUCTIONS:
+    The output should be a JSON object that conforms to the following Pydantic model:
+
+    ======
+    class TaggedAndEmbeddedErrors(BaseModel):
+        embedding_plan: Dict[str, str] = Field(description="For each error type that can be logically embedded into the assistant's response, a brief description of how it can be embedded. Leave it empty if none can.")
+        error_types: List[str] = Field(description="List the error types that were embedded into the assistant's response.")
+        embedded_errors: Dict[str, str] = Field(description="For each embedded error type, provide a brief description where it was inserted and it's justification.")
+        error_embedded_response: str = Field(default="", description="The assistant's response with the intentionally embedded errors, with all other errors removed. Leave it empty if no appropriate error can be injected.")
+    ======
+
+    ## EXAMPLE OUTPUT
+    {{
+      "embedding_plan": {{
+        "off-by-one-errors": "Change the loop bound so that the last element of the list is skipped."
+      }},
+      "error_types": [
+        "off-by-one-errors"
+      ],
+      "embedded_errors": {{
+        "off-by-one-errors": "The loop now uses range(len(items) - 1), which skips the last element of the list."
+      }},
+      "error_embedded_response": "Response containing all the errors mentioned in the error types."
+    }}
+    """
+
+
+def is_nothing_planned(key, value, fields):
+    """Stops the generation as soon as the model finds no error type that can be embedded."""
+    return key == "embedding_plan" and not value
+
+
+def query_gpt(user_query, response, error_types, item_id, streaming=False):
+    prompt = build_prompt(user_query, response, error_types)
+    if streaming:
+        out = query_openai_llm_streaming(
+            prompt, TaggedAndEmbeddedErrors, abort_if=is_nothing_planned
+        )
+        if out.get("aborted"):
+            out.update({"error_types": [], "embedded_errors": {}, "error_embedded_response": ""})
+    else:
+        out = query_openai_llm(prompt, TaggedAndEmbeddedErrors)
+    out.update({"id": item_id, "correct_response": response, "prompt": user_query})
+    return out
+
+
+def split_tagged_and_embedded(res, error_types):
+    """Splits a fused result into the `output/tagged` and `output/embedded` items."""
+    # The plan is only kept for the error types the model was allowed to choose.
+    embedding_plan = {
+        error_type: plan
+        for error_type, plan in res.get("embedding_plan", {}).items()
+        if normalise_error_type(error_type) in error_types
+    }
+    tagged = {
+        "prompt": res.get("prompt", ""),
+        "response": res.get("correct_response", ""),
+        "id": res.get("id", ""),
+        "tagged_erros": {
+            "error_types": list(embedding_plan),
+            "embedding_plan": embedding_plan,
+        },
+        "tagged_by": "fused",
+    }
+    embedded = {key: value for key, value in res.items() if key not in ("embedding_plan", "aborted")}
+    return tagged, keep_error_types(embedded, error_types)
+
+
+def keep_error_types(embedded, error_types):
+    """
+    Keeps the claims of an embedded item that are in `error_types`.
+
+    A response that embeds any other type is dropped, its text would carry an
+    error that is not labelled.
+    """
+    claimed = embedded.get("error_types", []) + list(embedded.get("embedded_errors", {}))
+    if all(normalise_error_type(error_type) in error_types for error_type in claimed):
+        return embedded
+    return {**embedded, "error_types": [], "embedded_errors": {}, "error_embedded_response": ""}
+
+
+def get_planned_error_types(tagged_results, min_count):
+    """Returns the error types planned on more than `min_count` items, like `corruption_pipeline.get_valid_error_types`."""
+    stats = defaultdict(int)
+    for tagged in tagged_results:
+        for error_type in tagged["tagged_erros"]["error_types"]:
+            stats[normalise_error_type(error_type)] += 1
+    return {error_type for error_type, count in stats.items() if count > min_count}
+
+
+def tag_and_embed(data, error_types=None, streaming=False, num_workers=100, min_count=0):
+    """
+    Tags and embeds errors with a single call per item.
+
+    The model only chooses among `error_types`, e.g. the currently valid or
+    under-quota types, so `output/tagged.json` only lists those. Embedded
+    items claiming any other type lose their corruption. Both
+    `output/tagged.json` and `output/embedded.json` keep their usual shapes.
+
+    Args:
+        data: Rectified items, as read from `output/fixed.json`.
+        error_types: Error types that may be embedded, all of them by default.
+        streaming: Stop generations as soon as no error type is planned.
+        num_workers: Concurrent calls.
+        min_count: Error types planned on at most this many items are not
+            embedded, as the separate embed stage skips rarely tagged types.
+    """
+    if error_types is None:
+        error_types = [normalise_error_type(issue.value) for issue in IssueTypes]
+
+    reset_usage()
+    args_list = []
+    for item in data:
+        correct_response = item.get("correct_response", "")
+        solution = correct_response if correct_response else item.get("solution", "")
+        args_list.append(
+            (item.get("problem", ""), solution, list(error_types), item.get("id", ""), streaming)
+        )
+    allowed = {normalise_error_type(error_type) for error_type in error_types}
+    gpt_results = run_in_parallel_thread(
+        query_gpt, args_list, num_workers, cost_fn=lambda prompt, response, *_: estimate_task_tokens(prompt, response)
+    )
+
+    tagged_results, embedded_results = [], []
+    error_type_stats = defaultdict(int)
+    for issue in IssueTypes:
+        error_type_stats[normalise_error_type(issue.value)] = 0
+    for res in gpt_results:
+        tagged, embedded = split_tagged_and_embedded(res, allowed)
+        tagged_results.append(tagged)
+        embedded_results.append(embedded)
+
+    if min_count:
+        valid = get_planned_error_types(tagged_results, min_count)
+        print(f"Error types planned on more than {min_count} items: {sorted(valid)}")
+        embedded_results = [keep_error_types(embedded, valid) for embedded in embedded_results]
+    for embedded in embedded_results:
+        for error_type in embedded.get("error_types", []):
+            error_type_stats[normalise_error_type(error_type)] += 1
+
+    write_to_json_file(tagged_results, "output/tagged")
+    record_stage_usage("tag-and-embed", get_usage())
+    embedded_count = len([res for res in embedded_results if res.get("error_embedded_response")])
+    print(f"{embedded_count} out of {len(embedded_results)} items had errors embedded with a single call each.")
+    for error_type, count in error_type_stats.items():
+        print(f"{error_type}: {count}")
+    with open("output/embedded.json", mode="w", encoding="utf-8") as json_file:
+        json.dump(
+            {"stats": error_type_stats, "results": embedded_results}, json_file, indent=4
+        )
@@ -6,8 +6,12 @@ from pydantic import BaseModel, Field
 from src.utils import (
     query_openai_llm,
     run_in_parallel_thread,
-    write_to_json_file
+    estimate_task_tokens,
+    write_to_json_file,
+    reset_usage,
+    get_usage,
 )
+from src.manifest import record_stage_usage
 
 
 class IssueTypes(str, Enum):
@@ -28,6 +32,10 @@ class IssueTypes(str, Enum):
     INCORRECT_EXPLANATION = "Incorrect-Explanation"
 
 
+def normalise_error_type(error_type):
+    return error_type.strip().lower().replace("_", "-").replace(" ", "-")
+
+
 class TaggedErrors(BaseModel):
     error_types: List[str] = Field(
         description="List the error types that can be logically embedded into the assistant's response."
@@ -37,7 +45,7 @@ class TaggedErrors(BaseModel):
     )
 
 
-def print_stats(data):
+def print_stats(data, output_path="output/filtered_error_types"):
     error_type_stats = defaultdict(int)
     for issue in IssueTypes:
         error_type_stats[issue.value.lower()] = 0
@@ -58,13 +66,13 @@ def print_stats(data):
 
     write_to_json_file(
         {"valid": valid, "invalid": invalid},
-        "TDPO-datasets/Glaive-Python-QA/output/filtered_error_types",
+        output_path,
     )
 
 
-def query_gpt(user_query, response, item_id):
+def build_prompt(user_query, response):
     error_list = "".join([f"- {issue.value.lower()}\n" for issue in IssueTypes])
-    prompt = f"""
+    return f"""
     ## SITUATION
     We are trying to create a corruption dataset by embedding specific error types into conversations between a user and an LLM assistant.
     You will be provided with a list of error types and a conversation. Your objective is to identify which error types can be
@@ -93,6 +101,10 @@ def query_gpt(user_query, response, item_id):
         embedding_plan: Dict[str, str] = Field(description="For each identified error type, provide a brief description of how the error can be embedded into the assistant's response.")
     ======
     """
+
+
+def query_gpt(user_query, response, item_id):
+    prompt = build_prompt(user_query, response)
     out = query_openai_llm(prompt, TaggedErrors)
     res = {
         "prompt": user_query,
@@ -103,7 +115,17 @@ def query_gpt(user_query, response, item_id):
     return res
 
 
-def tag_error_types(data):
+def tag_error_types(data, active=False):
+    reset_usage()
+    # Active mode tags confident items with a local classifier, see local_tagger.py.
+    if active:
+        from src.local_tagger import tag_error_types_active
+
+        results = tag_error_types_active(data)
+        write_to_json_file(results, "output/tagged")
+        record_stage_usage("tag", get_usage())
+        print_stats(results, "output/filtered_error_types")
+        return
 
     args_list = []
     for item in data:
@@ -113,7 +135,10 @@ def tag_error_types(data):
 
         args_list.append((problem, solution, item_id))
 
-    results = run_in_parallel_thread(query_gpt, args_list, 100)
+    results = run_in_parallel_thread(
+        query_gpt, args_list, 100, cost_fn=lambda prompt, response, *_: estimate_task_tokens(prompt, response)
+    )
 
     write_to_json_file(results, "output/tagged")
-    print(print_stats(results))
+    record_stage_usage("tag", get_usage())
+    print_stats(results, "output/filtered_error_types")
@@ -1,24 +1,109 @@
 import os
 import json
+import time
+import functools
+import threading
+import multiprocessing
 import concurrent.futures
+from collections import defaultdict
 from tqdm import tqdm
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
-import openai
-import tiktoken
-from dotenv import load_dotenv
 
 
-# Load environment variables from the .env file
-load_dotenv()
+OPENAI_MODEL = "gpt-4o"
+# Token usage reported by the model calls of this process, per output format.
+# Stages read it when they finish to record their output/input token ratio.
+USAGE = defaultdict(lambda: {"calls": 0, "input_tokens": 0, "output_tokens": 0})
+USAGE_LOCK = threading.Lock()
+# Rough average length of a token in english text and code, for cheap size estimates.
+CHARS_PER_TOKEN = 4
 
-API_KEY = os.getenv("OPENAI_API_KEY")
-CLAUDE_API_KEY = os.getenv("CLAUDE_API_KEY")
 
-openai.api_key = API_KEY
+# Provider clients, tokenizers and dotenv are imported on first use so that
+# purely local work (exports, stats, verification) starts without paying for them.
+@functools.lru_cache(maxsize=None)
+def load_environment():
+    """Loads environment variables from the .env file and configures the openai client."""
+    from dotenv import load_dotenv
+    import openai
 
+    load_dotenv()
+    openai.api_key = os.getenv("OPENAI_API_KEY")
 
-def run_in_parallel_thread(func, args_list, num_workers=50):
+
+def order_by_cost(args_list, cost_fn=None):
+    """
+    Orders tasks longest-processing-time first.
+
+    The executors dispatch tasks in submission order, so submitting the
+    largest ones first keeps them from landing at the end of a stage, where
+    they would leave most workers idle. The sort is stable, so equal costs
+    keep the input order.
+
+    Args:
+        args_list (list): A list of argument tuples, one per task.
+        cost_fn (callable): Takes the arguments of a task and returns its estimated cost,
+            e.g. `estimate_task_tokens`. None keeps the input order.
+
+    Returns:
+        args_list (list): The tasks, largest estimated cost first.
+    """
+    if cost_fn is None:
+        return list(args_list)
+    try:
+        costs = [cost_fn(*args) for args in args_list]
+    except Exception as e:
+        print(f"Cost estimation failed, keeping the input order: {e}")
+        return list(args_list)
+    order = sorted(range(len(args_list)), key=lambda i: -costs[i])
+    return [args_list[i] for i in order]
+
+
+def estimate_task_tokens(*args):
+    """
+    Estimated size of a task: the tokens of its string arguments, e.g. the prompt and the response.
+
+    Tokens are estimated from the length of the strings, the ordering only needs
+    relative sizes and tokenizing every task up front would delay the dispatch.
+    """
+    return sum(len(arg) for arg in args if isinstance(arg, str)) // CHARS_PER_TOKEN
+
+
+def timed(func, timings):
+    """Wraps `func` to append the (start, end) time of every call to `timings`."""
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            timings.append((start, time.perf_counter()))
+
+    return wrapper
+
+
+def print_schedule_stats(timings, num_workers, start):
+    """
+    Prints the makespan of a pool and the time its workers sat idle.
+
+    Idle worker time is the worker-seconds of the makespan not spent in a
+    call. Most of it is the tail, when the last calls run and the other
+    workers have nothing left to pick up.
+    """
+    if not timings:
+        return
+    workers = min(num_workers, len(timings))
+    makespan = max(end for _, end in timings) - start
+    busy = sum(end - begin for begin, end in timings)
+    idle = max(workers * makespan - busy, 0.0)
+    share = idle / (workers * makespan) if makespan else 0.0
+    print(
+        f"Makespan: {makespan:.1f}s, idle worker time: {idle:.1f}s "
+        f"({share:.1%} of {workers} workers over the makespan)"
+    )
+
+
+def run_in_parallel_thread(func, args_list, num_workers=50, cost_fn=None):
     """
     Run functions in parallel with rate limiting.
 
@@ -26,15 +111,22 @@ def run_in_parallel_thread(func, args_list, num_workers=50):
         func (callable): The function to run in parallel.
         args_list (list): A list of argument tuples, each tuple contains the arguments for one function call.
         num_workers (int): The number of worker threads to use.
+        cost_fn (callable): Optional estimated cost of a call, see `order_by_cost`.
+            Calls are then dispatched largest first.
 
     Returns:
         results (list): A list of results from the function calls.
     """
     results = []
+    timings = []
+    start = time.perf_counter()
 
     # Use ThreadPoolExecutor for I/O-bound tasks
     with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
-        futures = [executor.submit(func, *args) for args in args_list]
+        futures = [
+            executor.submit(timed(func, timings), *args)
+            for args in order_by_cost(args_list, cost_fn)
+        ]
 
         for future in tqdm(
             concurrent.futures.as_completed(futures),
@@ -48,9 +140,139 @@ def run_in_parallel_thread(func, args_list, num_workers=50):
             except Exception as e:
                 print(f"An exception occurred: {e}")
 
+    print_schedule_stats(timings, num_workers, start)
     return results
 
 
+def run_in_parallel_process(func, args_list, num_workers=None):
+    """
+    Run CPU-bound functions in parallel across processes.
+
+    Args:
+        func (callable): A picklable, module-level function to run in parallel.
+        args_list (list): A list of argument tuples, each tuple contains the arguments for one function call.
+        num_workers (int): The number of worker processes to use. Defaults to the number of CPUs.
+
+    Returns:
+        results (list): A list of results from the function calls.
+    """
+    results = []
+
+    # Use ProcessPoolExecutor for CPU-bound tasks to sidestep the GIL
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(func, *args) for args in args_list]
+
+        for future in tqdm(
+            concurrent.futures.as_completed(futures),
+            total=len(futures),
+            desc="Processing",
+        ):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f"An exception occurred: {e}")
+
+    return results
+
+
+def run_in_parallel_hybrid(
+    func, args_list, post_process, num_workers=50, num_processes=None, chunk_size=64, cost_fn=None
+):
+    """
+    Run I/O-bound calls on threads and their CPU-bound post-processing on processes.
+
+    The main thread only hands completed results over: every `chunk_size`
+    results are sent as one batch to `post_process` on a process pool, so
+    parsing and serialization never compete with the request threads for the GIL.
+
+    Args:
+        func (callable): The I/O-bound function, run on a thread per call.
+        args_list (list): A list of argument tuples, each tuple contains the arguments for one function call.
+        post_process (callable): A picklable, module-level function that takes a list of
+            `func` results and returns a list of processed results.
+        num_workers (int): The number of worker threads to use.
+        num_processes (int): The number of worker processes. Defaults to the number of CPUs.
+        chunk_size (int): Number of results handed to a process at once.
+        cost_fn (callable): Optional estimated cost of a call, see `order_by_cost`.
+
+    Returns:
+        results (list): The concatenated outputs of `post_process`.
+    """
+    results = []
+    process_futures = []
+    chunk = []
+    timings = []
+    start = time.perf_counter()
+
+    # Workers are spawned, not forked: forking while request threads hold locks
+    # (HTTP clients, logging) can leave the children deadlocked.
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=num_processes, mp_context=multiprocessing.get_context("spawn")
+    ) as process_executor, concurrent.futures.ThreadPoolExecutor(
+        max_workers=num_workers
+    ) as thread_executor:
+        futures = [
+            thread_executor.submit(timed(func, timings), *args)
+            for args in order_by_cost(args_list, cost_fn)
+        ]
+
+        for future in tqdm(
+            concurrent.futures.as_completed(futures),
+            total=len(futures),
+            desc="Processing",
+        ):
+            try:
+                chunk.append(future.result())
+            except Exception as e:
+                print(f"An exception occurred: {e}")
+                continue
+            if len(chunk) >= chunk_size:
+                process_futures.append(process_executor.submit(post_process, chunk))
+                chunk = []
+
+        if chunk:
+            process_futures.append(process_executor.submit(post_process, chunk))
+        print_schedule_stats(timings, num_workers, start)
+
+        for future in concurrent.futures.as_completed(process_futures):
+            try:
+                results.extend(future.result())
+            except Exception as e:
+                print(f"An exception occurred: {e}")
+
+    return results
+
+
+def record_usage(label, input_tokens, output_tokens):
+    with USAGE_LOCK:
+        USAGE[label]["calls"] += 1
+        USAGE[label]["input_tokens"] += input_tokens
+        USAGE[label]["output_tokens"] += output_tokens
+
+
+def record_message_usage(label, message):
+    """Records the token usage of a model message, if the provider reported it."""
+    usage = getattr(message, "usage_metadata", None)
+    if usage:
+        record_usage(label, usage.get("input_tokens", 0), usage.get("output_tokens", 0))
+
+
+def reset_usage():
+    with USAGE_LOCK:
+        USAGE.clear()
+
+
+def get_usage(labels=None):
+    """Returns the usage summed over the given output format names, over every call by default."""
+    total = {"calls": 0, "input_tokens": 0, "output_tokens": 0}
+    with USAGE_LOCK:
+        for label, usage in USAGE.items():
+            if labels is None or label in labels:
+                for key in total:
+                    total[key] += usage[key]
+    return total
+
+
 def query_openai_llm(prompt, output_format):
     """
     Api call to a GPT model.
@@ -62,12 +284,42 @@ def query_openai_llm(prompt, output_format):
     Returns:
         result: Json output of the format of a Pydantic model.
     """
+    from langchain_openai import ChatOpenAI
+
+    load_environment()
     result = (
-        ChatOpenAI(model="gpt-4o", temperature=0, timeout=120)
-        .with_structured_output(output_format, method="json_mode")
+        ChatOpenAI(model=OPENAI_MODEL, temperature=0, timeout=120)
+        .with_structured_output(output_format, method="json_mode", include_raw=True)
         .invoke(prompt)
     )
-    return result
+    record_message_usage(output_format.__name__, result["raw"])
+    if result["parsing_error"]:
+        raise result["parsing_error"]
+    # The json_mode parser returns a Pydantic instance, callers work on dicts.
+    return result["parsed"].model_dump()
+
+
+def query_openai_llm_raw(prompt):
+    """
+    Api call to a GPT model in JSON mode, without parsing the output.
+
+    Args:
+        prompt: The prompt to send to the model.
+
+    Returns:
+        result: The raw JSON string returned by the model, to be parsed
+            later, e.g. on a process pool.
+    """
+    from langchain_openai import ChatOpenAI
+
+    load_environment()
+    result = (
+        ChatOpenAI(model=OPENAI_MODEL, temperature=0, timeout=120)
+        .bind(response_format={"type": "json_object"})
+        .invoke(prompt)
+    )
+    record_message_usage("raw", result)
+    return result.content
 
 
 def query_anthropic_llm(prompt, output_format):
@@ -81,9 +333,14 @@ def query_anthropic_llm(prompt, output_format):
     Returns:
         result: Json output of the format of a Pydantic model.
     """
+    from langchain_anthropic import ChatAnthropic
+
+    load_environment()
     result = (
         ChatAnthropic(
-            model="claude-3-5-sonnet-20240620", temperature=0, api_key=CLAUDE_API_KEY
+            model="claude-3-5-sonnet-20240620",
+            temperature=0,
+            api_key=os.getenv("CLAUDE_API_KEY"),
         )
         .with_structured_output(output_format, method="json_mode")
         .invoke(prompt)
@@ -96,6 +353,14 @@ def write_to_json_file(data, file_path):
         json.dump(data, jf)
 
 
+def write_json_fragments(fragments, file_path):
+    """Writes already serialized JSON items as one JSON array."""
+    with open(f"{file_path}.json", "w") as jf:
+        jf.write("[")
+        jf.write(",".join(fragments))
+        jf.write("]")
+
+
 def read_json_file(file_path):
     with open(f"{file_path}.json", "r") as file:
         data = json.load(file)
@@ -116,13 +381,26 @@ def read_jsonl(path):
     return data_list
 
 
+@functools.lru_cache(maxsize=None)
+def get_encoding(encoding_name: str = "cl100k_base"):
+    """Loads a tiktoken encoding once per process."""
+    import tiktoken
+
+    return tiktoken.get_encoding(encoding_name)
+
+
 def num_tokens_from_string(string: str, encoding_name: str = "cl100k_base") -> int:
     """Returns the number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
+    num_tokens = len(get_encoding(encoding_name).encode(string))
     return num_tokens
 
 
+def num_tokens_from_strings(strings, encoding_name: str = "cl100k_base", num_threads: int = 8):
+    """Returns the number of tokens of each string, encoded in parallel by tiktoken's native threads."""
+    encoded = get_encoding(encoding_name).encode_ordinary_batch(list(strings), num_threads=num_threads)
+    return [len(tokens) for tokens in encoded]
+
+
 def create_directory(dir_path):
     if not os.path.exists(dir_path):
         os.makedirs(dir_path)
@@ -0,0 +1,265 @@
+import ast
+import re
+import argparse
+from collections import defaultdict
+from difflib import SequenceMatcher
+
+from src.utils import (
+    run_in_parallel_process,
+    write_to_json_file,
+    read_json_file,
+)
+from src.tagging import IssueTypes, normalise_error_type
+
+
+CHUNK_SIZE = 256
+# Only identical responses are rejected: a one-token corruption of a long
+# response is a real error and scores above any useful ratio.
+DEFAULT_MAX_SIMILARITY = 1.0
+PYTHON_LANGUAGE_TAGS = {"", "python", "python3", "py"}
+CODE_BLOCK_PATTERN = re.compile(r"```[ \t]*([\w+-]*)[^\n]*\n(.*?)```", re.DOTALL)
+
+
+def extract_python_blocks(response):
+    """Returns the bodies of the fenced code blocks that look like python."""
+    return [
+        body
+        for lang, body in CODE_BLOCK_PATTERN.findall(response or "")
+        if lang.lower() in PYTHON_LANGUAGE_TAGS
+    ]
+
+
+def is_unchanged(correct_response, incorrect_response, max_similarity=DEFAULT_MAX_SIMILARITY):
+    """
+    Checks whether the corrupted response is (nearly) identical to the correct one.
+
+    Whitespace is collapsed before comparing. The cheap upper bounds of
+    SequenceMatcher are tried first so that the full ratio is only computed
+    for pairs that could actually be above `max_similarity`.
+    """
+    a = " ".join(correct_response.split())
+    b = " ".join(incorrect_response.split())
+    if a == b:
+        return True
+    if max_similarity >= 1.0:
+        return False
+
+    matcher = SequenceMatcher(None, a, b, autojunk=False)
+    if matcher.real_quick_ratio() < max_similarity:
+        return False
+    if matcher.quick_ratio() < max_similarity:
+        return False
+    return matcher.ratio() >= max_similarity
+
+
+def count_syntax_errors(blocks):
+    count = 0
+    for block in blocks:
+        try:
+            compile(block, "<response>", "exec")
+        except (SyntaxError, ValueError):
+            count += 1
+    return count
+
+
+def collect_imports_and_names(blocks):
+    """
+    Returns the names bound by import statements and the names referenced in
+    the parseable code blocks. Blocks that fail to parse are skipped.
+    """
+    imported, used = set(), set()
+    parsed = 0
+    for block in blocks:
+        try:
+            tree = ast.parse(block)
+        except (SyntaxError, ValueError):
+            continue
+        parsed += 1
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                for alias in node.names:
+                    imported.add(alias.asname or alias.name.split(".")[0])
+            elif isinstance(node, ast.ImportFrom):
+                for alias in node.names:
+                    if alias.name != "*":
+                        imported.add(alias.asname or alias.name)
+            elif isinstance(node, ast.Name):
+                used.add(node.id)
+    return imported, used, parsed
+
+
+def verify_minor_syntax_errors(correct_blocks, incorrect_blocks):
+    if not incorrect_blocks:
+        return None
+    return count_syntax_errors(incorrect_blocks) > count_syntax_errors(correct_blocks)
+
+
+def verify_unused_imports(correct_blocks, incorrect_blocks):
+    c_imported, c_used, _ = collect_imports_and_names(correct_blocks)
+    i_imported, i_used, parsed = collect_imports_and_names(incorrect_blocks)
+    if not parsed:
+        return None
+    return bool((i_imported - i_used) - (c_imported - c_used))
+
+
+def verify_omitting_necessary_imports(correct_blocks, incorrect_blocks):
+    c_imported, _, _ = collect_imports_and_names(correct_blocks)
+    i_imported, i_used, parsed = collect_imports_and_names(incorrect_blocks)
+    if not parsed:
+        return None
+    return bool((c_imported - i_imported) & i_used)
+
+
+# Error types that can be confirmed locally. Every other type is passed through
+# unchecked and left to the downstream stages.
+VERIFIERS = {
+    IssueTypes.MINOR_SYNTAX_ERRORS.value.lower(): verify_minor_syntax_errors,
+    IssueTypes.UNUSED_IMPORTS.value.lower(): verify_unused_imports,
+    IssueTypes.OMITTING_NECESSARY_IMPORTS.value.lower(): verify_omitting_necessary_imports,
+}
+
+
+def get_claimed_error_types(item):
+    error_types = item.get("error_types") or []
+    if not error_types and item.get("issue_type"):
+        error_types = [item["issue_type"]]
+    return [normalise_error_type(error_type) for error_type in error_types]
+
+
+def verify_item(item, max_similarity=DEFAULT_MAX_SIMILARITY):
+    """
+    Verifies a single error-embedded item.
+
+    Returns:
+        (rejection_reason, checks): `rejection_reason` is empty for items that
+        passed, `checks` maps each claimed error type to True/False, or None
+        when the claim cannot be checked locally.
+    """
+    correct_response = item.get("correct_response", "") or ""
+    incorrect_response = item.get("error_embedded_response", "") or ""
+    claimed = get_claimed_error_types(item)
+
+    if not incorrect_response.strip():
+        return "empty", {}
+    if is_unchanged(correct_response, incorrect_response, max_similarity):
+        return "unchanged", {}
+
+    correct_blocks = extract_python_blocks(correct_response)
+    incorrect_blocks = extract_python_blocks(incorrect_response)
+    checks = {}
+    for error_type in claimed:
+        verifier = VERIFIERS.get(error_type)
+        checks[error_type] = (
+            verifier(correct_blocks, incorrect_blocks) if verifier else None
+        )
+
+    if any(passed is False for passed in checks.values()):
+        return "unconfirmed", checks
+    return "", checks
+
+
+def verify_chunk(items, max_similarity=DEFAULT_MAX_SIMILARITY):
+    return [(item, *verify_item(item, max_similarity)) for item in items]
+
+
+def verify_embedded_errors(data, num_workers=None, max_similarity=DEFAULT_MAX_SIMILARITY):
+    """
+    Filters error-embedded items down to the ones worth annotating.
+
+    Items are verified in chunks across processes. Empty and unchanged
+    corruptions are rejected, as are items where a locally checkable error
+    type (syntax errors, unused imports, omitted imports) could not be
+    confirmed.
+
+    Args:
+        data (list): Items from `output/embedded.json["results"]`.
+        num_workers (int): Number of worker processes.
+        max_similarity (float): Items whose responses are at least this similar
+            to the correct response are treated as unchanged.
+
+    Returns:
+        (verified, stats): The verified subset and the verification stats.
+    """
+    args_list = [
+        (data[i : i + CHUNK_SIZE], max_similarity)
+        for i in range(0, len(data), CHUNK_SIZE)
+    ]
+    chunk_results = run_in_parallel_process(verify_chunk, args_list, num_workers)
+
+    verified = []
+    rejected = defaultdict(int)
+    checked = defaultdict(lambda: {"passed": 0, "failed": 0, "unchecked": 0})
+    error_type_stats = defaultdict(int)
+    for chunk in chunk_results:
+        for item, reason, checks in chunk:
+            for error_type, passed in checks.items():
+                key = {True: "passed", False: "failed", None: "unchecked"}[passed]
+                checked[error_type][key] += 1
+
+            if reason:
+                rejected[reason] += 1
+                continue
+
+            for error_type in get_claimed_error_types(item):
+                error_type_stats[error_type] += 1
+            item.update({"verification": checks})
+            verified.append(item)
+
+    pass_rates = {}
+    for error_type, counts in checked.items():
+        total = counts["passed"] + counts["failed"]
+        pass_rates[error_type] = counts["passed"] / total if total else None
+
+    stats = {
+        "total": len(data),
+        "verified": len(verified),
+        "rejected": dict(rejected),
+        "checks": {k: dict(v) for k, v in checked.items()},
+        "pass_rates": pass_rates,
+        "error_types": dict(error_type_stats),
+    }
+    return verified, stats
+
+
+def print_stats(stats):
+    print(f"{stats['verified']} out of {stats['total']} items passed verification.")
+    for reason, count in stats["rejected"].items():
+        print(f"Rejected ({reason}): {count}")
+    for error_type, rate in stats["pass_rates"].items():
+        if rate is not None:
+            print(f"{error_type}: {rate:.2%} confirmed")
+
+
+def verify_and_save(data, num_workers=None, max_similarity=DEFAULT_MAX_SIMILARITY):
+    verified, stats = verify_embedded_errors(data, num_workers, max_similarity)
+    # Same shape as `output/embedded.json` so it can be fed to granular annotation.
+    write_to_json_file(
+        {"stats": stats["error_types"], "verification": stats, "results": verified},
+        "output/verified",
+    )
+    print_stats(stats)
+    return verified
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process file path argument.")
+
+    parser.add_argument(
+        "-i",
+        "--input_file_path",
+        type=str,
+        required=True,
+        help="File path of the error embedded data.",
+    )
+    parser.add_argument(
+        "--max_similarity",
+        type=float,
+        default=DEFAULT_MAX_SIMILARITY,
+        help="Reject corruptions at least this similar to the correct response.",
+    )
+
+    args = parser.parse_args()
+
+    file_path = args.input_file_path.replace(".json", "")
+    error_embedded_data = read_json_file(file_path)["results"]
+    verify_and_save(error_embedded_data, max_similarity=args.max_similarity)
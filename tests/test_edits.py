@@ -0,0 +1,79 @@
+import sys
+import types
+
+from src import embed, edits, utils
+
+
+RESPONSE = "def total(items):\n    for i in range(len(items)):\n        yield items[i]\n"
+
+
+def install_fake_model(monkeypatch, replies):
+    """Replaces the chat model by one that parses the next reply into the requested format."""
+    replies = iter(replies)
+
+    class FakeStructuredModel:
+        def __init__(self, output_format):
+            self.output_format = output_format
+
+        def invoke(self, prompt):
+            raw = types.SimpleNamespace(usage_metadata={"input_tokens": 10, "output_tokens": 5})
+            return {"raw": raw, "parsed": self.output_format(**next(replies)), "parsing_error": None}
+
+    class FakeChatOpenAI:
+        def __init__(self, **kwargs):
+            pass
+
+        def with_structured_output(self, output_format, **kwargs):
+            return FakeStructuredModel(output_format)
+
+    monkeypatch.setitem(sys.modules, "langchain_openai", types.SimpleNamespace(ChatOpenAI=FakeChatOpenAI))
+    monkeypatch.setattr(utils, "load_environment", lambda: None)
+
+
+def test_query_openai_llm_returns_a_dict(monkeypatch):
+    install_fake_model(monkeypatch, [{"edits": [{"search": "a", "replace": "b"}]}])
+
+    out = utils.query_openai_llm("prompt", edits.EditScript)
+
+    assert out == {"edits": [{"search": "a", "replace": "b"}]}
+
+
+def test_embed_edit_mode_with_a_retry(monkeypatch):
+    first = {
+        "error_types": ["off-by-one-errors"],
+        "embedded_errors": {"off-by-one-errors": "The loop skips the last element."},
+        "edits": [{"search": "range(len(item))", "replace": "range(len(items) - 1)", "error_type": "off-by-one-errors"}],
+    }
+    retry = {"edits": [{"search": "range(len(items))", "replace": "range(len(items) - 1)", "error_type": "off-by-one-errors"}]}
+    install_fake_model(monkeypatch, [first, retry])
+
+    out = embed.query_gpt_edits("Yield the items.", RESPONSE, [("off-by-one-errors", "")], 0)
+
+    assert out["error_types"] == ["off-by-one-errors"]
+    assert "range(len(items) - 1)" in out["error_embedded_response"]
+
+
+def test_rectify_drops_half_applied_fixes(monkeypatch, tmp_path):
+    from src import rectify
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "output").mkdir()
+    fix = {"search": "yield items[i]", "replace": "yield items[i] * 2"}
+    broken = {"search": "not in the response", "replace": ""}
+    install_fake_model(
+        monkeypatch,
+        [
+            {"edits": [fix], "correction_details": "Doubles the items."},
+            {"edits": [fix, broken], "correction_details": "Doubles the items."},
+            {"edits": [broken]},
+        ],
+    )
+    monkeypatch.setattr(rectify, "run_in_parallel_thread", lambda func, args_list, *_, **__: [func(*args) for args in args_list])
+    monkeypatch.setattr(rectify, "record_stage_usage", lambda stage, usage: None)
+    data = [{"problem": "Yield the items.", "solution": RESPONSE, "id": i} for i in range(2)]
+
+    rectify.rectify_issues(data, edit_mode=True)
+
+    fixed = utils.read_json_file("output/fixed")
+    assert [item["id"] for item in fixed] == [0]
+    assert "items[i] * 2" in fixed[0]["correct_response"]
@@ -0,0 +1,74 @@
+import json
+
+from src.granular_annotation import annotate_chunk, annotate_window_chunk
+
+
+CORRECT = "import math\nx = 1\nprint(x)\n" + "y = 2\n" * 5 + "print(math.pi)\n"
+INCORRECT = "x = 1\nprint(x)\n" + "y = 3\n" * 5 + "print(math.pi)\n"
+
+
+def get_regions(fragments):
+    return json.loads(fragments[0])["masked_regions"]
+
+
+def test_window_mode_matches_single_prompt_mode():
+    raw = json.dumps(
+        {
+            "incorrect_regions": [
+                {"error_substring": "import math", "error_explanation": "Missing import."},
+                {"error_substring": "y = 3", "error_explanation": "Wrong value."},
+            ]
+        }
+    )
+    item = {"correct_response": CORRECT, "error_embedded_response": INCORRECT}
+    windows = [(0, 20, raw), (14, len(INCORRECT), raw)]
+
+    single = get_regions(annotate_chunk([(dict(item), raw)]))
+    windowed = get_regions(annotate_window_chunk([(dict(item), windows)]))
+
+    assert [0, 11, 1] in single and [0, 11, 1] in windowed
+    assert [r for r in windowed if r[2] == 1] == [r for r in single if r[2] == 1]
+
+
+def test_window_occurrence_is_preferred_in_the_incorrect_response():
+    raw = json.dumps({"incorrect_regions": [{"error_substring": "y = 3", "error_explanation": ""}]})
+    item = {"correct_response": CORRECT, "error_embedded_response": INCORRECT}
+    start = INCORRECT.rfind("y = 3")
+
+    regions = get_regions(annotate_window_chunk([(dict(item), [(start, len(INCORRECT), raw)])]))
+
+    assert regions == [[start, start + 5, -1]]
+
+
+def test_window_calls_share_the_request_limit(monkeypatch):
+    import threading
+    import time
+
+    from src import granular_annotation
+
+    in_flight, peak = [0], [0]
+    lock = threading.Lock()
+
+    def fake_query(prompt):
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        time.sleep(0.01)
+        with lock:
+            in_flight[0] -= 1
+        return json.dumps({"incorrect_regions": []})
+
+    monkeypatch.setattr(granular_annotation, "query_openai_llm_raw", fake_query)
+    limiter = threading.Semaphore(3)
+    windows = [(i, i + 1) for i in range(8)]
+    items = [{"prompt": "", "error_embedded_response": "x" * 10, "embedded_errors": {}} for _ in range(4)]
+    threads = [
+        threading.Thread(target=granular_annotation.query_gpt_windows_raw, args=(item, windows, limiter))
+        for item in items
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert peak[0] == 3
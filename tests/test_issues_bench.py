@@ -0,0 +1,29 @@
+from src import issues_bench
+from src.issues_bench import CorrectnessEvaluation
+
+
+def fake_evaluation(prompt, output_format):
+    # The buggy response is judged wrong with errors, the other one right without.
+    value, error_types = ("No", ["off-by-one-errors"]) if "BUGGY" in prompt else ("Yes", [])
+    correctness = {aspect: {"value": value, "explanation": ""} for aspect in CorrectnessEvaluation.model_fields}
+    errors = {"error_types": error_types, "embedded_errors": {}}
+    if output_format is issues_bench.CorrectnessEvaluation:
+        return correctness
+    if output_format is issues_bench.EmbeddedErrors:
+        return errors
+    return {**correctness, **errors}
+
+
+def test_agreement_check_tells_apart_items_sharing_a_prompt(monkeypatch):
+    items = [
+        {"p_id": 7, "prompt": "Sum a list.", "pipeline_response": [{"role": "assistant", "content": response}]}
+        for response in ("return sum(items)", "return sum(items[:-1])  # BUGGY")
+    ]
+    monkeypatch.setattr(issues_bench, "load_model_data", lambda file_path, sample_size=10: items)
+    monkeypatch.setattr(issues_bench, "query_openai_llm", fake_evaluation)
+
+    agreement = issues_bench.run_agreement_check("model.json", num_workers=4)
+
+    assert agreement["accuracy"] == 1.0
+    assert agreement["has_errors"] == 1.0
+    assert agreement["error_types_jaccard"] == 1.0
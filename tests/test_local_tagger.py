@@ -0,0 +1,41 @@
+from src import local_tagger
+from src.embed import format_error_list, UNPLANNED_SUGGESTION
+
+
+DATA = [{"problem": f"Sum the list {i}.", "solution": f"print(sum(values[{i}]))", "id": i} for i in range(6)]
+
+
+def fake_query_gpt(failures):
+    calls = []
+
+    def query_gpt(prompt, response, item_id):
+        calls.append(item_id)
+        if failures.get(item_id, 0) > calls.count(item_id) - 1:
+            raise RuntimeError("API error")
+        return {
+            "prompt": prompt,
+            "response": response,
+            "id": item_id,
+            "tagged_erros": {"error_types": [], "embedding_plan": {}},
+        }
+
+    return query_gpt, calls
+
+
+def test_failed_calls_are_retried(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    query_gpt, calls = fake_query_gpt({1: 1, 2: 5})
+    monkeypatch.setattr(local_tagger, "query_gpt", query_gpt)
+
+    results = local_tagger.tag_error_types_active(DATA, batch_size=6, min_labels=100, num_workers=2, max_attempts=3)
+
+    assert sorted(res["id"] for res in results) == [0, 1, 3, 4, 5]
+    assert calls.count(1) == 2 and calls.count(2) == 3
+
+
+def test_local_items_ask_embed_to_plan():
+    res = local_tagger.get_local_result("prompt", "response", 0, [0.9] + [0.1] * (len(local_tagger.LABELS) - 1))
+    plan = res["tagged_erros"]["embedding_plan"]
+
+    assert plan == {local_tagger.LABELS[0]: ""}
+    assert format_error_list(plan.items()) == f"- {local_tagger.LABELS[0]}: {UNPLANNED_SUGGESTION}\n"
@@ -0,0 +1,84 @@
+import sys
+import json
+import types
+
+import pytest
+
+from src import embed, rectify, streaming, utils
+
+
+def install_fake_model(monkeypatch, reply, chunk_size=7):
+    """Replaces the chat model by one that streams `reply` in small chunks."""
+
+    class FakeStream:
+        def __init__(self):
+            self.chunks = iter(
+                types.SimpleNamespace(content=reply[i : i + chunk_size])
+                for i in range(0, len(reply), chunk_size)
+            )
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            return next(self.chunks)
+
+        def close(self):
+            pass
+
+    class FakeChatOpenAI:
+        def __init__(self, **kwargs):
+            pass
+
+        def bind(self, **kwargs):
+            return self
+
+        def stream(self, prompt):
+            return FakeStream()
+
+    monkeypatch.setitem(sys.modules, "langchain_openai", types.SimpleNamespace(ChatOpenAI=FakeChatOpenAI))
+    monkeypatch.setattr(streaming, "load_environment", lambda: None)
+    # Stopped streams count their tokens locally, the tiktoken encodings may not be downloadable here.
+    monkeypatch.setattr(utils, "get_encoding", lambda encoding_name="cl100k_base": types.SimpleNamespace(encode=str.split))
+
+
+def test_embed_streaming_accepts_the_prompted_shape(monkeypatch):
+    reply = {
+        "error_types": ["off-by-one-errors"],
+        "embedded_errors": {"off-by-one-errors": "The loop skips the last element."},
+        "error_embedded_response": "for i in range(len(items) - 1): ...",
+    }
+    install_fake_model(monkeypatch, json.dumps(reply))
+
+    out = embed.query_gpt_streaming("Sum a list.", "for i in range(len(items)): ...", [("off-by-one-errors", "")], 3)
+
+    assert out["error_types"] == reply["error_types"]
+    assert out["embedded_errors"] == reply["embedded_errors"]
+    assert out["error_embedded_response"] == reply["error_embedded_response"]
+    assert embed.get_embedded_error_types(out) == ["off-by-one-errors"]
+
+
+def test_embed_streaming_stops_when_nothing_is_embedded(monkeypatch):
+    install_fake_model(monkeypatch, '{"error_types": [], "embedded_errors": {"never": "read"}}')
+
+    out = embed.query_gpt_streaming("Sum a list.", "response", [], 3)
+
+    assert out["aborted"]
+    assert out["error_types"] == [] and out["embedded_errors"] == {}
+    assert out["error_embedded_response"] == ""
+
+
+def test_embed_streaming_rejects_malformed_replies(monkeypatch):
+    install_fake_model(monkeypatch, '{"error_types": ["x"], "embedded_errors": "not a dict"}')
+
+    with pytest.raises(Exception):
+        embed.query_gpt_streaming("Sum a list.", "response", [], 3)
+
+
+def test_rectify_streaming_drops_the_abort_reason(monkeypatch):
+    install_fake_model(monkeypatch, '{"correct_response": "", "correction_details": "Already correct."}')
+
+    out = rectify.query_gpt_streaming("Sum a list.", "response", 5)
+
+    assert "aborted" not in out
+    assert out["id"] == 5
@@ -0,0 +1,47 @@
+import re
+import json
+
+from src import tag_and_embed
+
+
+def fake_reply(error_types):
+    return {
+        "embedding_plan": {error_type: "Change the loop." for error_type in error_types},
+        "error_types": error_types,
+        "embedded_errors": {error_type: "Changed the loop." for error_type in error_types},
+        "error_embedded_response": "for i in range(len(items) - 1): ...",
+    }
+
+
+def run_fused(monkeypatch, tmp_path, replies, **kwargs):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "output").mkdir()
+    monkeypatch.setattr(
+        tag_and_embed,
+        "query_openai_llm",
+        lambda prompt, output_format: dict(replies[int(re.search(r"Sum list (\d+)", prompt).group(1))]),
+    )
+    data = [{"problem": f"Sum list {i}.", "solution": "for i in range(len(items)): ...", "id": i} for i in range(len(replies))]
+    tag_and_embed.tag_and_embed(data, num_workers=1, **kwargs)
+    with open("output/embedded.json") as jf:
+        return json.load(jf)
+
+
+def test_types_outside_the_allowed_list_are_not_embedded(monkeypatch, tmp_path):
+    replies = [fake_reply(["off-by-one-errors"]), fake_reply(["off-by-one-errors", "minor-syntax-errors"])]
+
+    embedded = run_fused(monkeypatch, tmp_path, replies, error_types=["off-by-one-errors"])
+
+    results = sorted(embedded["results"], key=lambda res: res["id"])
+    assert results[0]["error_types"] == ["off-by-one-errors"]
+    assert results[1]["error_types"] == [] and results[1]["error_embedded_response"] == ""
+    assert embedded["stats"]["off-by-one-errors"] == 1 and embedded["stats"]["minor-syntax-errors"] == 0
+
+
+def test_rarely_planned_types_are_not_embedded(monkeypatch, tmp_path):
+    replies = [fake_reply(["off-by-one-errors"])] * 2 + [fake_reply(["minor-syntax-errors"])]
+
+    embedded = run_fused(monkeypatch, tmp_path, replies, min_count=1)
+
+    assert sorted(res["id"] for res in embedded["results"] if res["error_embedded_response"]) == [0, 1]
+    assert embedded["stats"]["off-by-one-errors"] == 2 and embedded["stats"]["minor-syntax-errors"] == 0
@@ -0,0 +1,58 @@
+from src.verify import DEFAULT_MAX_SIMILARITY, is_unchanged, verify_item
+
+
+CORRECT = """Here is the function:
+
+```python
+def total(values):
+    result = 0
+    for value in values:
+        result += value
+    return result
+```
+"""
+
+LONG_CORRECT = """The recursive version computes the factorial by reducing the problem to a smaller one until it
+reaches the base case, then multiplies the partial results on the way back. The iterative helper sums
+the first n integers with a simple loop, which keeps the memory usage constant.
+
+```python
+def factorial(n):
+    if n <= 1:
+        return 1
+    return n * factorial(n - 1)
+
+
+def sum_first(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+```
+
+Both functions expect a non-negative integer and run in linear time in n.
+"""
+
+
+def test_one_token_corruptions_are_kept():
+    pairs = [
+        (LONG_CORRECT, LONG_CORRECT.replace("range(n)", "range(n + 1)")),
+        (LONG_CORRECT, LONG_CORRECT.replace("def sum_first(n):", "def sum_first(n)")),
+        (LONG_CORRECT, LONG_CORRECT.replace("if n <= 1:", "if n <= 0:")),
+        (CORRECT, CORRECT.replace("result = 0", "result = 1")),
+    ]
+    for correct, incorrect in pairs:
+        assert not is_unchanged(correct, incorrect)
+        item = {"correct_response": correct, "error_embedded_response": incorrect}
+        assert verify_item(item)[0] != "unchanged"
+
+
+def test_whitespace_only_change_is_unchanged():
+    assert is_unchanged(CORRECT, "  " + CORRECT.replace("\n", " \n"))
+    assert verify_item({"correct_response": CORRECT, "error_embedded_response": CORRECT + "\n"})[0] == "unchanged"
+
+
+def test_lower_similarity_rejects_near_copies():
+    incorrect = CORRECT.replace("result = 0", "result = 1")
+    assert DEFAULT_MAX_SIMILARITY == 1.0
+    assert is_unchanged(CORRECT, incorrect, max_similarity=0.95)